@@ -0,0 +1,147 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Executor
+from typing import Callable, Optional
+import wirepas_mesh_messaging as wmm
+import mbproto.mb_protocol_answers_pb2 as mb_answers
+from mbproto.mb_protocol_iface import MBProto
+from pymodbus.client import ModbusFrameGenerator
+from pymodbus.framer import FramerType
+from uplink_decoder import ModbusResponse, Uplink, UplinkDecoder
+from request_tracker import RequestKey, request_key, uplink_key
+
+
+class GatewayError(Exception):
+    """The gateway refused a downlink, res is the GatewayResultCode"""
+
+    def __init__(self, gateway: str, sink: str, res):
+        super().__init__("Cannot send data to %s:%s res=%s" % (gateway, sink, res))
+        self.res = res
+
+
+class ModbusError(Exception):
+    """The Modbus slave answered with an exception"""
+
+    def __init__(self, response: ModbusResponse):
+        super().__init__("Modbus exception 0x%02x from slave %d" % (response.exception_code, response.slave))
+        self.response = response
+
+
+class AsyncWmbClient():
+    """
+    asyncio facade over a WirepasNetworkInterface.
+
+    Each request coroutine sends its downlink and resolves with the uplink
+    answering it, matched like RequestTracker does: answers to requests of
+    one kind to one node arrive in order. The blocking send_message runs in
+    an executor and at most concurrency requests are outstanding at a time;
+    waiting for the answer itself costs no thread.
+
+    Use it as an async context manager from the event loop that awaits it:
+
+        async with AsyncWmbClient(wni) as client:
+            response = await client.read_input_registers(gw, sink, node, 0x0, 2)
+    """
+
+    def __init__(self, wni, concurrency: int = 256, timeout: float = 30.0, executor: Optional[Executor] = None):
+        self.wni = wni
+        self.timeout = timeout
+        self.executor = executor
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending: dict[RequestKey, deque[asyncio.Future]] = defaultdict(deque)
+        self._decoder = UplinkDecoder()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._cb_id = None
+
+    async def __aenter__(self) -> "AsyncWmbClient":
+        self._loop = asyncio.get_running_loop()
+        self._cb_id = self.wni.register_uplink_traffic_cb(self._on_uplink, src_ep=66, dst_ep=77)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.wni.unregister_uplink_traffic_cb(self._cb_id)
+        for pending in self._pending.values():
+            for future in pending:
+                future.cancel()
+        self._pending.clear()
+
+    def _on_uplink(self, data):
+        # MQTT network thread: decode here, resolve on the event loop
+        try:
+            uplink = self._decoder.decode(data.data_payload)
+        except ValueError as e:
+            logging.error("Failed to decode uplink from %s: %s", data.source_address, e)
+            return
+        key = uplink_key(data.gw_id, data.sink_id, data.source_address, uplink)
+        if key is not None:
+            self._loop.call_soon_threadsafe(self._resolve, key, uplink)
+
+    def _resolve(self, key: RequestKey, uplink: Uplink):
+        pending = self._pending.get(key)
+        while pending:
+            future = pending.popleft()
+            if not future.done():
+                future.set_result(uplink)
+                break
+        if not pending:
+            self._pending.pop(key, None)
+
+    async def request(self, gateway: str, sink: str, node: int, payload: bytes,
+                      timeout: Optional[float] = None, on_sent: Optional[Callable[[float], None]] = None) -> Uplink:
+        """
+        Send an MBProto payload and return the uplink answering it. on_sent
+        is called with the monotonic time the request goes out at, once it
+        got a slot in the window.
+        """
+        key = request_key(gateway, sink, node, payload)
+        async with self._semaphore:
+            if on_sent is not None:
+                on_sent(time.monotonic())
+            future = self._loop.create_future()
+            # Queue before sending, the answer may come back before send_message returns
+            self._pending[key].append(future)
+            try:
+                res = await self._loop.run_in_executor(
+                    self.executor, functools.partial(self.wni.send_message, gateway, sink, node, 77, 66, payload))
+                if res != wmm.GatewayResultCode.GW_RES_OK:
+                    raise GatewayError(gateway, sink, res)
+                return await asyncio.wait_for(future, timeout if timeout is not None else self.timeout)
+            finally:
+                pending = self._pending.get(key)
+                if pending is not None and future in pending:
+                    pending.remove(future)
+                    if not pending:
+                        del self._pending[key]
+
+    async def _read_registers(self, function: str, gateway: str, sink: str, node: int, address: int, count: int,
+                              slave: int, port: int, timeout: Optional[float]) -> ModbusResponse:
+        generator = ModbusFrameGenerator(framer=FramerType.RTU, slave=slave)
+        mbproto = MBProto()
+        mbproto.target_port = port
+        payload = mbproto.create_modbus_oneshot(getattr(generator, function)(address=address, count=count))
+        response = (await self.request(gateway, sink, node, payload, timeout)).modbus
+        if response.exception_code:
+            raise ModbusError(response)
+        return response
+
+    async def read_input_registers(self, gateway: str, sink: str, node: int, address: int, count: int,
+                                   slave: int = 1, port: int = 1, timeout: Optional[float] = None) -> ModbusResponse:
+        return await self._read_registers('read_input_registers', gateway, sink, node, address, count,
+                                          slave, port, timeout)
+
+    async def read_holding_registers(self, gateway: str, sink: str, node: int, address: int, count: int,
+                                     slave: int = 1, port: int = 1, timeout: Optional[float] = None) -> ModbusResponse:
+        return await self._read_registers('read_holding_registers', gateway, sink, node, address, count,
+                                          slave, port, timeout)
+
+    async def set_periodic(self, gateway: str, sink: str, node: int, index: int, interval: int, modbus_frame: bytes,
+                           port: int = 1, timeout: Optional[float] = None) -> bool:
+        """Configure periodic Modbus request index on a node, return True on ACK and False on NACK"""
+        mbproto = MBProto()
+        mbproto.target_port = port
+        payload = mbproto.create_modbus_periodic(index, interval, modbus_frame)
+        uplink = await self.request(gateway, sink, node, payload, timeout)
+        return uplink.ack == mb_answers.Acknowladge.ACKNOWLADGE_ACK
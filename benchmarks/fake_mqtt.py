@@ -0,0 +1,28 @@
+import threading
+from typing import NamedTuple
+
+
+class _MessageInfo(NamedTuple):
+    rc: int = 0
+
+    def is_published(self) -> bool:
+        return True
+
+
+class FakeMqttClient():
+    """Stand-in for a connected paho.mqtt.client.Client keeping the published messages in memory"""
+
+    def __init__(self):
+        self.messages: list[tuple[str, bytes, int]] = []
+        self._lock = threading.Lock()
+
+    def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        with self._lock:
+            self.messages.append((topic, payload, qos))
+        return _MessageInfo()
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
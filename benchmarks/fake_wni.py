@@ -0,0 +1,196 @@
+import heapq
+import itertools
+import random
+import struct
+import threading
+import time
+from typing import Callable, Optional
+import wirepas_mesh_messaging as wmm
+import mbproto.mb_protocol_pb2 as mb_protocol
+import mbproto.mb_protocol_answers_pb2 as mb_answers
+import mbproto.mb_protocol_enums_pb2 as mb_enums
+from le_01mq_registers import LE_01MQ, TYPES, RegisterMap
+from uplink_decoder import FC_READ_HOLDING_REGISTERS, FC_READ_INPUT_REGISTERS
+from benchmarks.uplinks import (build_ack_uplink, build_diagnostics_uplink, build_modbus_uplink,
+                               build_read_registers_response, build_rtu_response)
+
+
+def encode_registers(register_map: RegisterMap, values: dict[str, float]) -> dict[int, int]:
+    """Inverse of RegisterMap.decode(): register address -> 16-bit value"""
+    image = {}
+    for name, value in values.items():
+        register = register_map.by_name[name]
+        fmt, count = TYPES[register.type]
+        if register.scale != 1.0:
+            value = value / register.scale
+        if fmt != 'f':
+            value = int(round(value))
+        words = struct.unpack(">%dH" % count, struct.pack(">" + fmt, value))
+        if register.word_order == 'CDAB' and count == 2:
+            words = words[::-1]
+        for offset, word in enumerate(words):
+            image[register.address + offset] = word
+    return image
+
+
+class FakeDevice():
+    """A Modbus slave behind a WMB node, answering register reads from a register image"""
+
+    def __init__(self, values: Optional[dict[str, float]] = None, register_map: RegisterMap = LE_01MQ):
+        if values is None:
+            values = {register.name: 230.0 for register in register_map.registers}
+        self.registers = encode_registers(register_map, values)
+        # Settings reported to CMD_DIAGNOSTICS and changed by the configuration commands
+        self.diagnostics = mb_answers.DiagnosticsAnsFrame(
+            device_mode=mb_enums.MODBUS_MODE_MASTER, antenna_settings=mb_enums.ANTENNA_INTERNAL,
+            baud_port_0=mb_enums.PORT_BAUD_9600, parity_port_0=mb_enums.PORT_PARITY_NONE,
+            stop_bits_port_0=mb_enums.PORT_STOP_BITS_1, baud_port_1=mb_enums.PORT_BAUD_9600,
+            parity_port_1=mb_enums.PORT_PARITY_NONE, stop_bits_port_1=mb_enums.PORT_STOP_BITS_1)
+
+    def answer(self, request: bytes) -> bytes:
+        slave, function_code, address, count = struct.unpack_from(">BBHH", request)
+        if function_code not in (FC_READ_HOLDING_REGISTERS, FC_READ_INPUT_REGISTERS):
+            # Illegal function
+            return build_rtu_response(slave, function_code | 0x80, b"\x01")
+        registers = [self.registers.get(address + i, 0) for i in range(count)]
+        return build_read_registers_response(slave, registers, function_code)
+
+
+class FakeWirepasNetworkInterface():
+    """
+    In-process stand-in for wirepas_mqtt_library.WirepasNetworkInterface.
+
+    Downlinks are decoded as MBProto commands and answered by the FakeDevice
+    of the destination node: one-shot Modbus reads with a Modbus response,
+    diagnostics with the device settings, and every other command with an
+    ACK after applying it to those settings. Answers are delivered to the
+    registered uplink callbacks from a delivery thread after latency +/-
+    jitter seconds.
+
+    loss drops that fraction of answers; once one is dropped, the next
+    loss_burst - 1 answers are dropped too. With burst_period set, answers
+    are held back and released together on multiples of burst_period, like
+    a gateway flushing its buffer.
+    """
+
+    def __init__(self,
+                 devices: Optional[dict[tuple[str, str, int], FakeDevice]] = None,
+                 default_device: Optional[FakeDevice] = None,
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 loss: float = 0.0,
+                 loss_burst: int = 1,
+                 burst_period: float = 0.0,
+                 seed: Optional[int] = None):
+        self.devices = devices or {}
+        self.default_device = default_device or FakeDevice()
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.loss_burst = loss_burst
+        self.burst_period = burst_period
+        self.sent = 0
+        self.answered = 0
+        self.lost = 0
+        self._random = random.Random(seed)
+        self._losing = 0
+        self._callbacks: dict[int, tuple[Callable, Optional[str], Optional[str], Optional[int], Optional[int]]] = {}
+        self._ids = itertools.count()
+        self._sequence = itertools.count()
+        self._pending: list[tuple[float, int, Callable, tuple]] = []
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="fake-wni", daemon=True)
+        self._thread.start()
+
+    def register_uplink_traffic_cb(self, cb, gateway=None, sink=None, network=None, src_ep=None, dst_ep=None) -> int:
+        with self._cond:
+            cb_id = next(self._ids)
+            self._callbacks[cb_id] = (cb, gateway, sink, src_ep, dst_ep)
+            return cb_id
+
+    def unregister_uplink_traffic_cb(self, cb_id: int):
+        with self._cond:
+            self._callbacks.pop(cb_id, None)
+
+    def send_message(self, gw_id, sink_id, dest, src_ep, dst_ep, payload, qos=0, csma_ca_only=False, hop_limit=0,
+                     cb=None, param=None, timeout=2):
+        uplink = self._answer(payload, self.devices.get((gw_id, sink_id, int(dest)), self.default_device))
+        with self._cond:
+            self.sent += 1
+            if self._lose():
+                self.lost += 1
+            else:
+                delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+                due = time.monotonic() + delay
+                if self.burst_period:
+                    due = (due // self.burst_period + 1) * self.burst_period
+                # Answers travel from the node's source endpoint back to our destination endpoint
+                event = wmm.ReceivedDataEvent(gw_id, sink_id, int(time.time() * 1000), int(dest), 1,
+                                              dst_ep, src_ep, int(delay * 1000), qos, data=uplink)
+                self._schedule(due, self._deliver, (event,))
+            if cb is not None:
+                self._schedule(time.monotonic(), cb, (wmm.GatewayResultCode.GW_RES_OK, param))
+        if cb is None:
+            return wmm.GatewayResultCode.GW_RES_OK
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def _lose(self) -> bool:
+        if self._losing:
+            self._losing -= 1
+            return True
+        if self.loss and self._random.random() < self.loss:
+            self._losing = self.loss_burst - 1
+            return True
+        return False
+
+    @staticmethod
+    def _answer(payload: bytes, device: FakeDevice) -> bytes:
+        message = mb_protocol.MbMessage()
+        message.ParseFromString(payload[:-2])
+        frame = message.payload.payload_cmd_frame
+        if message.cmd == mb_protocol.Cmd.CMD_MODBUS_ONE_SHOT:
+            request = frame.modbus_one_shot_frame
+            return build_modbus_uplink(device.answer(request.modbus_frame), 0, message.cmd, request.modbus_port)
+        if message.cmd == mb_protocol.Cmd.CMD_DIAGNOSTICS:
+            return build_diagnostics_uplink(device.diagnostics)
+        diagnostics = device.diagnostics
+        if message.cmd == mb_protocol.Cmd.CMD_DEV_MODE:
+            diagnostics.device_mode = frame.device_mode_frame.device_mode
+        elif message.cmd == mb_protocol.Cmd.CMD_ANTENA_CONFIG:
+            diagnostics.antenna_settings = frame.antenna_settings_frame.antenna_settings
+        elif message.cmd == mb_protocol.Cmd.CMD_PORT_CONFIG:
+            port = frame.port_settings_frame
+            suffix = "0" if port.modbus_port == mb_enums.MODBUS_PORT_ZERO else "1"
+            setattr(diagnostics, "baud_port_" + suffix, port.port_baud)
+            setattr(diagnostics, "parity_port_" + suffix, port.port_parity)
+            setattr(diagnostics, "stop_bits_port_" + suffix, port.port_stop_bits)
+        return build_ack_uplink(message.cmd)
+
+    def _schedule(self, due: float, fn: Callable, args: tuple):
+        heapq.heappush(self._pending, (due, next(self._sequence), fn, args))
+        self._cond.notify()
+
+    def _deliver(self, event):
+        with self._cond:
+            callbacks = [cb for cb, gateway, sink, src_ep, dst_ep in self._callbacks.values()
+                         if gateway in (None, event.gw_id) and sink in (None, event.sink_id)
+                         and src_ep in (None, event.source_endpoint) and dst_ep in (None, event.destination_endpoint)]
+            self.answered += 1
+        for cb in callbacks:
+            cb(event)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and (not self._pending or self._pending[0][0] > time.monotonic()):
+                    self._cond.wait(self._pending[0][0] - time.monotonic() if self._pending else None)
+                if not self._running:
+                    return
+                _, _, fn, args = heapq.heappop(self._pending)
+            fn(*args)
@@ -0,0 +1,66 @@
+import argparse
+import random
+import struct
+import time
+from le_01mq_registers import LE_01MQ
+from benchmarks.uplinks import float_to_registers
+
+
+def mbd_to_float(input: bytes | bytearray | list[int]) -> float:
+    assert len(input) == 4
+    return struct.unpack("<f", bytes([input[2], input[3], input[0], input[1]]))[0]
+
+
+def legacy_decode(address: int, registers: list[int]) -> dict[str, float]:
+    # One mbd_to_float() per mapped value, as le_01mq_mqtt.py did for the voltage
+    values = {}
+    for register in LE_01MQ.registers:
+        offset = register.address - address
+        if offset < 0 or offset + 2 > len(registers):
+            continue
+        _result_bytes = bytearray()
+        for val in registers[offset:offset + 2]:
+            _result_bytes.extend(val.to_bytes(length=2, byteorder="little"))
+        values[register.name] = mbd_to_float(_result_bytes)
+    return values
+
+
+def make_blocks(count: int, address: int = 0x0b, length: int = 18) -> list[list[int]]:
+    blocks = []
+    for _ in range(count):
+        block = [0] * length
+        for offset in range(1, length - 1, 6):
+            block[offset:offset + 2] = float_to_registers(random.uniform(0, 5000))
+        blocks.append(block)
+    return blocks
+
+
+def run(count: int) -> dict:
+    blocks = make_blocks(count)
+    assert legacy_decode(0x0b, blocks[0]) == LE_01MQ.decode(0x0b, blocks[0])
+    result = {"blocks": count}
+    start = time.perf_counter()
+    for block in blocks:
+        legacy_decode(0x0b, block)
+    result["legacy_blocks_per_s"] = count / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for block in blocks:
+        LE_01MQ.decode(0x0b, block)
+    result["decode_blocks_per_s"] = count / (time.perf_counter() - start)
+    start = time.perf_counter()
+    LE_01MQ.decode_many(0x0b, blocks)
+    result["decode_many_blocks_per_s"] = count / (time.perf_counter() - start)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count',
+                        required=False,
+                        type=int,
+                        default=100000,
+                        help='Number of 18-register blocks to decode')
+    args = parser.parse_args()
+
+    for name, value in run(args.count).items():
+        print("%s: %.0f" % (name, value))
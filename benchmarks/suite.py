@@ -0,0 +1,357 @@
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import tracemalloc
+import wirepas_mesh_messaging as wmm
+from pymodbus.client import ModbusFrameGenerator
+from pymodbus.framer import FramerType
+from mbproto.mb_protocol_iface import MBProto
+from uplink_decoder import UplinkDecoder
+from le_01mq_registers import LE_01MQ
+from fleet_poller import FleetEntry, FleetPoller
+from provisioner import ConfigJob, Provisioner
+from request_tracker import RequestTracker, uplink_key
+from benchmarks import register_map, uplink_decoder
+from rtu_sniffer import ModbusSniffer, crc16_modbus
+from series_store import SeriesStore
+from profiling import StageProfiler
+from connection_manager import SharedConnection
+from republisher import MqttSink, Reading, Republisher
+from benchmarks.fake_mqtt import FakeMqttClient
+from benchmarks.uplinks import build_modbus_uplink, build_read_registers_response, build_rtu_response
+from benchmarks.fake_wni import FakeWirepasNetworkInterface
+
+# Metrics compared against a baseline: name suffix -> True if higher is better
+DIRECTIONS = {"_per_s": True, "_bytes": False, "_ms": False}
+
+
+def bench_decode(scale: float) -> dict:
+    return uplink_decoder.run(int(20000 * scale))
+
+
+def bench_profiling(scale: float) -> dict:
+    count = int(50000 * scale)
+    payloads = uplink_decoder.make_payloads()
+    decoder = UplinkDecoder()
+    result = {"messages": count}
+    for name, profiler in (("disabled", None), ("enabled", StageProfiler()),
+                           ("allocations", StageProfiler(allocations=True))):
+        decoder.profiler = profiler
+        result[name + "_msg_per_s"] = uplink_decoder.measure(decoder.decode, payloads, count)
+    return result
+
+
+def bench_register_map(scale: float) -> dict:
+    return register_map.run(int(100000 * scale))
+
+
+def bench_allocation(scale: float) -> dict:
+    payloads = uplink_decoder.make_payloads()
+    count = int(2000 * scale)
+    result = {"messages": count}
+    for name, decode in (("legacy", uplink_decoder.legacy_decode), ("fast", uplink_decoder.fast_decode_factory())):
+        decode(payloads[0])
+        tracemalloc.start()
+        peak = 0
+        for i in range(count):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            decode(payloads[i % len(payloads)])
+            peak += tracemalloc.get_traced_memory()[1] - current
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        result[name + "_peak_bytes"] = peak / count
+        result[name + "_retained_bytes"] = retained
+    return result
+
+
+def read_voltage_payload(entry: FleetEntry) -> bytes:
+    generator = ModbusFrameGenerator(framer=FramerType.RTU, slave=entry.modbus_addr)
+    mbproto = MBProto()
+    mbproto.target_port = entry.target_port
+    return mbproto.create_modbus_oneshot(generator.read_input_registers(address=0x0, count=2))
+
+
+def bench_fleet(scale: float, latency: float, jitter: float, loss: float) -> dict:
+    nodes = int(200 * scale)
+    period = 2.0
+    cycles = 3
+    inventory = [FleetEntry("gw%d" % (i % 2), "sink%d" % (i % 4), i) for i in range(nodes)]
+    wni = FakeWirepasNetworkInterface(latency=latency, jitter=jitter, loss=loss, seed=1)
+    tracker = RequestTracker(timeout=period)
+    poller = FleetPoller(wni, inventory, read_voltage_payload, period, window=8, answer_timeout=period, tracker=tracker)
+    decoder = UplinkDecoder()
+
+    def on_uplink(data):
+        tracker.received(uplink_key(data.gw_id, data.sink_id, data.source_address, decoder.decode(data.data_payload)))
+
+    poller.register_uplink_cb(on_uplink)
+    cpu = time.process_time()
+    start = time.perf_counter()
+    poller.start()
+    time.sleep(period * cycles)
+    poller.stop()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    time.sleep(latency + jitter + 0.1)
+    wni.close()
+    tracker.expire(time.monotonic() + period + 1)
+    totals = tracker.totals()
+    return {"nodes": nodes,
+            "requests_per_s": totals.sent / elapsed,
+            "target_requests_per_s": nodes / period,
+            "answered": totals.answered,
+            "lost": totals.lost,
+            "rtt_p50_ms": totals.rtt.quantile(0.5) * 1000,
+            "rtt_p99_ms": totals.rtt.quantile(0.99) * 1000,
+            "cpu_ms": cpu * 1000}
+
+
+def bench_config_push(scale: float, latency: float, jitter: float, loss: float) -> dict:
+    nodes = int(100 * scale)
+    configurations = 4
+    wni = FakeWirepasNetworkInterface(latency=latency, jitter=jitter, loss=loss, seed=1)
+    provisioner = Provisioner(wni, window=16, ack_timeout=max(0.5, 4 * (latency + jitter)), retries=3)
+    decoder = UplinkDecoder()
+    wni.register_uplink_traffic_cb(lambda data: provisioner.on_uplink(data, decoder.decode(data.data_payload)))
+    mbproto = MBProto()
+    mbproto.target_port = 1
+    generator = ModbusFrameGenerator(framer=FramerType.RTU, slave=1)
+    jobs = [ConfigJob("gw0", "sink0", node, index,
+                      mbproto.create_modbus_periodic(index, 60, generator.read_input_registers(address=index * 6, count=2)))
+            for node in range(nodes) for index in range(1, configurations + 1)]
+    start = time.perf_counter()
+    results = provisioner.run(jobs)
+    elapsed = time.perf_counter() - start
+    wni.close()
+    node_results = [r for rs in results.values() for r in rs]
+    return {"configurations": len(jobs),
+            "configurations_per_s": len(jobs) / elapsed,
+            "acknowledged": sum(r.status == "ack" for r in node_results),
+            "retries": sum(r.attempts - 1 for r in node_results),
+            "push_ms": elapsed * 1000}
+
+
+def bench_republish(scale: float) -> dict:
+    meters = int(1000 * scale)
+    names = [register.name for register in LE_01MQ.registers]
+    readings = [[Reading("gw0", "sink0", node, name, 230.0, LE_01MQ.unit(name), 0) for name in names]
+                for node in range(meters)]
+    count = meters * len(names)
+    result = {"readings": count}
+    for name, max_batch in (("single", 1), ("batched", 500)):
+        client = FakeMqttClient()
+        republisher = Republisher(MqttSink(client, "wmb/readings"), max_batch=max_batch, max_buffer=count)
+        start = time.perf_counter()
+        republisher.start()
+        for meter in readings:
+            republisher.publish(meter)
+        republisher.stop()
+        result[name + "_readings_per_s"] = count / (time.perf_counter() - start)
+        result[name + "_messages"] = len(client.messages)
+        result[name + "_bytes"] = sum(len(payload) for _, payload, _ in client.messages)
+    return result
+
+
+def bench_history(scale: float) -> dict:
+    meters = int(2000 * scale)
+    names = [register.name for register in LE_01MQ.registers]
+    store = SeriesStore(names, capacity=120, max_nodes=meters)
+    values = {name: 230.0 for name in names}
+    samples = 0
+    start = time.perf_counter()
+    for t in range(240):
+        for node in range(meters):
+            store.append(("gw0", "sink0", node), values, float(t))
+        samples += meters * len(names)
+    appended = time.perf_counter() - start
+    start = time.perf_counter()
+    for node in range(meters):
+        store.stats(("gw0", "sink0", node), "voltage", 60.0, now=239.0)
+    queried = time.perf_counter() - start
+    return {"series": meters * len(names), "samples_per_s": samples / appended, "queries_per_s": meters / queried,
+            "memory_bytes": store.memory}
+
+
+def bench_sniffer(scale: float) -> dict:
+    transactions = int(20000 * scale)
+    noise = random.Random(1)
+    result = {}
+    for name, garbage in (("clean", 0), ("noisy", 20)):
+        chunks = []
+        for i in range(transactions):
+            slave = 1 + i % 8
+            request = ModbusFrameGenerator(framer=FramerType.RTU, slave=slave).read_input_registers(address=0, count=18)
+            response = (build_read_registers_response(slave, list(range(18))) if i % 10
+                        else build_rtu_response(slave, 0x84, b"\x02"))
+            # Frames split at arbitrary boundaries, as the bus bytes reach the node, noisy ones after line noise
+            data = bytes(noise.randrange(256) for _ in range(garbage)) + request + response
+            chunks.extend((data[:11], data[11:]))
+        sniffer = ModbusSniffer()
+        start = time.perf_counter()
+        for i, chunk in enumerate(chunks):
+            sniffer.feed(("gw0", "sink0", 1, 1), chunk, i * 0.001)
+        elapsed = time.perf_counter() - start
+        # Clean keeps the unprefixed names of earlier results
+        prefix = "" if name == "clean" else name + "_"
+        result.update({prefix + "frames": sniffer.frames, prefix + "frames_per_s": sniffer.frames / elapsed,
+                       prefix + "skipped_bytes": sniffer.garbage})
+    # Busy bus: 32 slaves answering full 125 register reads back to back, where the CRC dominates
+    frames = []
+    for i in range(transactions):
+        slave = 1 + i % 32
+        frames.append(ModbusFrameGenerator(framer=FramerType.RTU, slave=slave).read_input_registers(address=0,
+                                                                                                   count=125))
+        frames.append(build_read_registers_response(slave, [(i + j) & 0xFFFF for j in range(125)]))
+    stream = b"".join(frames)
+    chunks = [stream[i:i + 200] for i in range(0, len(stream), 200)]
+    sniffer = ModbusSniffer()
+    start = time.perf_counter()
+    for i, chunk in enumerate(chunks):
+        sniffer.feed(("gw0", "sink0", 1, 1), chunk, i * 0.001)
+    elapsed = time.perf_counter() - start
+    crc_elapsed = float("inf")
+    # Best of three passes, the CRC alone is short enough to be noisy
+    for _ in range(3):
+        start = time.perf_counter()
+        for frame in frames:
+            crc16_modbus(frame, 0, len(frame) - 2)
+        crc_elapsed = min(crc_elapsed, time.perf_counter() - start)
+    result.update({"busy_frames": sniffer.frames, "busy_frames_per_s": sniffer.frames / elapsed,
+                   "busy_bytes_per_s": len(stream) / elapsed, "crc_bytes_per_s": len(stream) / crc_elapsed})
+    return result
+
+
+def bench_dispatch(scale: float) -> dict:
+    sites = int(500 * scale)
+    count = int(20000 * scale)
+    # A one-shot answer: periodic reports do not answer the pending requests
+    uplink = build_modbus_uplink(build_read_registers_response(1, [0x4366, 0x0000]))
+    events = [wmm.ReceivedDataEvent("gw%d" % (i % sites), "sink0", 0, i, 1, 66, 77, 0, 0, data=uplink)
+              for i in range(count)]
+    result = {"sites": sites, "uplinks": count}
+    filtered = FakeWirepasNetworkInterface()
+    for name in ("filtered", "indexed", "indexed_pending"):
+        if name == "filtered":
+            wni = fake = filtered
+        else:
+            # Answers are all lost, the uplinks below answer the requests
+            wni = SharedConnection(lambda connection_cb: FakeWirepasNetworkInterface(loss=1.0))
+            fake = wni._wni
+        received = []
+        for i in range(sites):
+            wni.register_uplink_traffic_cb(received.append, gateway="gw%d" % i, src_ep=66, dst_ep=77)
+        if name == "indexed_pending":
+            # One request waiting for an answer from the node of every uplink
+            for event in events:
+                entry = FleetEntry(event.gw_id, event.sink_id, event.source_address)
+                wni.send_message(entry.gateway, entry.sink, entry.node, 77, 66, read_voltage_payload(entry))
+        # Both interfaces hand uplinks to their callbacks the same way, SharedConnection through a single one
+        start = time.perf_counter()
+        for event in events:
+            fake._deliver(event)
+        result[name + "_uplinks_per_s"] = count / (time.perf_counter() - start)
+        assert len(received) == count
+        if name == "indexed_pending":
+            assert not wni._pending
+        wni.close()
+    return result
+
+
+BENCHMARKS = {
+    "decode": lambda args: bench_decode(args.scale),
+    "register_map": lambda args: bench_register_map(args.scale),
+    "allocation": lambda args: bench_allocation(args.scale),
+    "fleet": lambda args: bench_fleet(args.scale, args.latency, args.jitter, args.loss),
+    "config_push": lambda args: bench_config_push(args.scale, args.latency, args.jitter, args.loss),
+    "republish": lambda args: bench_republish(args.scale),
+    "profiling": lambda args: bench_profiling(args.scale),
+    "history": lambda args: bench_history(args.scale),
+    "sniffer": lambda args: bench_sniffer(args.scale),
+    "dispatch": lambda args: bench_dispatch(args.scale),
+}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return a description of every metric more than tolerance worse than in baseline"""
+    regressions = []
+    for name, metrics in results["benchmarks"].items():
+        for metric, value in metrics.items():
+            before = baseline.get("benchmarks", {}).get(name, {}).get(metric)
+            higher_is_better = next((d for suffix, d in DIRECTIONS.items() if metric.endswith(suffix)), None)
+            if higher_is_better is None or not before or "target" in metric:
+                continue
+            change = (value - before) / before
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append("%s.%s: %.4g -> %.4g (%+.0f%%)" % (name, metric, before, value, change * 100))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks',
+                        nargs='*',
+                        help='Benchmarks to run, all by default: %s' % ", ".join(BENCHMARKS))
+    parser.add_argument('--scale',
+                        required=False,
+                        type=float,
+                        default=1.0,
+                        help='Multiply message, node and configuration counts')
+    parser.add_argument('--latency',
+                        required=False,
+                        type=float,
+                        default=0.05,
+                        help='Fake network answer latency in seconds')
+    parser.add_argument('--jitter',
+                        required=False,
+                        type=float,
+                        default=0.02,
+                        help='Fake network latency jitter in seconds')
+    parser.add_argument('--loss',
+                        required=False,
+                        type=float,
+                        default=0.01,
+                        help='Fraction of answers lost by the fake network')
+    parser.add_argument('--output',
+                        required=False,
+                        help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare',
+                        required=False,
+                        help='Baseline JSON results, exit with status 1 on regressions')
+    parser.add_argument('--tolerance',
+                        required=False,
+                        type=float,
+                        default=0.2,
+                        help='Relative change tolerated before a metric counts as a regression')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark %s" % name)
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.WARNING)
+
+    results = {"python": platform.python_version(),
+               "platform": platform.platform(),
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "parameters": {"scale": args.scale, "latency": args.latency, "jitter": args.jitter, "loss": args.loss},
+               "benchmarks": {}}
+    for name in args.benchmarks or BENCHMARKS:
+        print("Running %s" % name, file=sys.stderr)
+        results["benchmarks"][name] = BENCHMARKS[name](args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression %s" % regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,85 @@
+import argparse
+import json
+import struct
+import time
+import mbproto.mb_protocol_pb2 as mb_protocol
+from mbproto.mb_protocol_iface import MBProto
+from google.protobuf.json_format import MessageToJson
+from uplink_decoder import UplinkDecoder, FC_READ_INPUT_REGISTERS, registers_to_float
+from benchmarks.uplinks import build_modbus_uplink, build_read_registers_response, float_to_registers
+
+
+def mbd_to_float(input: bytes | bytearray | list[int]) -> float:
+    assert len(input) == 4
+    return struct.unpack("<f", bytes([input[2], input[3], input[0], input[1]]))[0]
+
+
+def legacy_decode(payload: bytes) -> float | None:
+    # Callback body of le_01mq_mqtt.py before the fast-path decoder
+    _mbproto = MBProto()
+    _ret, _err, _msg = _mbproto.decode_response(payload)
+    _json_str = MessageToJson(_msg, always_print_fields_with_no_presence=True, preserving_proto_field_name=True)
+    _dict = json.loads(_json_str)
+    if (_msg.cmd == mb_protocol.Cmd.CMD_MODBUS_ONE_SHOT or _msg.cmd == mb_protocol.Cmd.CMD_MODBUS_PERIODICAL):
+        if (_msg.payload.payload_answer_frame.ack_frame.acknowladge == 0):
+            _modbus_data = _msg.payload.payload_answer_frame.modbus_response_frame.modbus_frame
+            _modbus_frame = _mbproto.decode_modbus_frame(_modbus_data)
+            _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame'] = _modbus_frame
+    if 'modbus_response_frame' in _dict['payload']['payload_answer_frame']:
+        if 'ReadInputRegistersResponse' in _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']:
+            _result = _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']['ReadInputRegistersResponse']['registers']
+            _result_bytes: bytearray = bytearray()
+            for val in _result:
+                _val_bytes: bytes = val.to_bytes(length=2, byteorder="little")
+                _result_bytes.extend(_val_bytes)
+            return mbd_to_float(input=_result_bytes)
+    return None
+
+
+def fast_decode_factory():
+    decoder = UplinkDecoder()
+
+    def fast_decode(payload: bytes) -> float | None:
+        uplink = decoder.decode(payload)
+        if uplink.modbus is not None and uplink.modbus.function_code == FC_READ_INPUT_REGISTERS:
+            return registers_to_float(uplink.modbus.registers)
+        return None
+    return fast_decode
+
+
+def measure(decode, payloads: list[bytes], count: int) -> float:
+    n = len(payloads)
+    start = time.perf_counter()
+    for i in range(count):
+        decode(payloads[i % n])
+    return count / (time.perf_counter() - start)
+
+
+def make_payloads(variants: int = 64) -> list[bytes]:
+    return [build_modbus_uplink(build_read_registers_response(1, float_to_registers(220.0 + i / 10)), 1)
+            for i in range(variants)]
+
+
+def run(count: int) -> dict:
+    payloads = make_payloads()
+    fast_decode = fast_decode_factory()
+    for payload in payloads:
+        assert legacy_decode(payload) == fast_decode(payload)
+    before = measure(legacy_decode, payloads, count)
+    after = measure(fast_decode, payloads, count)
+    return {"messages": count, "before_msg_per_s": before, "after_msg_per_s": after, "speedup": after / before}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count',
+                        required=False,
+                        type=int,
+                        default=20000,
+                        help='Number of uplinks to decode per variant')
+    args = parser.parse_args()
+
+    result = run(args.count)
+    print("before: %.0f msg/s" % result["before_msg_per_s"])
+    print("after:  %.0f msg/s" % result["after_msg_per_s"])
+    print("speedup: x%.1f" % result["speedup"])
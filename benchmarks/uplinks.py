@@ -0,0 +1,50 @@
+import struct
+import mbproto.mb_protocol_pb2 as mb_protocol
+import mbproto.mb_protocol_answers_pb2 as mb_answers
+from mbproto.mb_protocol_iface import MBProto
+from pymodbus.framer.rtu import FramerRTU
+
+
+def build_rtu_response(slave: int, function_code: int, pdu: bytes) -> bytes:
+    frame = bytes([slave, function_code]) + pdu
+    return frame + FramerRTU.compute_CRC(frame).to_bytes(2, "big")
+
+
+def build_read_registers_response(slave: int, registers: list[int], function_code: int = 0x04) -> bytes:
+    pdu = bytes([len(registers) * 2]) + struct.pack(">%dH" % len(registers), *registers)
+    return build_rtu_response(slave, function_code, pdu)
+
+
+def build_modbus_uplink(modbus_frame: bytes,
+                        configuration_index: int = 0,
+                        cmd: int = mb_protocol.Cmd.CMD_MODBUS_ONE_SHOT,
+                        modbus_port: int = 1) -> bytes:
+    mbproto = MBProto()
+    message = mbproto._create_message()
+    message.cmd = cmd
+    response = message.payload.payload_answer_frame.modbus_response_frame
+    response.modbus_port = modbus_port
+    response.configuration_index = configuration_index
+    response.modbus_frame = modbus_frame
+    return mbproto._add_crc(message.SerializeToString())
+
+
+def build_ack_uplink(cmd: int = mb_protocol.Cmd.CMD_MODBUS_PERIODICAL,
+                     ack: int = mb_answers.Acknowladge.ACKNOWLADGE_ACK) -> bytes:
+    mbproto = MBProto()
+    message = mbproto._create_message()
+    message.cmd = cmd
+    message.payload.payload_answer_frame.ack_frame.acknowladge = ack
+    return mbproto._add_crc(message.SerializeToString())
+
+
+def build_diagnostics_uplink(diagnostics: mb_answers.DiagnosticsAnsFrame) -> bytes:
+    mbproto = MBProto()
+    message = mbproto._create_message()
+    message.cmd = mb_protocol.Cmd.CMD_DIAGNOSTICS
+    message.payload.payload_answer_frame.diagnostics_ans_frame.CopyFrom(diagnostics)
+    return mbproto._add_crc(message.SerializeToString())
+
+
+def float_to_registers(value: float) -> list[int]:
+    return list(struct.unpack(">HH", struct.pack(">f", value)))
@@ -0,0 +1,285 @@
+import argparse
+import logging
+from typing import Any, Callable, NamedTuple, Optional
+
+
+def add_connection_arguments(parser: argparse.ArgumentParser):
+    """MQTT broker options shared by every example"""
+    parser.add_argument('--host',
+                        required=True,
+                        help="MQTT broker address")
+    parser.add_argument('--port',
+                        required=False,
+                        default=8883,
+                        type=int,
+                        help="MQTT broker port")
+    parser.add_argument('--username',
+                        required=False,
+                        default='mqttmasteruser',
+                        help="MQTT broker username")
+    parser.add_argument('--password',
+                        required=True,
+                        help="MQTT broker password")
+    parser.add_argument('--insecure',
+                        required=False,
+                        dest='insecure',
+                        action='store_true',
+                        help="MQTT use unsecured connection")
+    parser.add_argument('--no-replay',
+                        required=False,
+                        dest='replay',
+                        action='store_false',
+                        help="Do not send again the requests left unanswered when the broker connection drops")
+
+
+def connect(args: argparse.Namespace):
+    """
+    Connect to the broker given by the connection options, through the
+    connection shared by everything running in the process
+    """
+    # Imported here so that argument errors and --help do not pay for it
+    from connection_manager import default_manager
+    return default_manager.connect(args.host,
+                                   args.port,
+                                   args.username,
+                                   args.password,
+                                   insecure=args.insecure,
+                                   replay=args.replay)
+
+
+def add_profiling_arguments(parser: argparse.ArgumentParser):
+    """Options of profiling.StageProfiler"""
+    parser.add_argument('--profile-interval',
+                        required=False,
+                        type=float,
+                        default=0.0,
+                        help='Time each stage of the uplink path and log a summary every this many seconds, '
+                             '0 to disable; SIGUSR1 then runs cProfile and SIGUSR2 tracemalloc for a while')
+    parser.add_argument('--profile-allocations',
+                        required=False,
+                        action='store_true',
+                        help='Count the memory blocks allocated by each stage too')
+    parser.add_argument('--profile-seconds',
+                        required=False,
+                        type=float,
+                        default=30.0,
+                        help='How long SIGUSR1 and SIGUSR2 sample for')
+    parser.add_argument('--profile-dir',
+                        required=False,
+                        default='.',
+                        help='Directory of the cProfile statistics files')
+
+
+def add_filter_arguments(parser: argparse.ArgumentParser):
+    """Options of uplink_dedup.UplinkDeduplicator and value_filter.DeadbandFilter"""
+    parser.add_argument('--dedup-window',
+                        required=False,
+                        type=float,
+                        default=2.0,
+                        help='Drop copies of an uplink received again within this many seconds, 0 to disable')
+    parser.add_argument('--deadband',
+                        required=False,
+                        type=float,
+                        default=0.0,
+                        help='Only report values that moved by more than this absolute amount')
+    parser.add_argument('--deadband-percent',
+                        required=False,
+                        type=float,
+                        default=0.0,
+                        help='Only report values that moved by more than this percentage')
+    parser.add_argument('--max-silence',
+                        required=False,
+                        type=float,
+                        default=0.0,
+                        help='Report a filtered value anyway after this many seconds')
+
+
+def add_pipeline_arguments(parser: argparse.ArgumentParser):
+    """Options of uplink_pipeline.UplinkPipeline and of the uplink capture, see setup_pipeline()"""
+    from uplink_pipeline import OVERFLOW_POLICIES
+    parser.add_argument('--workers',
+                        required=False,
+                        type=int,
+                        default=1,
+                        help='Uplink decoding threads, at least --processes with a process pool')
+    parser.add_argument('--processes',
+                        required=False,
+                        type=int,
+                        default=0,
+                        help='Decode uplinks in a pool of this many processes, 0 decodes in the worker threads')
+    parser.add_argument('--queue-size',
+                        required=False,
+                        type=int,
+                        default=10000,
+                        help='Maximum uplinks waiting to be decoded')
+    parser.add_argument('--overflow',
+                        required=False,
+                        choices=OVERFLOW_POLICIES,
+                        default='drop-oldest',
+                        help='What to do with a new uplink when the queue is full: block also holds back the '
+                             'answers to requests and the connection callbacks, which may then time out')
+    parser.add_argument('--stats-interval',
+                        required=False,
+                        type=float,
+                        help='Log uplink queue statistics every this many seconds')
+    parser.add_argument('--capture',
+                        required=False,
+                        help='Append every raw uplink to this capture file, see uplink_replay.py')
+
+
+def add_output_arguments(parser: argparse.ArgumentParser):
+    """Options of series_store.SeriesStore and republisher.Republisher, see setup_outputs()"""
+    parser.add_argument('--history',
+                        required=False,
+                        type=int,
+                        default=0,
+                        help='Keep this many samples of every node and register in memory, 0 to disable')
+    parser.add_argument('--history-file',
+                        required=False,
+                        help='Keep the history in this memory-mapped file so that it survives restarts')
+    parser.add_argument('--history-nodes',
+                        required=False,
+                        type=int,
+                        help='Maximum nodes kept in the history, the inventory size by default')
+    parser.add_argument('--publish-topic',
+                        required=False,
+                        help='Republish decoded readings in batches to this MQTT topic on the same broker')
+    parser.add_argument('--publish-file',
+                        required=False,
+                        help='Append decoded readings in batches to this rotating JSON lines file')
+    parser.add_argument('--publish-batch',
+                        required=False,
+                        type=int,
+                        default=500,
+                        help='Maximum readings per published batch')
+    parser.add_argument('--publish-delay',
+                        required=False,
+                        type=float,
+                        default=5.0,
+                        help='Maximum seconds a reading waits for its batch')
+    parser.add_argument('--publish-buffer',
+                        required=False,
+                        type=int,
+                        default=100000,
+                        help='Maximum buffered readings, the oldest are dropped beyond')
+    parser.add_argument('--publish-columnar',
+                        required=False,
+                        action='store_true',
+                        help='Publish each batch as columns instead of an array of readings')
+
+
+def add_metrics_arguments(parser: argparse.ArgumentParser):
+    """Options of request_tracker.MetricsExporter"""
+    parser.add_argument('--metrics-file',
+                        required=False,
+                        help='Write Prometheus metrics to this file')
+    parser.add_argument('--metrics-port',
+                        required=False,
+                        type=int,
+                        help='Serve Prometheus metrics over HTTP on this port')
+
+
+class Outputs(NamedTuple):
+    # Each is None unless its options asked for it
+    profiler: Optional[Any]
+    value_filter: Optional[Any]
+    history: Optional[Any]
+    republisher: Optional[Any]
+
+
+def setup_outputs(parser: argparse.ArgumentParser,
+                  args: argparse.Namespace,
+                  runtime,
+                  names: list[str],
+                  nodes: int) -> Outputs:
+    """
+    Create the stage profiler, deadband filter, history of nodes (up to
+    nodes by default) and republisher asked for by the profiling, filter
+    and output options, all stopped by runtime on shutdown. The options a
+    parser does not have are left out.
+    """
+    from profiling import StageProfiler
+    from value_filter import DeadbandFilter
+    from series_store import SeriesStore
+    from republisher import JsonLinesSink, MqttSink, Republisher
+
+    profiler = value_filter = history = republisher = None
+    if args.profile_interval > 0:
+        profiler = StageProfiler(args.profile_interval, args.profile_allocations, args.profile_seconds,
+                                 args.profile_dir)
+        profiler.install_signal_handlers()
+        profiler.start()
+        runtime.on_shutdown(profiler.stop)
+
+    if args.deadband > 0 or args.deadband_percent > 0 or args.max_silence > 0:
+        value_filter = DeadbandFilter(names, args.deadband, args.deadband_percent, args.max_silence)
+        runtime.on_shutdown(lambda: logging.info("Reported %d of %d values", value_filter.emitted, value_filter.received))
+
+    if getattr(args, 'history', 0) > 0:
+        try:
+            history = SeriesStore(names, args.history, args.history_nodes or nodes, args.history_file)
+        except ValueError as e:
+            runtime.shutdown()
+            parser.error(str(e))
+        runtime.on_shutdown(history.close)
+        runtime.on_shutdown(lambda: logging.info("History dropped %d out of order samples", history.out_of_order))
+        logging.info("History of %d samples per series uses %d bytes", args.history, history.memory)
+
+    if getattr(args, 'publish_topic', None) is not None or getattr(args, 'publish_file', None) is not None:
+        if args.publish_topic is not None:
+            sink = MqttSink.connect(args.host, args.port, args.username, args.password, args.publish_topic,
+                                    insecure=args.insecure)
+        else:
+            sink = JsonLinesSink(args.publish_file)
+        republisher = Republisher(sink, args.publish_batch, args.publish_delay, args.publish_buffer,
+                                  args.publish_columnar)
+        republisher.start()
+        runtime.on_shutdown(republisher.stop)
+    return Outputs(profiler, value_filter, history, republisher)
+
+
+def setup_pipeline(parser: argparse.ArgumentParser,
+                   args: argparse.Namespace,
+                   runtime,
+                   handler: Callable,
+                   profiler=None,
+                   keep: Optional[Callable] = None) -> Callable:
+    """
+    Start an UplinkPipeline calling handler(raw, uplink) and return the
+    uplink callback feeding it, which records every uplink to the capture
+    and drops copies within the dedup window first, except the uplinks for
+    which keep(data) is True
+    """
+    from uplink_pipeline import UplinkPipeline
+    from uplink_capture import CaptureWriter
+    from uplink_dedup import UplinkDeduplicator
+
+    pipeline = UplinkPipeline(handler, args.queue_size, args.workers, args.processes,
+                              overflow=args.overflow, stats_interval=args.stats_interval, profiler=profiler)
+    pipeline.start()
+    runtime.on_shutdown(pipeline.stop)
+
+    capture = None
+    if args.capture is not None:
+        try:
+            capture = CaptureWriter(args.capture)
+        except ValueError as e:
+            runtime.shutdown()
+            parser.error(str(e))
+        if capture.truncated:
+            logging.warning("Cut off %d bytes of a torn record at the end of %s", capture.truncated, args.capture)
+        runtime.on_shutdown(capture.close)
+
+    deduplicator = None
+    if args.dedup_window > 0:
+        deduplicator = UplinkDeduplicator(args.dedup_window)
+        runtime.on_shutdown(deduplicator.log_summary)
+
+    def on_uplink(data):
+        # The capture keeps the copies, replaying it shows what the mesh delivered
+        if capture is not None:
+            capture.record(data)
+        if deduplicator is not None and not (keep is not None and keep(data)) and deduplicator.is_duplicate(data):
+            return
+        pipeline.enqueue(data)
+    return on_uplink
@@ -1,18 +1,31 @@
 import argparse
-import json
+import sys
 import string
 import logging
-from wirepas_mqtt_library import WirepasNetworkInterface
 import wirepas_mesh_messaging as wmm
-import mbproto.mb_protocol_pb2 as mb_protocol
 from mbproto.mb_protocol_iface import MBProto
-from google.protobuf.json_format import MessageToJson
-from pymodbus.client import ModbusFrameGenerator
-from pymodbus.framer import FramerType
+from uplink_decoder import UplinkDecoder
+from request_tracker import request_key, uplink_key
+from runtime import Runtime
+from cli_options import add_connection_arguments, connect
+
+decoder = UplinkDecoder()
+runtime = Runtime()
+# Key of the command sent, only its answer ends the run
+expected_key = None
 
 def on_uplink_data_transmitted(data):
+    try:
+        _key = uplink_key(data.gw_id, data.sink_id, data.source_address, decoder.decode(data.data_payload))
+    except ValueError as e:
+        logging.error("Failed to decode uplink: %s", e)
+        return
+    if _key != expected_key:
+        # Periodic reports, other nodes and answers to other requests
+        return
     _mbproto = MBProto()
     _mbproto.print_decoded_msg(data.data_payload)
+    runtime.response_received()
 
 
 def regs_type(value):
@@ -22,30 +35,9 @@ def regs_type(value):
         raise argparse.ArgumentTypeError("Regs must contain only ASCII letters and digits")
     return value
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
-    parser.add_argument('--host',
-                        required=True,
-                        help="MQTT broker address")
-    parser.add_argument('--port',
-                        required=False,
-                        default=8883,
-                        type=int,
-                        help="MQTT broker port")
-    parser.add_argument('--username', 
-                        required=False,
-                        default='mqttmasteruser',
-                        help="MQTT broker username")
-    parser.add_argument('--password',
-                        required=True,
-                        help="MQTT broker password")
-    parser.add_argument('--insecure',
-                        required=False,
-                        dest='insecure',
-                        action='store_true',
-                        help="MQTT use unsecured connection")
+def add_arguments(parser: argparse.ArgumentParser):
     parser.add_argument('--gw',
-                        required=True,
+                        required=False,
                         help="GW ID")
     parser.add_argument('--sink',
                         required=False,
@@ -66,7 +58,7 @@ if __name__ == "__main__":
                         choices=[1, 2],
                         help='Target port: 1 - Port 1, 2 - Port 2')
     parser.add_argument('--cmd',
-                        required=True,
+                        required=False,
                         type=str,
                         choices=['reset', 'diag', 'dev_mode', 'ant_cfg', 'port_cfg'],
                         help='Command Types')
@@ -84,16 +76,58 @@ if __name__ == "__main__":
                         required=False,
                         nargs=3,
                         help='Port Serial configuration: <baudrate> <parity (0 - none, 1 - odd, 2 - even)> <stop_bits (1 or 2)>')
+    parser.add_argument('--timeout',
+                        required=False,
+                        type=float,
+                        help='Seconds to wait for the answer, by default wait until interrupted')
+    parser.add_argument('--desired-state',
+                        required=False,
+                        help='Bulk mode: CSV file of gateway,sink,node,dev_mode,ant_cfg,port1_baud,port1_parity,'
+                             'port1_stop_bits,port2_baud,port2_parity,port2_stop_bits; only the settings that '
+                             'differ from the diagnostics of each node are sent')
+    parser.add_argument('--window',
+                        required=False,
+                        type=int,
+                        default=8,
+                        help='Bulk mode: nodes configured in parallel per gateway')
+    parser.add_argument('--retries',
+                        required=False,
+                        type=int,
+                        default=2,
+                        help='Bulk mode: retries of an unanswered request')
 
-    args = parser.parse_args()
-
+def main(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    global expected_key
     logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
 
-    wni = WirepasNetworkInterface(args.host,
-                                  args.port,
-                                  args.username,
-                                  args.password,
-                                  insecure=args.insecure)
+    if args.desired_state is None and (args.gw is None or args.cmd is None):
+        parser.error("Both --gw and --cmd are required without --desired-state")
+    states = None
+    if args.desired_state is not None:
+        # Only bulk mode needs asyncio and the async client, one-shot commands start faster without them
+        import asyncio
+        from fleet_config import configure_fleet, load_desired_state, log_report
+        try:
+            states = load_desired_state(args.desired_state)
+        except ValueError as e:
+            parser.error(str(e))
+
+    wni = connect(args)
+    runtime.wni = wni
+
+    if states is not None:
+        reports = None
+        try:
+            reports = asyncio.run(configure_fleet(wni, states, args.window, args.retries,
+                                                  args.timeout if args.timeout is not None else 30.0))
+        except KeyboardInterrupt:
+            logging.info("Interrupted, exiting")
+        finally:
+            runtime.shutdown()
+        if reports is None:
+            sys.exit(1)
+        log_report(reports)
+        sys.exit(0 if all(report.status != "failed" for report in reports) else 1)
     
     # Register a callback for uplink traffic
     wni.register_uplink_traffic_cb(on_uplink_data_transmitted, gateway=args.gw, sink=args.sink, src_ep = 66, dst_ep = 77)
@@ -126,16 +160,20 @@ if __name__ == "__main__":
             parser.error(e)
         payload_coded = mbproto.create_port_config()
 
+    expected_key = request_key(args.gw, args.sink, args.node, payload_coded)
+    runtime.expect(1)
     try:
         res = wni.send_message(args.gw, args.sink, args.node, 77, 66, payload_coded)
         if res != wmm.GatewayResultCode.GW_RES_OK:
-            print("Cannot send data to %s:%s res=%s" % (args.gw, args.sink, res))
+            logging.error("Cannot send data to %s:%s res=%s", args.gw, args.sink, res)
     except TimeoutError:
-        print("Cannot send data to %s:%s", args.gw, args.sink)
+        logging.error("Cannot send data to %s:%s", args.gw, args.sink)
 
-    logging.info("Entering infinite polling, press Ctrl+C to exit")
-    try:
-        while True:
-            pass
-    except KeyboardInterrupt:
-        print("Loop interrupted by user.")
\ No newline at end of file
+    logging.info("Waiting for the answer, press Ctrl+C to exit")
+    runtime.run(args.timeout)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_connection_arguments(parser)
+    add_arguments(parser)
+    main(parser, parser.parse_args())
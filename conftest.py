@@ -0,0 +1 @@
+# Makes the top-level modules and the benchmarks package importable from tests/ under plain pytest
@@ -0,0 +1,320 @@
+import hashlib
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Callable, NamedTuple, Optional
+import mbproto.mb_protocol_pb2 as mb_protocol
+import wirepas_mesh_messaging as wmm
+from google.protobuf.message import DecodeError
+
+# Pending requests kept per node for replay, the oldest are forgotten beyond
+MAX_PENDING_PER_NODE = 64
+
+
+class _PendingRequest(NamedTuple):
+    sent: float
+    gw_id: str
+    sink_id: str
+    dest: int
+    src_ep: int
+    dst_ep: int
+    payload: bytes
+
+
+class SharedConnection():
+    """
+    One WirepasNetworkInterface shared by every user of a broker.
+
+    It stands in for the interface: a single uplink callback for the WMB
+    endpoints dispatches each uplink through a dict index on (gateway, sink,
+    node), where None matches anything, instead of every registered callback
+    filtering every uplink. register_uplink_traffic_cb() also takes a node.
+    Registrations on other endpoints or on a network go to the interface.
+
+    Requests sent to the WMB endpoints are kept until an uplink comes from
+    their node, which answers the oldest one. Only the command of uplinks
+    from nodes with requests kept is decoded, periodic reports do not
+    answer a request. When the broker connection comes back after a drop, the requests sent
+    less than replay_window seconds before the drop are sent again, since
+    their answers were published while nobody was subscribed. If the
+    connection stays down for recreate_after seconds, the interface is
+    replaced by a new one. Other methods are forwarded to the current
+    interface.
+    """
+
+    def __init__(self, factory: Callable, replay: bool = True, replay_window: float = 30.0,
+                 recreate_after: float = 120.0):
+        # factory(connection_cb) creates the WirepasNetworkInterface
+        self.factory = factory
+        self.replay = replay
+        self.replay_window = replay_window
+        self.recreate_after = recreate_after
+        self.replayed = 0
+        self.users = 0
+        self._index: dict[tuple, dict[int, Callable]] = {}
+        self._passthrough: dict[int, tuple] = {}
+        self._ids = itertools.count()
+        self._pending: dict[tuple[str, str, int], deque[_PendingRequest]] = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._connected_once = False
+        self._disconnected_since: Optional[float] = None
+        self._stop_event = threading.Event()
+        self._wni = None
+        self._open()
+        self._watchdog = threading.Thread(target=self._watch, name="connection-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def _open(self):
+        self._wni = self.factory(self._on_connection)
+        self._wni.register_uplink_traffic_cb(self._dispatch, src_ep=66, dst_ep=77)
+        with self._lock:
+            for cb_id, (args, kwargs, _) in list(self._passthrough.items()):
+                self._passthrough[cb_id] = (args, kwargs, self._wni.register_uplink_traffic_cb(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._wni, name)
+
+    def register_uplink_traffic_cb(self, cb, gateway=None, sink=None, network=None, src_ep=None, dst_ep=None,
+                                   node=None) -> int:
+        with self._lock:
+            cb_id = next(self._ids)
+            if network is not None or src_ep not in (None, 66) or dst_ep not in (None, 77):
+                kwargs = dict(gateway=gateway, sink=sink, network=network, src_ep=src_ep, dst_ep=dst_ep)
+                self._passthrough[cb_id] = ((cb,), kwargs, self._wni.register_uplink_traffic_cb(cb, **kwargs))
+            else:
+                self._index.setdefault((gateway, sink, None if node is None else int(node)), {})[cb_id] = cb
+            return cb_id
+
+    def unregister_uplink_traffic_cb(self, cb_id: int):
+        with self._lock:
+            entry = self._passthrough.pop(cb_id, None)
+            if entry is not None:
+                self._wni.unregister_uplink_traffic_cb(entry[2])
+                return
+            for key, callbacks in self._index.items():
+                if callbacks.pop(cb_id, None) is not None:
+                    if not callbacks:
+                        del self._index[key]
+                    return
+        raise KeyError(cb_id)
+
+    def _dispatch(self, data):
+        gw_id = data.gw_id
+        sink_id = data.sink_id
+        node = data.source_address
+        if self._pending:
+            self._answered((gw_id, sink_id, node), data.data_payload)
+        index = self._index
+        # Every registration matching the uplink, None standing for any gateway, sink or node
+        for key in ((gw_id, sink_id, node), (gw_id, sink_id, None), (gw_id, None, node), (gw_id, None, None),
+                    (None, sink_id, node), (None, sink_id, None), (None, None, node), (None, None, None)):
+            callbacks = index.get(key)
+            if callbacks:
+                for cb in list(callbacks.values()):
+                    try:
+                        cb(data)
+                    except Exception:
+                        logging.exception("Uplink callback failed")
+
+    def _answered(self, node_key: tuple[str, str, int], payload: bytes):
+        # Runs on the dispatch thread for every uplink: nodes without requests take no lock and no decoding
+        if node_key not in self._pending or not _is_answer(payload):
+            return
+        with self._lock:
+            pending = self._pending.get(node_key)
+            if pending:
+                pending.popleft()
+            if not pending:
+                self._pending.pop(node_key, None)
+
+    def send_message(self, gw_id, sink_id, dest, src_ep, dst_ep, payload, qos=0, csma_ca_only=False, hop_limit=0,
+                     cb=None, param=None):
+        request = None
+        if (src_ep, dst_ep) == (77, 66):
+            now = time.monotonic()
+            request = _PendingRequest(now, gw_id, sink_id, int(dest), src_ep, dst_ep, payload)
+            with self._lock:
+                pending = self._pending[(gw_id, sink_id, int(dest))]
+                while pending and (len(pending) >= MAX_PENDING_PER_NODE or pending[0].sent < now - self.replay_window):
+                    pending.popleft()
+                # Queued before sending, the answer may come back before send_message returns
+                pending.append(request)
+            if cb is not None:
+                user_cb = cb
+
+                def cb(gw_error_code, param):
+                    if gw_error_code != wmm.GatewayResultCode.GW_RES_OK:
+                        self._forget(request)
+                    user_cb(gw_error_code, param)
+        try:
+            res = self._wni.send_message(gw_id, sink_id, dest, src_ep, dst_ep, payload, qos=qos,
+                                         csma_ca_only=csma_ca_only, hop_limit=hop_limit, cb=cb, param=param)
+        except Exception:
+            self._forget(request)
+            raise
+        if cb is None and res != wmm.GatewayResultCode.GW_RES_OK:
+            self._forget(request)
+        return res
+
+    def _forget(self, request: Optional[_PendingRequest]):
+        if request is None:
+            return
+        node_key = (request.gw_id, request.sink_id, request.dest)
+        with self._lock:
+            pending = self._pending.get(node_key)
+            if pending and request in pending:
+                pending.remove(request)
+                if not pending:
+                    del self._pending[node_key]
+
+    def _on_connection(self, connected: bool, error_code):
+        # Called from the interface's worker thread, which also dispatches uplinks: do not block it
+        if not connected:
+            if self._disconnected_since is None:
+                logging.warning("Broker connection lost: %s", error_code)
+                self._disconnected_since = time.monotonic()
+            return
+        disconnected_since = self._disconnected_since
+        self._disconnected_since = None
+        if not self._connected_once:
+            self._connected_once = True
+            return
+        logging.info("Broker connection back%s", " after %.1fs" % (time.monotonic() - disconnected_since)
+                     if disconnected_since is not None else "")
+        if self.replay and disconnected_since is not None:
+            threading.Thread(target=self._replay, args=(disconnected_since,), name="connection-replay",
+                             daemon=True).start()
+
+    def _replay(self, disconnected_since: float):
+        since = disconnected_since - self.replay_window
+        with self._lock:
+            requests = [request for pending in self._pending.values() for request in pending
+                        if request.sent >= since]
+            self._pending.clear()
+        requests.sort(key=lambda request: request.sent)
+        if requests:
+            logging.info("Replaying %d unanswered request(s)", len(requests))
+        for request in requests:
+            try:
+                res = self.send_message(request.gw_id, request.sink_id, request.dest, request.src_ep,
+                                        request.dst_ep, request.payload)
+                if res != wmm.GatewayResultCode.GW_RES_OK:
+                    logging.warning("Cannot replay request to %s:%s node %s res=%s", request.gw_id,
+                                    request.sink_id, request.dest, res)
+                else:
+                    self.replayed += 1
+            except TimeoutError:
+                logging.warning("Cannot replay request to %s:%s node %s", request.gw_id, request.sink_id,
+                                request.dest)
+
+    def _watch(self):
+        while not self._stop_event.wait(1.0):
+            since = self._disconnected_since
+            if since is None or time.monotonic() - since < self.recreate_after:
+                continue
+            logging.warning("No broker connection for %.0fs, connecting again from scratch",
+                            time.monotonic() - since)
+            old = self._wni
+            # Still disconnected: the new interface replays the requests once it connects
+            self._disconnected_since = time.monotonic()
+            try:
+                old.close()
+            except Exception as e:
+                logging.error("Failed to close the broker connection: %s", e)
+            self._open()
+
+    def close(self):
+        """Really close the interface, see ConnectionManager.release() for shared use"""
+        self._stop_event.set()
+        self._watchdog.join()
+        self._wni.close()
+
+
+def _is_answer(payload: bytes) -> bool:
+    """False for periodic reports and payloads that are not MBProto messages"""
+    msg = mb_protocol.MbMessage()
+    try:
+        msg.ParseFromString(payload[:-2])
+    except DecodeError:
+        return False
+    answer = msg.payload.payload_answer_frame
+    if answer.WhichOneof("answer_frame") != "modbus_response_frame":
+        # Including the ACK to a periodic configuration
+        return True
+    return msg.cmd != mb_protocol.Cmd.CMD_MODBUS_PERIODICAL and answer.modbus_response_frame.configuration_index == 0
+
+
+class ConnectionManager():
+    """
+    Hands out one SharedConnection per broker and credentials, and closes
+    it when the last user releases it. Users of one connection must agree
+    on replay.
+    """
+
+    def __init__(self, factory: Optional[Callable] = None):
+        # factory(host, port, username, password, insecure, connection_cb) creates a WirepasNetworkInterface
+        self.factory = factory or self._interface
+        self._connections: dict[tuple, SharedConnection] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _interface(host, port, username, password, insecure, connection_cb):
+        # Imported here so that argument errors and --help do not pay for it
+        from wirepas_mqtt_library import WirepasNetworkInterface
+        return WirepasNetworkInterface(host, port, username, password, insecure=insecure, connection_cb=connection_cb)
+
+    def connect(self, host: str, port: int, username: str, password: str, insecure: bool = False,
+                replay: bool = True) -> "_Lease":
+        # Only a digest of the password is kept in the key
+        digest = hashlib.sha256((password or "").encode()).hexdigest()
+        key = (host, int(port), username, digest, insecure)
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is None:
+                connection = self._connections[key] = SharedConnection(
+                    lambda cb: self.factory(host, port, username, password, insecure, cb), replay)
+            elif connection.replay != replay:
+                raise ValueError("Connection to %s:%s is already open with replay %s" %
+                                 (host, port, "enabled" if connection.replay else "disabled"))
+            connection.users += 1
+        return _Lease(self, key, connection)
+
+    def release(self, key: tuple):
+        with self._lock:
+            connection = self._connections[key]
+            connection.users -= 1
+            if connection.users:
+                return
+            del self._connections[key]
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+
+class _Lease():
+    """A user's handle on a SharedConnection: close() releases it instead of closing the interface"""
+
+    def __init__(self, manager: ConnectionManager, key: tuple, connection: SharedConnection):
+        self._manager = manager
+        self._key = key
+        self._connection = connection
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._manager.release(self._key)
+
+
+# Shared by the examples running in one process
+default_manager = ConnectionManager()
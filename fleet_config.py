@@ -0,0 +1,154 @@
+import asyncio
+import csv
+import logging
+from typing import NamedTuple, Optional
+import mbproto.mb_protocol_answers_pb2 as mb_answers
+from mbproto.mb_protocol_iface import MBProto
+from async_client import AsyncWmbClient, GatewayError
+from uplink_decoder import Uplink
+
+
+class DesiredState(NamedTuple):
+    gateway: str
+    sink: str
+    node: int
+    # Same values as the configuration_mqtt.py arguments, None leaves the setting alone
+    dev_mode: Optional[int] = None
+    ant_cfg: Optional[int] = None
+    # (baudrate, parity, stop bits) of port 1 and port 2
+    port1: Optional[tuple[int, int, int]] = None
+    port2: Optional[tuple[int, int, int]] = None
+
+
+class NodeReport(NamedTuple):
+    state: DesiredState
+    # 'unchanged', 'updated' or 'failed'
+    status: str
+    changed: list[str]
+    errors: list[str]
+
+
+def _optional_int(row: dict, name: str) -> Optional[int]:
+    value = (row.get(name) or '').strip()
+    return int(value) if value else None
+
+
+def load_desired_state(path: str) -> list[DesiredState]:
+    """
+    Load the desired configuration of a fleet from a CSV file with the header
+    gateway,sink,node,dev_mode,ant_cfg,port1_baud,port1_parity,port1_stop_bits,
+    port2_baud,port2_parity,port2_stop_bits. Empty cells leave a setting
+    alone and lines starting with '#' are ignored. Every row is checked
+    before anything is sent: an invalid one raises ValueError with its line
+    number.
+    """
+    states = []
+    with open(path, newline='') as f:
+        lines = [(number, line) for number, line in enumerate(f, start=1)
+                 if line.strip() and not line.lstrip().startswith('#')]
+    rows = csv.DictReader(line for _, line in lines)
+    for row in rows:
+        number = lines[rows.line_num - 1][0]
+        try:
+            ports = []
+            for port in (1, 2):
+                values = [_optional_int(row, "port%d_%s" % (port, name)) for name in ('baud', 'parity', 'stop_bits')]
+                if any(value is None for value in values):
+                    if any(value is not None for value in values):
+                        raise ValueError("Port %d needs baud, parity and stop bits" % port)
+                    ports.append(None)
+                else:
+                    ports.append(tuple(values))
+            state = DesiredState(row['gateway'].strip(),
+                                 row['sink'].strip(),
+                                 int(row['node']),
+                                 _optional_int(row, 'dev_mode'),
+                                 _optional_int(row, 'ant_cfg'),
+                                 *ports)
+            # Goes through the MBProto setters, which reject unsupported values
+            config_commands(state, mb_answers.DiagnosticsAnsFrame())
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ValueError("Line %d: %s" % (number, str(e) or "missing column"))
+        states.append(state)
+    return states
+
+
+def config_commands(state: DesiredState, diagnostics: mb_answers.DiagnosticsAnsFrame) -> list[tuple[str, bytes]]:
+    """Return the (name, payload) commands needed to move a node from its diagnostics to state"""
+    commands = []
+    mbproto = MBProto()
+    if state.dev_mode is not None:
+        mbproto.device_mode = state.dev_mode
+        if diagnostics.device_mode != mbproto.device_mode:
+            commands.append(("dev_mode", mbproto.create_device_mode()))
+    if state.ant_cfg is not None:
+        mbproto.antenna_config = state.ant_cfg
+        if diagnostics.antenna_settings != mbproto.antenna_config:
+            commands.append(("ant_cfg", mbproto.create_antenna_config()))
+    for port, config in ((1, state.port1), (2, state.port2)):
+        if config is None:
+            continue
+        mbproto.target_port = port
+        mbproto.baudrate_config, mbproto.parity_bit, mbproto.stop_bits = config
+        current = (getattr(diagnostics, "baud_port_%d" % (port - 1)),
+                   getattr(diagnostics, "parity_port_%d" % (port - 1)),
+                   getattr(diagnostics, "stop_bits_port_%d" % (port - 1)))
+        if current != (mbproto.baudrate_config, mbproto.parity_bit, mbproto.stop_bits):
+            commands.append(("port_cfg %d" % port, mbproto.create_port_config()))
+    return commands
+
+
+async def _request(client: AsyncWmbClient, state: DesiredState, payload: bytes, retries: int) -> Uplink:
+    for attempt in range(retries + 1):
+        try:
+            return await client.request(state.gateway, state.sink, state.node, payload)
+        except (TimeoutError, GatewayError) as e:
+            error = e
+            logging.warning("%s:%s node %s: attempt %d failed: %s", state.gateway, state.sink, state.node,
+                            attempt + 1, str(e) or "no answer")
+    raise error
+
+
+async def configure_node(client: AsyncWmbClient, state: DesiredState, window: asyncio.Semaphore,
+                         retries: int) -> NodeReport:
+    """Query the node's diagnostics, then send the commands that differ one at a time"""
+    async with window:
+        try:
+            uplink = await _request(client, state, MBProto().create_diagnostics(), retries)
+        except (TimeoutError, GatewayError) as e:
+            return NodeReport(state, "failed", [], ["diagnostics: %s" % (str(e) or "no answer")])
+        if uplink.diagnostics is None:
+            return NodeReport(state, "failed", [], ["diagnostics: unexpected answer"])
+        changed = []
+        errors = []
+        for name, payload in config_commands(state, uplink.diagnostics):
+            try:
+                uplink = await _request(client, state, payload, retries)
+            except (TimeoutError, GatewayError) as e:
+                errors.append("%s: %s" % (name, str(e) or "no answer"))
+                continue
+            if uplink.ack == mb_answers.Acknowladge.ACKNOWLADGE_ACK:
+                changed.append(name)
+            else:
+                errors.append("%s: NACK" % name)
+    return NodeReport(state, "failed" if errors else "updated" if changed else "unchanged", changed, errors)
+
+
+async def configure_fleet(wni, states: list[DesiredState], window: int = 8, retries: int = 2,
+                          timeout: float = 30.0) -> list[NodeReport]:
+    """Configure every node, with up to window nodes in progress per gateway"""
+    windows = {state.gateway: asyncio.Semaphore(window) for state in states}
+    async with AsyncWmbClient(wni, window * len(windows), timeout) as client:
+        return await asyncio.gather(*(configure_node(client, state, windows[state.gateway], retries)
+                                      for state in states))
+
+
+def log_report(reports: list[NodeReport]):
+    for report in sorted(reports, key=lambda r: (r.state.gateway, r.state.sink, r.state.node)):
+        state = report.state
+        log = logging.error if report.status == "failed" else logging.info
+        log("%s:%s node %s: %s%s%s", state.gateway, state.sink, state.node, report.status,
+            " " + ", ".join(report.changed) if report.changed else "",
+            ", failed " + "; ".join(report.errors) if report.errors else "")
+    counts = {status: sum(r.status == status for r in reports) for status in ("unchanged", "updated", "failed")}
+    logging.info("%d nodes: %d unchanged, %d updated, %d failed", len(reports), *counts.values())
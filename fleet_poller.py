@@ -0,0 +1,359 @@
+import csv
+import heapq
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, NamedTuple, Optional
+import wirepas_mesh_messaging as wmm
+from request_tracker import RequestTracker, request_key
+
+# Longest wait before an entry whose sink window was full is tried again
+WINDOW_RETRY = 0.05
+
+
+class FleetEntry(NamedTuple):
+    gateway: str
+    sink: str
+    node: int
+    modbus_addr: int = 1
+    target_port: int = 1
+
+
+def load_inventory(path: str) -> list[FleetEntry]:
+    """
+    Load a fleet inventory from a CSV file with the header
+    gateway,sink,node,modbus_addr,target_port (the last two are optional).
+    Lines starting with '#' are ignored.
+    """
+    inventory = []
+    with open(path, newline='') as f:
+        rows = csv.DictReader(line for line in f if line.strip() and not line.lstrip().startswith('#'))
+        for row in rows:
+            inventory.append(FleetEntry(row['gateway'].strip(),
+                                        row['sink'].strip(),
+                                        int(row['node']),
+                                        int(row.get('modbus_addr') or 1),
+                                        int(row.get('target_port') or 1)))
+    return inventory
+
+
+class SinkWindow():
+    """Bounds the number of requests waiting for an answer on one sink"""
+
+    def __init__(self, size: int, answer_timeout: float):
+        self.size = size
+        self.answer_timeout = answer_timeout
+        self._in_flight: dict[int, float] = {}
+        self._lock = threading.Lock()
+        # Requests dropped from the window without an answer
+        self.timeouts = 0
+
+    def _expire(self, now: float):
+        for node, sent in list(self._in_flight.items()):
+            if now - sent > self.answer_timeout:
+                del self._in_flight[node]
+                self.timeouts += 1
+                logging.warning("No answer from node %s within %.1fs", node, self.answer_timeout)
+
+    def try_acquire(self, node: int) -> Optional[float]:
+        """Take a slot for node without waiting: None once taken, else seconds until the oldest request expires"""
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if len(self._in_flight) < self.size and node not in self._in_flight:
+                self._in_flight[node] = now
+                return None
+            oldest = min(self._in_flight.values())
+            return max(0.0, oldest + self.answer_timeout - now) + 0.01
+
+    def release(self, node: int):
+        with self._lock:
+            self._in_flight.pop(node, None)
+
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._in_flight)
+
+
+class FleetPoller():
+    """
+    Polls a fleet of nodes every period from a single process.
+
+    Each gateway gets its own sender thread so that the blocking
+    send_message calls to different gateways run concurrently. Within a
+    gateway, the nodes of every sink are spread evenly across the period
+    and a SinkWindow limits how many requests a sink has in flight. A node
+    whose sink window is full is tried again shortly after instead of
+    holding up the other sinks of the gateway.
+    """
+
+    def __init__(self,
+                 wni,
+                 inventory: list[FleetEntry],
+                 payload_factory: Callable[[FleetEntry], bytes],
+                 period: float,
+                 window: int = 4,
+                 answer_timeout: float = 10.0,
+                 tracker: Optional[RequestTracker] = None):
+        self.wni = wni
+        self.period = period
+        self.tracker = tracker
+        self._payloads = {entry: payload_factory(entry) for entry in inventory}
+        self._keys = {entry: request_key(entry.gateway, entry.sink, entry.node, payload)
+                      for entry, payload in self._payloads.items()}
+        self._by_gateway: dict[str, list[FleetEntry]] = defaultdict(list)
+        for entry in inventory:
+            self._by_gateway[entry.gateway].append(entry)
+        self._windows = {(entry.gateway, entry.sink): SinkWindow(window, answer_timeout) for entry in inventory}
+        self._stop_event = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._cb_ids = []
+
+    def schedule(self, entries: list[FleetEntry]) -> list[tuple[float, FleetEntry]]:
+        """Return (offset in period, entry) pairs spreading each sink's nodes evenly"""
+        by_sink: dict[str, list[FleetEntry]] = defaultdict(list)
+        for entry in entries:
+            by_sink[entry.sink].append(entry)
+        schedule = []
+        for k, sink_entries in enumerate(by_sink.values()):
+            step = self.period / len(sink_entries)
+            # Shift each sink so sinks of one gateway do not fire together
+            phase = k * self.period / len(entries)
+            schedule.extend((phase + j * step, entry) for j, entry in enumerate(sink_entries))
+        schedule.sort(key=lambda item: item[0])
+        return schedule
+
+    def register_uplink_cb(self, cb: Callable):
+        """Register cb for uplinks of every polled sink, freeing window slots on answers"""
+        def on_uplink(data):
+            window = self._windows.get((data.gw_id, data.sink_id))
+            if window is not None:
+                window.release(data.source_address)
+            cb(data)
+
+        for gateway, sink in self._windows:
+            self._cb_ids.append(self.wni.register_uplink_traffic_cb(on_uplink, gateway=gateway, sink=sink, src_ep=66, dst_ep=77))
+
+    def start(self):
+        for gateway, entries in self._by_gateway.items():
+            thread = threading.Thread(target=self._run_gateway, args=(entries,), name="poll-%s" % gateway, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+        for cb_id in self._cb_ids:
+            self.wni.unregister_uplink_traffic_cb(cb_id)
+        self._cb_ids.clear()
+
+    def _run_gateway(self, entries: list[FleetEntry]):
+        start = time.monotonic()
+        # (due, sequence, slot in the schedule, entry), due is later than the slot while the sink window is full
+        queue = [(start + offset, i, start + offset, entry) for i, (offset, entry) in enumerate(self.schedule(entries))]
+        heapq.heapify(queue)
+        sequence = len(queue)
+        while True:
+            due, _, slot, entry = queue[0]
+            if self._stop_event.wait(max(0.0, due - time.monotonic())):
+                return
+            window = self._windows[(entry.gateway, entry.sink)]
+            wait = window.try_acquire(entry.node)
+            if wait is None:
+                self._poll(entry)
+                # Keep the slot in the period even when the request went out late
+                slot += self.period
+                due = max(slot, time.monotonic())
+            else:
+                # An answer frees the slot before the oldest request expires, look again soon
+                due = time.monotonic() + min(wait, WINDOW_RETRY)
+            heapq.heapreplace(queue, (due, sequence, slot, entry))
+            sequence += 1
+
+    def _poll(self, entry: FleetEntry) -> bool:
+        """Send one request in a window slot already taken, return False if the gateway did not accept it"""
+        window = self._windows[(entry.gateway, entry.sink)]
+        # Track before sending, the answer may come back before send_message returns
+        if self.tracker is not None:
+            self.tracker.sent(self._keys[entry])
+        try:
+            res = self.wni.send_message(entry.gateway, entry.sink, entry.node, 77, 66, self._payloads[entry])
+            if res != wmm.GatewayResultCode.GW_RES_OK:
+                logging.error("Cannot send data to %s:%s res=%s", entry.gateway, entry.sink, res)
+                self._cancel(entry, window)
+                return False
+        except TimeoutError:
+            logging.error("Cannot send data to %s:%s", entry.gateway, entry.sink)
+            self._cancel(entry, window)
+            return False
+        return True
+
+    def _cancel(self, entry: FleetEntry, window: SinkWindow):
+        window.release(entry.node)
+        if self.tracker is not None:
+            self.tracker.cancel(self._keys[entry])
+
+
+class TokenBucket():
+    """Send budget of rate requests per second with bursts of up to burst requests, rate 0 is unlimited"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> Optional[float]:
+        """Take a token without waiting: None once taken, else seconds until one is available"""
+        if not self.rate:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return None
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, stop) -> bool:
+        """Take a token, waiting with stop.wait(timeout) until one is available; False once stop is set"""
+        while True:
+            delay = self.try_acquire()
+            if delay is None:
+                return True
+            if stop.wait(delay):
+                return False
+
+
+class Backoff():
+    """Exponential backoff with jitter: the n-th failure waits between half and all of base * 2**(n-1)"""
+
+    def __init__(self, base: float = 1.0, maximum: float = 300.0):
+        self.base = base
+        self.maximum = maximum
+        self.failures = 0
+
+    def failure(self) -> float:
+        delay = min(self.maximum, self.base * 2 ** self.failures)
+        self.failures += 1
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def reset(self):
+        self.failures = 0
+
+
+class IntervalAdapter():
+    """
+    Per-meter poll interval between min_interval and max_interval.
+
+    The interval is halved when a value moved by more than change_percent
+    since the previous reading and grows by a quarter when it did not.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, change_percent: float = 1.0,
+                 initial: Optional[float] = None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.change = change_percent / 100
+        self.initial = min(max_interval, max(min_interval, initial if initial is not None else max_interval))
+        self._intervals: dict[tuple[str, str, int], float] = {}
+        self._last: dict[tuple[str, str, int], float] = {}
+        self._lock = threading.Lock()
+
+    def interval(self, node_key: tuple[str, str, int]) -> float:
+        return self._intervals.get(node_key, self.initial)
+
+    def observe(self, node_key: tuple[str, str, int], value: float):
+        with self._lock:
+            last = self._last.get(node_key)
+            self._last[node_key] = value
+            if last is None:
+                return
+            interval = self._intervals.get(node_key, self.initial)
+            if abs(value - last) > self.change * abs(last):
+                interval = max(self.min_interval, interval / 2)
+            else:
+                interval = min(self.max_interval, interval * 1.25)
+            self._intervals[node_key] = interval
+
+
+class AdaptivePoller(FleetPoller):
+    """
+    FleetPoller variant polling every meter at its own adaptive interval.
+
+    Each sink has a TokenBucket send budget on top of its SinkWindow. When
+    the gateway refuses a request, send_message times out or an answer does
+    not arrive within answer_timeout, the sink is paused with a jittered
+    exponential backoff. A meter waiting for a token, a window slot or the
+    end of a pause goes back in the schedule, so the gateway thread keeps
+    polling its other sinks. Feed decoded values to observe() so that
+    meters whose values change are polled more often than stable ones.
+    """
+
+    def __init__(self,
+                 wni,
+                 inventory: list[FleetEntry],
+                 payload_factory: Callable[[FleetEntry], bytes],
+                 period: float,
+                 min_period: float,
+                 max_period: float,
+                 rate: float = 0.0,
+                 burst: int = 4,
+                 window: int = 4,
+                 answer_timeout: float = 10.0,
+                 tracker: Optional[RequestTracker] = None,
+                 change_percent: float = 1.0):
+        super().__init__(wni, inventory, payload_factory, period, window, answer_timeout, tracker)
+        self.adapter = IntervalAdapter(min_period, max_period, change_percent, period)
+        self._buckets = {sink: TokenBucket(rate, burst) for sink in self._windows}
+        self._backoffs = {sink: Backoff(maximum=max_period) for sink in self._windows}
+
+    def observe(self, gateway: str, sink: str, node: int, value: float):
+        self.adapter.observe((gateway, sink, int(node)), value)
+
+    def _run_gateway(self, entries: list[FleetEntry]):
+        start = time.monotonic()
+        queue = [(start + offset, i, entry) for i, (offset, entry) in enumerate(self.schedule(entries))]
+        heapq.heapify(queue)
+        sequence = len(queue)
+        paused_until = {sink: 0.0 for sink in self._windows}
+        timeouts = {sink: 0 for sink in self._windows}
+        while True:
+            due, _, entry = queue[0]
+            if self._stop_event.wait(max(0.0, due - time.monotonic())):
+                return
+            heapq.heappop(queue)
+            sink = (entry.gateway, entry.sink)
+            now = time.monotonic()
+            window = self._windows[sink]
+            if paused_until[sink] > now:
+                due = paused_until[sink]
+            elif (wait := window.try_acquire(entry.node)) is not None:
+                due = now + min(wait, WINDOW_RETRY)
+            elif (wait := self._buckets[sink].try_acquire()) is not None:
+                window.release(entry.node)
+                due = now + wait
+            else:
+                sent = self._poll(entry)
+                now = time.monotonic()
+                timed_out = window.timeouts != timeouts[sink]
+                timeouts[sink] = window.timeouts
+                backoff = self._backoffs[sink]
+                if sent and not timed_out:
+                    backoff.reset()
+                    due = now + self.adapter.interval((entry.gateway, entry.sink, entry.node))
+                else:
+                    delay = backoff.failure()
+                    paused_until[sink] = now + delay
+                    logging.warning("Pausing %s:%s for %.1fs after %d failure(s)", *sink, delay, backoff.failures)
+                    # Retry a refused request once the pause is over
+                    due = now + (self.adapter.interval((entry.gateway, entry.sink, entry.node)) if sent else delay)
+            heapq.heappush(queue, (due, sequence, entry))
+            sequence += 1
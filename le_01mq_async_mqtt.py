@@ -0,0 +1,63 @@
+import argparse
+import asyncio
+import logging
+import time
+from async_client import AsyncWmbClient
+from cli_options import add_connection_arguments, connect
+from fleet_poller import FleetEntry, load_inventory
+from uplink_decoder import registers_to_float
+
+
+async def read_voltage(client: AsyncWmbClient, entry: FleetEntry) -> bool:
+    try:
+        response = await client.read_input_registers(entry.gateway, entry.sink, entry.node, 0x0, 2,
+                                                      slave=entry.modbus_addr, port=entry.target_port)
+    except Exception as e:
+        logging.error("%s:%s node %s: %s", entry.gateway, entry.sink, entry.node, str(e) or type(e).__name__)
+        return False
+    logging.info("%s:%s node %s voltage is: %f [V]", entry.gateway, entry.sink, entry.node,
+                 registers_to_float(response.registers))
+    return True
+
+
+async def read_fleet(wni, inventory: list[FleetEntry], concurrency: int, timeout: float):
+    async with AsyncWmbClient(wni, concurrency, timeout) as client:
+        start = time.monotonic()
+        results = await asyncio.gather(*(read_voltage(client, entry) for entry in inventory))
+        logging.info("Read %d of %d nodes in %.1fs", sum(results), len(inventory), time.monotonic() - start)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--inventory',
+                        required=True,
+                        help='Fleet CSV file: gateway,sink,node,modbus_addr,target_port')
+    parser.add_argument('--concurrency',
+                        required=False,
+                        type=int,
+                        default=256,
+                        help='Maximum requests waiting for an answer')
+    parser.add_argument('--timeout',
+                        required=False,
+                        type=float,
+                        default=30.0,
+                        help='Seconds to wait for each answer')
+
+
+def main(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
+
+    inventory = load_inventory(args.inventory)
+    wni = connect(args)
+    try:
+        asyncio.run(read_fleet(wni, inventory, args.concurrency, args.timeout))
+    except KeyboardInterrupt:
+        logging.info("Interrupted, exiting")
+    finally:
+        wni.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_connection_arguments(parser)
+    add_arguments(parser)
+    main(parser, parser.parse_args())
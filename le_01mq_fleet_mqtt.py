@@ -0,0 +1,153 @@
+import argparse
+import logging
+from mbproto.mb_protocol_iface import MBProto
+from pymodbus.client import ModbusFrameGenerator
+from pymodbus.framer import FramerType
+from uplink_decoder import Uplink, FC_READ_INPUT_REGISTERS, registers_to_float
+from uplink_pipeline import RawUplink
+from fleet_poller import AdaptivePoller, FleetEntry, FleetPoller, load_inventory
+from republisher import Reading
+from request_tracker import RequestTracker, MetricsExporter, uplink_key
+from runtime import Runtime
+from cli_options import (add_connection_arguments, add_filter_arguments, add_metrics_arguments,
+                         add_output_arguments, add_pipeline_arguments, add_profiling_arguments, connect,
+                         setup_outputs, setup_pipeline)
+
+tracker = RequestTracker()
+value_filter = None
+history = None
+republisher = None
+interval_adapter = None
+profiler = None
+
+def on_uplink_decoded(data: RawUplink, _uplink: Uplink):
+    _rtt = tracker.received(uplink_key(data.gw_id, data.sink_id, data.source_address, _uplink), data.received)
+    if _uplink.modbus is not None and _uplink.modbus.function_code == FC_READ_INPUT_REGISTERS:
+        if profiler is not None:
+            _t = profiler.clock()
+        _result_float: float = registers_to_float(_uplink.modbus.registers)
+        if profiler is not None:
+            _t = profiler.record('convert', _t)
+        if interval_adapter is not None:
+            interval_adapter.observe((data.gw_id, data.sink_id, data.source_address), _result_float)
+        if history is not None:
+            history.append((data.gw_id, data.sink_id, data.source_address), {'voltage': _result_float},
+                           data.rx_time_ms_epoch / 1000)
+        _report = value_filter is None or value_filter.update((data.gw_id, data.sink_id, data.source_address),
+                                                              {'voltage': _result_float})
+        if profiler is not None:
+            _t = profiler.record('filter', _t)
+        if not _report:
+            return
+        logging.info("%s:%s node %s voltage is: %f [V] (rtt %s)", data.gw_id, data.sink_id, data.source_address,
+                     _result_float, "%.2fs" % _rtt if _rtt is not None else "n/a")
+        if republisher is not None:
+            republisher.publish([Reading(data.gw_id, data.sink_id, data.source_address, 'voltage', _result_float,
+                                         'V', data.rx_time_ms_epoch)])
+        if profiler is not None:
+            profiler.record('output', _t)
+
+def read_voltage_payload(entry: FleetEntry) -> bytes:
+    generator = ModbusFrameGenerator(framer=FramerType.RTU, slave=entry.modbus_addr)
+    mbproto = MBProto()
+    mbproto.target_port = entry.target_port
+    return mbproto.create_modbus_oneshot(generator.read_input_registers(address=0x0, count=2))
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--inventory',
+                        required=True,
+                        help='Fleet CSV file: gateway,sink,node,modbus_addr,target_port')
+    parser.add_argument('--period',
+                        required=False,
+                        type=int,
+                        default=20,
+                        help='Period in seconds')
+    parser.add_argument('--window',
+                        required=False,
+                        type=int,
+                        default=4,
+                        help='Maximum requests in flight per sink')
+    parser.add_argument('--answer-timeout',
+                        required=False,
+                        type=float,
+                        default=10.0,
+                        help='Seconds after which an unanswered request frees its window slot')
+    parser.add_argument('--min-period',
+                        required=False,
+                        type=float,
+                        help='Shortest adaptive poll interval in seconds, defaults to --period')
+    parser.add_argument('--max-period',
+                        required=False,
+                        type=float,
+                        help='Longest adaptive poll interval in seconds, defaults to --period')
+    parser.add_argument('--change-percent',
+                        required=False,
+                        type=float,
+                        default=1.0,
+                        help='Poll a meter faster when its value moved by more than this percentage')
+    parser.add_argument('--rate',
+                        required=False,
+                        type=float,
+                        default=0.0,
+                        help='Maximum requests per second per sink, 0 for no limit')
+    parser.add_argument('--burst',
+                        required=False,
+                        type=int,
+                        default=4,
+                        help='Requests per sink that may be sent back to back within --rate')
+    parser.add_argument('--lost-timeout',
+                        required=False,
+                        type=float,
+                        default=30.0,
+                        help='Seconds after which an unanswered request is counted as lost')
+    add_metrics_arguments(parser)
+    parser.add_argument('--metrics-interval',
+                        required=False,
+                        type=float,
+                        default=15.0,
+                        help='Metrics file refresh interval in seconds')
+    add_pipeline_arguments(parser)
+    add_filter_arguments(parser)
+    add_output_arguments(parser)
+    add_profiling_arguments(parser)
+
+def main(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    global value_filter, history, republisher, interval_adapter, profiler
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
+
+    inventory = load_inventory(args.inventory)
+    if not inventory:
+        parser.error("Inventory %s is empty" % args.inventory)
+
+    wni = connect(args)
+    runtime = Runtime(wni)
+
+    tracker.timeout = args.lost_timeout
+    exporter = MetricsExporter(tracker, args.metrics_file, args.metrics_port, args.metrics_interval)
+    exporter.start()
+    runtime.on_shutdown(exporter.stop)
+
+    profiler, value_filter, history, republisher = setup_outputs(parser, args, runtime, ['voltage'], len(inventory))
+    on_uplink = setup_pipeline(parser, args, runtime, on_uplink_decoded, profiler)
+
+    min_period = args.min_period if args.min_period is not None else args.period
+    max_period = args.max_period if args.max_period is not None else args.period
+    if min_period == max_period == args.period and not args.rate:
+        poller = FleetPoller(wni, inventory, read_voltage_payload, args.period, args.window, args.answer_timeout, tracker)
+    else:
+        poller = AdaptivePoller(wni, inventory, read_voltage_payload, args.period, min_period, max_period,
+                                args.rate, args.burst, args.window, args.answer_timeout, tracker, args.change_percent)
+        interval_adapter = poller.adapter
+    poller.register_uplink_cb(on_uplink)
+    poller.start()
+    runtime.on_shutdown(poller.stop)
+
+    logging.info("Polling %d nodes, press Ctrl+C to exit", len(inventory))
+    runtime.run()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_connection_arguments(parser)
+    add_arguments(parser)
+    main(parser, parser.parse_args())
@@ -1,63 +1,51 @@
 import argparse
-import json
-import struct
-import time
 import logging
-from wirepas_mqtt_library import WirepasNetworkInterface
 import wirepas_mesh_messaging as wmm
-import mbproto.mb_protocol_pb2 as mb_protocol
 from mbproto.mb_protocol_iface import MBProto
-from google.protobuf.json_format import MessageToJson
 from pymodbus.client import ModbusFrameGenerator
 from pymodbus.framer import FramerType
+from uplink_decoder import UplinkDecoder, FC_READ_INPUT_REGISTERS, registers_to_float
+from uplink_dedup import UplinkDeduplicator
+from fleet_poller import Backoff, IntervalAdapter, TokenBucket
+from request_tracker import RequestTracker, MetricsExporter, request_key, uplink_key
+from runtime import Runtime
+from cli_options import (add_connection_arguments, add_filter_arguments, add_metrics_arguments,
+                         add_profiling_arguments, connect, setup_outputs)
 
-def mbd_to_float(input: bytes | bytearray | list[int]) -> float:
-    assert len(input) == 4
-    # parse with endianness: BACD (here, inverted to CDAB)
-    return struct.unpack("<f", bytes([input[2], input[3], input[0], input[1]]))[0]
+decoder = UplinkDecoder()
+tracker = RequestTracker()
+deduplicator = UplinkDeduplicator()
+value_filter = None
+interval_adapter = None
+profiler = None
 
 def on_uplink_data_transmitted(data):
-    _mbproto = MBProto()
-    _ret, _err, _msg = _mbproto.decode_response(data.data_payload)
-    _json_str = MessageToJson(_msg, always_print_fields_with_no_presence=True, preserving_proto_field_name=True)
-    _dict = json.loads(_json_str)
-    if (_msg.cmd == mb_protocol.Cmd.CMD_MODBUS_ONE_SHOT or _msg.cmd == mb_protocol.Cmd.CMD_MODBUS_PERIODICAL):
-        if (_msg.payload.payload_answer_frame.ack_frame.acknowladge == 0):
-            _modbus_data = _msg.payload.payload_answer_frame.modbus_response_frame.modbus_frame
-            _modbus_frame = _mbproto.decode_modbus_frame(_modbus_data)
-            _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame'] = _modbus_frame
-    if 'modbus_response_frame' in _dict['payload']['payload_answer_frame']:
-        if 'ReadInputRegistersResponse' in _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']:
-            _result = _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']['ReadInputRegistersResponse']['registers']
-            _result_bytes: bytearray = bytearray()
-            for val in _result:
-                _val_bytes: bytes = val.to_bytes(length=2, byteorder="little")
-                _result_bytes.extend(_val_bytes)
-            _result_float: float = mbd_to_float(input=_result_bytes)
-            logging.info("Voltage is: %f [V]", _result_float)
+    if deduplicator.window > 0 and deduplicator.is_duplicate(data):
+        return
+    try:
+        _uplink = decoder.decode(data.data_payload)
+    except ValueError as e:
+        logging.error("Failed to decode uplink: %s", e)
+        return
+    _rtt = tracker.received(uplink_key(data.gw_id, data.sink_id, data.source_address, _uplink))
+    if _uplink.modbus is not None and _uplink.modbus.function_code == FC_READ_INPUT_REGISTERS:
+        if profiler is not None:
+            _t = profiler.clock()
+        _result_float: float = registers_to_float(_uplink.modbus.registers)
+        if profiler is not None:
+            _t = profiler.record('convert', _t)
+        interval_adapter.observe((data.gw_id, data.sink_id, data.source_address), _result_float)
+        _report = value_filter is None or value_filter.update((data.gw_id, data.sink_id, data.source_address),
+                                                              {'voltage': _result_float})
+        if profiler is not None:
+            _t = profiler.record('filter', _t)
+        if not _report:
+            return
+        logging.info("Voltage is: %f [V] (rtt %s)", _result_float, "%.2fs" % _rtt if _rtt is not None else "n/a")
+        if profiler is not None:
+            profiler.record('output', _t)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
-    parser.add_argument('--host',
-                        required=True,
-                        help="MQTT broker address")
-    parser.add_argument('--port',
-                        required=False,
-                        default=8883,
-                        type=int,
-                        help="MQTT broker port")
-    parser.add_argument('--username', 
-                        required=False,
-                        default='mqttmasteruser',
-                        help="MQTT broker username")
-    parser.add_argument('--password',
-                        required=True,
-                        help="MQTT broker password")
-    parser.add_argument('--insecure',
-                        required=False,
-                        dest='insecure',
-                        action='store_true',
-                        help="MQTT use unsecured connection")
+def add_arguments(parser: argparse.ArgumentParser):
     parser.add_argument('--gw',
                         required=True,
                         help="GW ID")
@@ -85,16 +73,52 @@ if __name__ == "__main__":
                         type=int,
                         default=20,
                         help='Period in seconds')
+    parser.add_argument('--min-period',
+                        required=False,
+                        type=float,
+                        help='Shortest adaptive poll interval in seconds, defaults to --period')
+    parser.add_argument('--max-period',
+                        required=False,
+                        type=float,
+                        help='Longest adaptive poll interval in seconds, defaults to --period')
+    parser.add_argument('--change-percent',
+                        required=False,
+                        type=float,
+                        default=1.0,
+                        help='Poll a meter faster when its value moved by more than this percentage')
+    parser.add_argument('--rate',
+                        required=False,
+                        type=float,
+                        default=0.0,
+                        help='Maximum requests per second per sink, 0 for no limit')
+    parser.add_argument('--burst',
+                        required=False,
+                        type=int,
+                        default=4,
+                        help='Requests per sink that may be sent back to back within --rate')
+    add_filter_arguments(parser)
+    add_metrics_arguments(parser)
+    add_profiling_arguments(parser)
 
-    args = parser.parse_args()
+def main(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    global value_filter, interval_adapter, profiler
 
     logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
 
-    wni = WirepasNetworkInterface(args.host,
-                                  args.port,
-                                  args.username,
-                                  args.password,
-                                  insecure=args.insecure)
+    wni = connect(args)
+    runtime = Runtime(wni)
+    runtime.install_signal_handlers()
+    deduplicator.window = args.dedup_window
+    runtime.on_shutdown(deduplicator.log_summary)
+
+    profiler, value_filter, _, _ = setup_outputs(parser, args, runtime, ['voltage'], 1)
+    decoder.profiler = profiler
+
+    min_period = args.min_period if args.min_period is not None else args.period
+    max_period = args.max_period if args.max_period is not None else args.period
+    interval_adapter = IntervalAdapter(min_period, max_period, args.change_percent, args.period)
+    bucket = TokenBucket(args.rate, args.burst)
+    backoff = Backoff(maximum=max_period)
     
     # Register a callback for uplink traffic
     wni.register_uplink_traffic_cb(on_uplink_data_transmitted, gateway=args.gw, sink=args.sink, src_ep = 66, dst_ep = 77)
@@ -107,12 +131,39 @@ if __name__ == "__main__":
 
     mbproto.target_port = args.target_port
     payload_coded = mbproto.create_modbus_oneshot(read_regs_frame)
+    key = request_key(args.gw, args.sink, args.node, payload_coded)
+
+    # An answer missing for more than one period is counted as lost
+    tracker.timeout = max_period
+    exporter = MetricsExporter(tracker, args.metrics_file, args.metrics_port, args.period)
+    exporter.start()
+    runtime.on_shutdown(exporter.stop)
 
-    while True:
+    while bucket.acquire(runtime):
+        tracker.sent(key)
+        sent = False
         try:
             res = wni.send_message(args.gw, args.sink, args.node, 77, 66, payload_coded)
             if res != wmm.GatewayResultCode.GW_RES_OK:
                 print("Cannot send data to %s:%s res=%s" % (args.gw, args.sink, res))
+                tracker.cancel(key)
+            else:
+                sent = True
         except TimeoutError:
-            print("Cannot send data to %s:%s", args.gw, args.sink)
-        time.sleep(args.period)
\ No newline at end of file
+            print("Cannot send data to %s:%s" % (args.gw, args.sink))
+            tracker.cancel(key)
+        if sent:
+            backoff.reset()
+            delay = interval_adapter.interval((args.gw, args.sink, int(args.node)))
+        else:
+            delay = backoff.failure()
+            logging.warning("Retrying in %.1fs after %d failure(s)", delay, backoff.failures)
+        if runtime.wait(delay):
+            break
+    runtime.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_connection_arguments(parser)
+    add_arguments(parser)
+    main(parser, parser.parse_args())
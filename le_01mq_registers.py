@@ -0,0 +1,165 @@
+import struct
+from typing import NamedTuple
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional, decode_many() falls back to struct.iter_unpack
+    np = None
+
+# Register types: struct format and size in 16-bit registers
+TYPES = {
+    'float32': ('f', 2),
+    'int32': ('i', 2),
+    'uint32': ('I', 2),
+    'int16': ('h', 1),
+    'uint16': ('H', 1),
+}
+NUMPY_TYPES = {'float32': '>f4', 'int32': '>i4', 'uint32': '>u4', 'int16': '>i2', 'uint16': '>u2'}
+
+
+class Register(NamedTuple):
+    name: str
+    address: int
+    type: str = 'float32'
+    # 'ABCD' - high word first, 'CDAB' - low word first
+    word_order: str = 'ABCD'
+    scale: float = 1.0
+    unit: str = ''
+
+    @property
+    def count(self) -> int:
+        return TYPES[self.type][1]
+
+
+# le-01mq input registers (function 0x04)
+LE_01MQ_REGISTERS = (
+    Register('voltage', 0x00, unit='V'),
+    Register('current', 0x06, unit='A'),
+    Register('active_power', 0x0c, unit='W'),
+    Register('apparent_power', 0x12, unit='VA'),
+    Register('reactive_power', 0x18, unit='var'),
+    Register('power_factor', 0x1e),
+    Register('phase_angle', 0x24, unit='deg'),
+    Register('frequency', 0x46, unit='Hz'),
+    Register('import_active_energy', 0x48, unit='kWh'),
+    Register('export_active_energy', 0x4a, unit='kWh'),
+    Register('import_reactive_energy', 0x4c, unit='kvarh'),
+    Register('export_reactive_energy', 0x4e, unit='kvarh'),
+    Register('total_demand_power', 0x56, unit='W'),
+    Register('total_active_energy', 0x156, unit='kWh'),
+    Register('total_reactive_energy', 0x158, unit='kvarh'),
+)
+
+
+class _BlockLayout(NamedTuple):
+    # One big-endian struct format covering every register of the block, gaps as pad bytes
+    fmt: struct.Struct
+    # (register, index of its first value in the unpacked tuple) for registers inside the block
+    fields: tuple[tuple[Register, int], ...]
+
+
+class RegisterMap():
+    """
+    Declarative register map decoding a whole register block into named values.
+
+    The layout of each (address, count) block is compiled once into a single
+    struct format, so decoding a block is one unpack call whatever the number
+    of values it holds.
+    """
+
+    def __init__(self, registers: tuple[Register, ...] | list[Register]):
+        self.registers = tuple(sorted(registers, key=lambda r: r.address))
+        self.by_name = {r.name: r for r in self.registers}
+        self._layouts: dict[tuple[int, int], _BlockLayout] = {}
+
+    def layout(self, address: int, count: int) -> _BlockLayout:
+        layout = self._layouts.get((address, count))
+        if layout is None:
+            layout = self._layouts[(address, count)] = self._compile(address, count)
+        return layout
+
+    def _compile(self, address: int, count: int) -> _BlockLayout:
+        fmt = ">"
+        position = address
+        index = 0
+        fields = []
+        for register in self.registers:
+            if register.address < position or register.address + register.count > address + count:
+                continue
+            if register.address > position:
+                fmt += "%dx" % ((register.address - position) * 2)
+            if register.word_order == 'CDAB' and register.count == 2:
+                # Unpack both words and swap them in _value()
+                fmt += "HH"
+                fields.append((register, index))
+                index += 2
+            else:
+                fmt += TYPES[register.type][0]
+                fields.append((register, index))
+                index += 1
+            position = register.address + register.count
+        if address + count > position:
+            fmt += "%dx" % ((address + count - position) * 2)
+        return _BlockLayout(struct.Struct(fmt), tuple(fields))
+
+    @staticmethod
+    def _value(register: Register, values: tuple, index: int) -> float:
+        if register.word_order == 'CDAB' and register.count == 2:
+            raw = struct.pack(">HH", values[index + 1], values[index])
+            value = struct.unpack(">" + TYPES[register.type][0], raw)[0]
+        else:
+            value = values[index]
+        return value * register.scale if register.scale != 1.0 else value
+
+    def decode(self, address: int, registers: tuple[int, ...] | list[int]) -> dict[str, float]:
+        """Decode every mapped value fully contained in a block of registers starting at address"""
+        layout = self.layout(address, len(registers))
+        values = layout.fmt.unpack(struct.pack(">%dH" % len(registers), *registers))
+        return {register.name: self._value(register, values, index) for register, index in layout.fields}
+
+    def decode_bytes(self, address: int, data: bytes) -> dict[str, float]:
+        """Same as decode() for the raw big-endian register bytes of a Modbus answer"""
+        layout = self.layout(address, len(data) // 2)
+        values = layout.fmt.unpack(data)
+        return {register.name: self._value(register, values, index) for register, index in layout.fields}
+
+    def decode_many(self, address: int, blocks: list[tuple[int, ...]] | list[list[int]]) -> dict[str, list[float]]:
+        """
+        Decode many blocks read from the same address, e.g. one answer per meter,
+        into one column of values per register name.
+
+        Uses NumPy when it is installed and struct.iter_unpack otherwise. The
+        NumPy path returns arrays instead of lists.
+        """
+        if not blocks:
+            return {}
+        count = len(blocks[0])
+        layout = self.layout(address, count)
+        if np is not None:
+            return self._decode_many_numpy(address, blocks, layout)
+        data = struct.pack(">%dH" % (count * len(blocks)), *(value for block in blocks for value in block))
+        rows = list(struct.iter_unpack(layout.fmt.format, data))
+        return {register.name: [self._value(register, row, index) for row in rows] for register, index in layout.fields}
+
+    @staticmethod
+    def _decode_many_numpy(address: int, blocks, layout: _BlockLayout) -> dict:
+        words = np.asarray(blocks, dtype=np.uint16)
+        columns = {}
+        for register, _ in layout.fields:
+            offset = register.address - address
+            if register.count == 2 and register.word_order == 'CDAB':
+                part = words[:, [offset + 1, offset]]
+            else:
+                part = words[:, offset:offset + register.count]
+            # Registers as big-endian bytes, reinterpreted as the register type
+            column = np.ascontiguousarray(part, dtype='>u2').view(NUMPY_TYPES[register.type]).ravel()
+            columns[register.name] = column * register.scale if register.scale != 1.0 else column
+        return columns
+
+    def unit(self, name: str) -> str:
+        return self.by_name[name].unit
+
+
+LE_01MQ = RegisterMap(LE_01MQ_REGISTERS)
+
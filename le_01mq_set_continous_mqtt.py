@@ -1,83 +1,87 @@
 import argparse
-import json
-import struct
-import threading
 import logging
-from wirepas_mqtt_library import WirepasNetworkInterface
-import wirepas_mesh_messaging as wmm
-import mbproto.mb_protocol_pb2 as mb_protocol
-import mbproto.mb_protocol_answers_pb2 as mb_answers
 from mbproto.mb_protocol_iface import MBProto
-from google.protobuf.json_format import MessageToJson
 from pymodbus.client import ModbusFrameGenerator
 from pymodbus.framer import FramerType
+from uplink_decoder import Uplink, FC_READ_INPUT_REGISTERS
+from uplink_pipeline import RawUplink
+from fleet_poller import FleetEntry, load_inventory
+from provisioner import ConfigJob, Provisioner, log_summary
+from register_planner import MAX_READ_COUNT, RegisterBlock, ReadPlan, plan_reads, split_registers
+from le_01mq_registers import LE_01MQ
+from republisher import Reading
+from runtime import Runtime
+from cli_options import (add_connection_arguments, add_filter_arguments, add_output_arguments, add_pipeline_arguments,
+                         add_profiling_arguments, connect, setup_outputs, setup_pipeline)
 
-callback_event = threading.Event()
-
-def mbd_to_float(input: bytes | bytearray | list[int]) -> float:
-    assert len(input) == 4
-    # parse with endianness: BACD (here, inverted to CDAB)
-    return struct.unpack("<f", bytes([input[2], input[3], input[0], input[1]]))[0]
-
-def on_uplink_data_transmitted(data):
-    _mbproto = MBProto()
-    _ret, _err, _msg = _mbproto.decode_response(data.data_payload)
-    _json_str = MessageToJson(_msg, always_print_fields_with_no_presence=True, preserving_proto_field_name=True)
-    _dict = json.loads(_json_str)
-    if (_msg.cmd == mb_protocol.Cmd.CMD_MODBUS_ONE_SHOT or _msg.cmd == mb_protocol.Cmd.CMD_MODBUS_PERIODICAL):
-        if (_msg.payload.payload_answer_frame.ack_frame.acknowladge == mb_answers.Acknowladge.ACKNOWLADGE_UNKNOWN):
-            _modbus_data = _msg.payload.payload_answer_frame.modbus_response_frame.modbus_frame
-            _modbus_frame = _mbproto.decode_modbus_frame(_modbus_data)
-            _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame'] = _modbus_frame
-        elif(_msg.payload.payload_answer_frame.ack_frame.acknowladge == mb_answers.Acknowladge.ACKNOWLADGE_ACK):
-            logging.info("Configuration added")
-            callback_event.set()
-    if (_msg.payload.payload_answer_frame.modbus_response_frame.configuration_index == 1):
-        if 'modbus_response_frame' in _dict['payload']['payload_answer_frame']:
-            if 'ReadInputRegistersResponse' in _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']:
-                _result = _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']['ReadInputRegistersResponse']['registers']
-                _result_bytes: bytearray = bytearray()
-                for val in _result:
-                    _val_bytes: bytes = val.to_bytes(length=2, byteorder="little")
-                    _result_bytes.extend(_val_bytes)
-                _result_float: float = mbd_to_float(input=_result_bytes)
-                logging.info("Voltage is: %f [V]", _result_float)
-
-def set_configuration(modbus_frame: bytes, config_index: int, interval_seconds: int, serial_port: int):
+# Input register blocks read periodically
+READ_BLOCKS = [RegisterBlock(0x00, 2), RegisterBlock(0x06, 2), RegisterBlock(0x0b, 18), RegisterBlock(0x24, 2),
+               RegisterBlock(0x46, 2), RegisterBlock(0x48, 8), RegisterBlock(0x56, 2), RegisterBlock(0x156, 4)]
+
+provisioner = None
+value_filter = None
+history = None
+republisher = None
+profiler = None
+# Configuration index i reads plans[i - 1]
+plans: list[ReadPlan] = []
+
+def on_uplink_decoded(data: RawUplink, _uplink: Uplink):
+    if provisioner.on_uplink(data, _uplink):
+        logging.info("Configuration added on node %s", data.source_address)
+    elif _uplink.modbus is not None and _uplink.configuration_index > len(plans):
+        logging.warning("Node %s still reports configuration %d, which is not in the plan", data.source_address,
+                        _uplink.configuration_index)
+    elif _uplink.modbus is not None and _uplink.configuration_index >= 1:
+        if _uplink.modbus.function_code == FC_READ_INPUT_REGISTERS:
+            if profiler is not None:
+                _t = profiler.clock()
+            try:
+                _blocks = split_registers(plans[_uplink.configuration_index - 1], _uplink.modbus.registers)
+            except ValueError as e:
+                logging.error("Unexpected answer to configuration %d: %s", _uplink.configuration_index, e)
+                return
+            _values = {}
+            for _block, _registers in _blocks.items():
+                _values.update(LE_01MQ.decode(_block.address, _registers))
+            if profiler is not None:
+                _t = profiler.record('convert', _t)
+            if history is not None:
+                history.append((data.gw_id, data.sink_id, data.source_address), _values, data.rx_time_ms_epoch / 1000)
+            if value_filter is not None:
+                _values = value_filter.update((data.gw_id, data.sink_id, data.source_address), _values)
+            if profiler is not None:
+                _t = profiler.record('filter', _t)
+            if not _values:
+                return
+            logging.info("Node %s: %s", data.source_address,
+                         ", ".join("%s=%f [%s]" % (name, value, LE_01MQ.unit(name)) for name, value in _values.items()))
+            if republisher is not None:
+                republisher.publish([Reading(data.gw_id, data.sink_id, data.source_address, name, value,
+                                             LE_01MQ.unit(name), data.rx_time_ms_epoch)
+                                     for name, value in _values.items()])
+            if profiler is not None:
+                profiler.record('output', _t)
+
+def configuration_jobs(entry: FleetEntry, interval_seconds: int, clear_up_to: int) -> list[ConfigJob]:
+    generator = ModbusFrameGenerator(framer=FramerType.RTU, slave=entry.modbus_addr)
     mbproto = MBProto()
-    mbproto.target_port = serial_port
-    payload_coded = mbproto.create_modbus_periodic(config_index, interval_seconds, modbus_frame)
-    try:
-        res = wni.send_message(args.gw, args.sink, args.node, 77, 66, payload_coded)
-        if res != wmm.GatewayResultCode.GW_RES_OK:
-            print("Cannot send data to %s:%s res=%s" % (args.gw, args.sink, res))
-    except TimeoutError:
-        print("Cannot send data to %s:%s", args.gw, args.sink)
+    mbproto.target_port = entry.target_port
+    jobs = []
+    for i, (address, count, _) in enumerate(plans, start=1):
+        modbus_frame = generator.read_input_registers(address=address, count=count)
+        payload_coded = mbproto.create_modbus_periodic(i, interval_seconds, modbus_frame)
+        jobs.append(ConfigJob(entry.gateway, entry.sink, entry.node, i, payload_coded))
+    # Indices a previous, longer plan left on the device keep reading until disabled with a 0 interval
+    modbus_frame = generator.read_input_registers(address=plans[0].address, count=plans[0].count)
+    for i in range(len(plans) + 1, clear_up_to + 1):
+        payload_coded = mbproto.create_modbus_periodic(i, 0, modbus_frame)
+        jobs.append(ConfigJob(entry.gateway, entry.sink, entry.node, i, payload_coded))
+    return jobs
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
-    parser.add_argument('--host',
-                        required=True,
-                        help="MQTT broker address")
-    parser.add_argument('--port',
-                        required=False,
-                        default=8883,
-                        type=int,
-                        help="MQTT broker port")
-    parser.add_argument('--username', 
-                        required=False,
-                        default='mqttmasteruser',
-                        help="MQTT broker username")
-    parser.add_argument('--password',
-                        required=True,
-                        help="MQTT broker password")
-    parser.add_argument('--insecure',
-                        required=False,
-                        dest='insecure',
-                        action='store_true',
-                        help="MQTT use unsecured connection")
+def add_arguments(parser: argparse.ArgumentParser):
     parser.add_argument('--gw',
-                        required=True,
+                        required=False,
                         help="GW ID")
     parser.add_argument('--sink',
                         required=False,
@@ -103,46 +107,89 @@ if __name__ == "__main__":
                         type=int,
                         default=120,
                         help='Interval in seconds')
+    parser.add_argument('--inventory',
+                        required=False,
+                        help='Provision every node of a fleet CSV file: gateway,sink,node,modbus_addr,target_port')
+    parser.add_argument('--window',
+                        required=False,
+                        type=int,
+                        default=16,
+                        help='Maximum nodes with a configuration in flight')
+    parser.add_argument('--ack-timeout',
+                        required=False,
+                        type=float,
+                        default=30.0,
+                        help='Seconds to wait for a configuration ACK before retrying')
+    parser.add_argument('--retries',
+                        required=False,
+                        type=int,
+                        default=2,
+                        help='Retries of a configuration whose ACK timed out')
+    parser.add_argument('--max-gap',
+                        required=False,
+                        type=int,
+                        default=10,
+                        help='Merge register blocks separated by at most this many registers into one read, 0 merges only touching blocks')
+    parser.add_argument('--max-count',
+                        required=False,
+                        type=int,
+                        default=MAX_READ_COUNT,
+                        help='Maximum registers in one merged read')
+    parser.add_argument('--clear-up-to',
+                        required=False,
+                        type=int,
+                        default=len(READ_BLOCKS),
+                        help='Disable the configuration indices above the plan up to this one, left active by a '
+                             'previous plan (one read per block used up to %d)' % len(READ_BLOCKS))
+    add_pipeline_arguments(parser)
+    add_filter_arguments(parser)
+    add_output_arguments(parser)
+    add_profiling_arguments(parser)
 
-    args = parser.parse_args()
+def main(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    global provisioner, value_filter, history, republisher, plans, profiler
 
     logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
 
-    wni = WirepasNetworkInterface(args.host,
-                                  args.port,
-                                  args.username,
-                                  args.password,
-                                  insecure=args.insecure)
-    
+    if args.inventory is not None:
+        inventory = load_inventory(args.inventory)
+    elif args.gw is not None:
+        inventory = [FleetEntry(args.gw, args.sink, int(args.node), args.modbus_addr, args.target_port)]
+    else:
+        parser.error("Either --gw or --inventory is required")
+
+    wni = connect(args)
+    runtime = Runtime(wni)
+    runtime.install_signal_handlers()
+
+    provisioner = Provisioner(wni, args.window, args.ack_timeout, args.retries)
+    runtime.on_stop(provisioner.cancel)
+
+    profiler, value_filter, history, republisher = setup_outputs(parser, args, runtime,
+                                                                 [register.name for register in LE_01MQ.registers],
+                                                                 len(inventory))
+    # The ACKs to a node's successive configurations are identical, they are not copies
+    on_uplink = setup_pipeline(parser, args, runtime, on_uplink_decoded, profiler, provisioner.awaiting)
+
     # Register a callback for uplink traffic
-    wni.register_uplink_traffic_cb(on_uplink_data_transmitted, gateway=args.gw, sink=args.sink, src_ep = 66, dst_ep = 77)
-
-    generator = ModbusFrameGenerator(framer=FramerType.RTU, slave=args.modbus_addr)
-
-    for i in range(1, 9):
-        callback_event.clear()
-        if i == 1:
-            modbus_frame = generator.read_input_registers(address=0x00, count=2)
-        elif i == 2:
-            modbus_frame = generator.read_input_registers(address=0x06, count=2)
-        elif i == 3:
-            modbus_frame = generator.read_input_registers(address=0x0b, count=18)
-        elif i == 4:
-            modbus_frame = generator.read_input_registers(address=0x24, count=2)
-        elif i == 5:
-            modbus_frame = generator.read_input_registers(address=0x46, count=2)
-        elif i == 6:
-            modbus_frame = generator.read_input_registers(address=0x48, count=8)
-        elif i == 7:
-            modbus_frame = generator.read_input_registers(address=0x56, count=2)
-        elif i == 8:
-            modbus_frame = generator.read_input_registers(address=0x156, count=4)
-        set_configuration(modbus_frame, i, args.modbus_interval, args.target_port)
-        callback_event.wait()
-
-    logging.info("Entering infinite polling, press Ctrl+C to exit")
-    try:
-        while True:
-            pass
-    except KeyboardInterrupt:
-        print("Loop interrupted by user.")
\ No newline at end of file
+    for gateway, sink in sorted({(entry.gateway, entry.sink) for entry in inventory}):
+        wni.register_uplink_traffic_cb(on_uplink, gateway=gateway, sink=sink, src_ep = 66, dst_ep = 77)
+
+    plans = plan_reads(READ_BLOCKS, args.max_gap, args.max_count)
+    for i, plan in enumerate(plans, start=1):
+        logging.info("Configuration %d reads 0x%x+%d for %d block(s)", i, plan.address, plan.count, len(plan.blocks))
+
+    if args.clear_up_to > len(plans):
+        logging.info("Configurations %d to %d are disabled", len(plans) + 1, args.clear_up_to)
+    jobs = [job for entry in inventory for job in configuration_jobs(entry, args.modbus_interval, args.clear_up_to)]
+    results = provisioner.run(jobs)
+    log_summary(results, max(len(plans), args.clear_up_to))
+
+    logging.info("Listening for periodic answers, press Ctrl+C to exit")
+    runtime.run()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_connection_arguments(parser)
+    add_arguments(parser)
+    main(parser, parser.parse_args())
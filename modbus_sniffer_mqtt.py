@@ -0,0 +1,68 @@
+import argparse
+import logging
+from uplink_decoder import UplinkDecoder
+from rtu_sniffer import ModbusSniffer
+from runtime import Runtime
+from cli_options import add_connection_arguments, connect
+
+decoder = UplinkDecoder()
+sniffer = ModbusSniffer()
+
+def on_uplink_data_transmitted(data):
+    # Only unwrap the MBProto message, the sniffed bytes go straight to the stream parser
+    try:
+        _port, _modbus_frame = decoder.modbus_frame(data.data_payload)
+    except ValueError as e:
+        logging.error("Failed to decode uplink: %s", e)
+        return
+    if _modbus_frame:
+        sniffer.feed((data.gw_id, data.sink_id, data.source_address, _port), _modbus_frame,
+                     data.rx_time_ms_epoch / 1000)
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--gw',
+                        required=False,
+                        help="GW ID, all gateways by default")
+    parser.add_argument('--sink',
+                        required=False,
+                        help="Sink ID, all sinks by default")
+    parser.add_argument('--stats-interval',
+                        required=False,
+                        type=float,
+                        default=10.0,
+                        help='Log the statistics of the last interval every this many seconds')
+    parser.add_argument('--max-streams',
+                        required=False,
+                        type=int,
+                        default=10000,
+                        help='Maximum sniffed buses (node and port) tracked')
+    parser.add_argument('--max-keys',
+                        required=False,
+                        type=int,
+                        default=4096,
+                        help='Maximum (slave, function code) pairs tracked')
+
+def main(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
+
+    sniffer.max_streams = args.max_streams
+    sniffer.max_keys = args.max_keys
+
+    wni = connect(args)
+    runtime = Runtime(wni)
+    runtime.install_signal_handlers()
+
+    # Register a callback for uplink traffic
+    wni.register_uplink_traffic_cb(on_uplink_data_transmitted, gateway=args.gw, sink=args.sink, src_ep = 66, dst_ep = 77)
+
+    logging.info("Listening for sniffed Modbus traffic, press Ctrl+C to exit")
+    while not runtime.wait(args.stats_interval):
+        sniffer.log_stats(reset=True)
+    sniffer.log_stats()
+    runtime.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_connection_arguments(parser)
+    add_arguments(parser)
+    main(parser, parser.parse_args())
@@ -0,0 +1,212 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Optional
+from request_tracker import Histogram
+
+# Stage durations [s], from a microsecond to a tenth of a second
+STAGE_BUCKETS = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 1e-1)
+
+
+class _Stage():
+    def __init__(self):
+        self.time = Histogram(STAGE_BUCKETS)
+        # Net memory blocks allocated by the stage, only with allocations
+        self.blocks = 0
+
+
+class StageProfiler():
+    """
+    Wall time of each stage of the uplink path, e.g. decode_response,
+    decode_modbus_frame, convert and output.
+
+    Instrumented code holds an optional profiler and pays a None check when
+    it is not set:
+
+        if profiler is not None:
+            _t = profiler.clock()
+        ...
+        if profiler is not None:
+            _t = profiler.record('convert', _t)
+
+    With allocations, the net number of memory blocks allocated by each
+    stage is counted too. start() logs a summary every interval seconds.
+    install_signal_handlers() makes SIGUSR1 run cProfile in the threads
+    going through clock() for sample_seconds and write the merged
+    statistics to output_dir, and SIGUSR2 trace allocations with
+    tracemalloc for sample_seconds and log the top allocating lines.
+    """
+
+    def __init__(self, interval: float = 60.0, allocations: bool = False, sample_seconds: float = 30.0,
+                 output_dir: str = '.'):
+        self.interval = interval
+        self.allocations = allocations
+        self.sample_seconds = sample_seconds
+        self.output_dir = output_dir
+        self._stages: dict[str, _Stage] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # cProfile runs until this monotonic time, 0 when not sampling
+        self._profile_until = 0.0
+        self._profiles: list[cProfile.Profile] = []
+        # Threads with a profile of the current sample enabled and not handed over yet
+        self._profiling = 0
+        # Numbers the samples, a thread's profile of an already dumped sample is stale
+        self._generation = 0
+        # Threads still holding a stale profile, they turn it off on their next clock()
+        self._stale = 0
+
+    def clock(self) -> float:
+        """Start timing a stage in the calling thread"""
+        if self._profile_until or self._stale:
+            self._sample()
+        if self.allocations:
+            self._local.blocks = sys.getallocatedblocks()
+        return time.perf_counter()
+
+    def record(self, name: str, start: float) -> float:
+        """Record the stage started at start, return the start of the next one"""
+        now = time.perf_counter()
+        blocks = 0
+        if self.allocations:
+            current = sys.getallocatedblocks()
+            blocks = current - getattr(self._local, 'blocks', current)
+            self._local.blocks = current
+        self.record_time(name, now - start, blocks)
+        return now
+
+    def record_time(self, name: str, seconds: float, blocks: int = 0):
+        """Record a stage timed elsewhere, e.g. the time an uplink waited in a queue"""
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = _Stage()
+            stage.time.observe(seconds)
+            stage.blocks += blocks
+
+    def log_summary(self, reset: bool = False):
+        with self._lock:
+            stages = self._stages
+            if reset:
+                self._stages = {}
+        total = sum(stage.time.sum for stage in stages.values())
+        for name, stage in stages.items():
+            histogram = stage.time
+            logging.info("Stage %s: %d calls, %.1fms (%.1f%%), mean %.1fus, p50 %.1fus, p99 %.1fus%s", name,
+                         histogram.count, 1e3 * histogram.sum, 100 * histogram.sum / total if total else 0.0,
+                         1e6 * histogram.sum / histogram.count, 1e6 * histogram.quantile(0.5),
+                         1e6 * histogram.quantile(0.99),
+                         ", %.1f blocks/call" % (stage.blocks / histogram.count) if self.allocations else "")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stage-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.log_summary()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.log_summary(reset=True)
+
+    def install_signal_handlers(self):
+        # Not available on Windows
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.sample_profile())
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.sample_allocations())
+
+    def sample_profile(self):
+        """Profile the instrumented threads for sample_seconds"""
+        if self._profile_until:
+            return
+        logging.info("Profiling for %.0fs", self.sample_seconds)
+        self._profile_until = time.monotonic() + self.sample_seconds
+        self._timer(self.sample_seconds, self._dump_profile)
+
+    @staticmethod
+    def _timer(delay: float, fn):
+        timer = threading.Timer(delay, fn)
+        timer.daemon = True
+        timer.start()
+
+    def _sample(self):
+        # cProfile only sees the thread that enabled it, so each instrumented thread runs its own
+        local = self._local
+        profile = getattr(local, 'profile', None)
+        if profile is not None and local.generation != self._generation:
+            # Idle when its sample was dumped
+            profile.disable()
+            local.profile = profile = None
+            with self._lock:
+                self._stale -= 1
+        if time.monotonic() < self._profile_until:
+            if profile is None:
+                profile = local.profile = cProfile.Profile()
+                with self._lock:
+                    local.generation = self._generation
+                    self._profiling += 1
+                profile.enable()
+        elif profile is not None:
+            profile.disable()
+            local.profile = None
+            with self._lock:
+                if local.generation == self._generation:
+                    self._profiles.append(profile)
+                    self._profiling -= 1
+                else:
+                    # Dumped meanwhile
+                    self._stale -= 1
+
+    def _dump_profile(self):
+        # Threads hand their profile over on their next clock(), wait for them as long as the sample lasted
+        deadline = time.monotonic() + self.sample_seconds
+        while self._profiling and time.monotonic() < deadline:
+            time.sleep(0.1)
+        with self._lock:
+            profiles = self._profiles
+            self._profiles = []
+            if self._profiling:
+                logging.warning("%d thread(s) still profiling are left out", self._profiling)
+            # Threads left out turn their profile off on their next clock()
+            self._stale += self._profiling
+            self._profiling = 0
+            self._generation += 1
+        self._profile_until = 0.0
+        if not profiles:
+            logging.warning("Nothing was profiled, no uplink went through the instrumented stages")
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        path = os.path.join(self.output_dir, "profile-%d-%d.prof" % (os.getpid(), time.time()))
+        stats.dump_stats(path)
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats('cumulative').print_stats(20)
+        logging.info("Profile of %d thread(s) written to %s\n%s", len(profiles), path, summary.getvalue())
+
+    def sample_allocations(self):
+        """Trace allocations for sample_seconds"""
+        if tracemalloc.is_tracing():
+            return
+        logging.info("Tracing allocations for %.0fs", self.sample_seconds)
+        tracemalloc.start()
+        self._timer(self.sample_seconds, self._dump_allocations)
+
+    def _dump_allocations(self):
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        top = snapshot.statistics('lineno')[:20]
+        logging.info("Top allocations:\n%s", "\n".join(str(stat) for stat in top))
@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import NamedTuple, Optional
+import wirepas_mesh_messaging as wmm
+import mbproto.mb_protocol_answers_pb2 as mb_answers
+from uplink_decoder import Uplink
+
+
+class ConfigJob(NamedTuple):
+    gateway: str
+    sink: str
+    node: int
+    index: int
+    payload: bytes
+
+
+class ConfigResult(NamedTuple):
+    index: int
+    # 'ack', 'nack', 'timeout' or 'send_failed'
+    status: str
+    attempts: int
+    rtt: float
+
+
+class _InFlight(NamedTuple):
+    job: ConfigJob
+    attempt: int
+    sent: float
+
+
+class Provisioner():
+    """
+    Pushes configuration commands to many nodes with a bounded window.
+
+    ACK frames do not carry the configuration index, so each node has at
+    most one configuration in flight and an ACK or NACK from a node is
+    matched to that configuration. Pipelining happens across nodes: up to
+    window nodes have a request outstanding at any time. Only requests whose
+    ACK times out, or that the gateway refuses, are retried.
+    """
+
+    def __init__(self, wni, window: int = 16, ack_timeout: float = 30.0, retries: int = 2):
+        self.wni = wni
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self._cond = threading.Condition()
+        self._queues: dict[tuple[str, str, int], deque[tuple[ConfigJob, int]]] = {}
+        self._ready: deque[tuple[str, str, int]] = deque()
+        self._in_flight: dict[tuple[str, str, int], _InFlight] = {}
+        self._results: dict[tuple[str, str, int], list[ConfigResult]] = {}
+        self._cancelled = False
+
+    def cancel(self):
+        """Make run() return early, safe to call from a signal handler"""
+        self._cancelled = True
+
+    def awaiting(self, data) -> bool:
+        """True while the node an uplink comes from has a configuration waiting for its ACK"""
+        return (data.gw_id, data.sink_id, int(data.source_address)) in self._in_flight
+
+    def on_uplink(self, data, uplink: Uplink) -> bool:
+        """Match an ACK/NACK uplink to the node's outstanding configuration, return True if it did"""
+        if uplink.ack not in (mb_answers.Acknowladge.ACKNOWLADGE_ACK, mb_answers.Acknowladge.ACKNOWLADGE_NACK):
+            return False
+        node_key = (data.gw_id, data.sink_id, int(data.source_address))
+        with self._cond:
+            in_flight = self._in_flight.pop(node_key, None)
+            if in_flight is None:
+                return False
+            status = "ack" if uplink.ack == mb_answers.Acknowladge.ACKNOWLADGE_ACK else "nack"
+            self._finish(node_key, in_flight, status, time.monotonic())
+            self._cond.notify()
+        return True
+
+    def run(self, jobs: list[ConfigJob]) -> dict[tuple[str, str, int], list[ConfigResult]]:
+        """Push all jobs and block until each one is acknowledged, refused or out of retries"""
+        with self._cond:
+            self._results = {}
+            for job in jobs:
+                node_key = (job.gateway, job.sink, int(job.node))
+                if node_key not in self._queues:
+                    self._queues[node_key] = deque()
+                    self._results[node_key] = []
+                    self._ready.append(node_key)
+                self._queues[node_key].append((job, 1))
+
+            self._cancelled = False
+            while not self._cancelled:
+                now = time.monotonic()
+                self._expire(now)
+                to_send = []
+                while self._ready and len(self._in_flight) < self.window:
+                    node_key = self._ready.popleft()
+                    job, attempt = self._queues[node_key].popleft()
+                    self._in_flight[node_key] = _InFlight(job, attempt, now)
+                    to_send.append(node_key)
+                if to_send:
+                    # send_message with a callback only publishes, it does not wait for the gateway
+                    self._cond.release()
+                    try:
+                        for node_key in to_send:
+                            self._send(node_key)
+                    finally:
+                        self._cond.acquire()
+                    continue
+                if not self._in_flight and not self._ready:
+                    break
+                deadline = min(in_flight.sent for in_flight in self._in_flight.values()) + self.ack_timeout
+                # Bounded wait so that cancel() is noticed
+                self._cond.wait(min(1.0, max(0.0, deadline - now)))
+            self._queues.clear()
+            self._ready.clear()
+            self._in_flight.clear()
+            return self._results
+
+    def _send(self, node_key: tuple[str, str, int]):
+        job = self._in_flight[node_key].job
+        try:
+            self.wni.send_message(job.gateway, job.sink, job.node, 77, 66, job.payload,
+                                  cb=self._on_sent, param=(node_key, job))
+        except TimeoutError:
+            self._on_sent(None, (node_key, job))
+
+    def _on_sent(self, res, param):
+        node_key, job = param
+        if res == wmm.GatewayResultCode.GW_RES_OK:
+            return
+        print("Cannot send data to %s:%s res=%s" % (job.gateway, job.sink, res))
+        with self._cond:
+            in_flight = self._in_flight.get(node_key)
+            if in_flight is None or in_flight.job is not job:
+                return
+            del self._in_flight[node_key]
+            self._retry_or_finish(node_key, in_flight, "send_failed", time.monotonic())
+            self._cond.notify()
+
+    def _expire(self, now: float):
+        for node_key, in_flight in list(self._in_flight.items()):
+            if now - in_flight.sent > self.ack_timeout:
+                del self._in_flight[node_key]
+                logging.warning("No ACK from %s:%s node %s for configuration %d (attempt %d)",
+                                *node_key, in_flight.job.index, in_flight.attempt)
+                self._retry_or_finish(node_key, in_flight, "timeout", now)
+
+    def _retry_or_finish(self, node_key, in_flight: _InFlight, status: str, now: float):
+        if in_flight.attempt <= self.retries:
+            self._queues[node_key].appendleft((in_flight.job, in_flight.attempt + 1))
+            self._ready.append(node_key)
+        else:
+            self._finish(node_key, in_flight, status, now)
+
+    def _finish(self, node_key, in_flight: _InFlight, status: str, now: float):
+        self._results[node_key].append(ConfigResult(in_flight.job.index, status, in_flight.attempt, now - in_flight.sent))
+        if self._queues.get(node_key):
+            self._ready.append(node_key)
+
+
+def log_summary(results: dict[tuple[str, str, int], list[ConfigResult]], expected: Optional[int] = None):
+    for (gateway, sink, node), node_results in sorted(results.items()):
+        acked = [r.index for r in node_results if r.status == "ack"]
+        failed = ["%d:%s" % (r.index, r.status) for r in node_results if r.status != "ack"]
+        retries = sum(r.attempts - 1 for r in node_results)
+        total = expected if expected is not None else len(node_results)
+        log = logging.info if not failed and len(acked) == total else logging.error
+        log("%s:%s node %s: %d/%d configurations acknowledged, %d retries%s",
+            gateway, sink, node, len(acked), total, retries,
+            ", failed " + " ".join(failed) if failed else "")
@@ -0,0 +1,54 @@
+from typing import NamedTuple
+
+# A Modbus read registers request can return at most 125 registers
+MAX_READ_COUNT = 125
+
+
+class RegisterBlock(NamedTuple):
+    address: int
+    count: int
+
+    @property
+    def end(self) -> int:
+        return self.address + self.count
+
+
+class ReadPlan(NamedTuple):
+    address: int
+    count: int
+    blocks: tuple[RegisterBlock, ...]
+
+
+def plan_reads(blocks: list[RegisterBlock] | list[tuple[int, int]],
+               max_gap: int = 0,
+               max_count: int = MAX_READ_COUNT) -> list[ReadPlan]:
+    """
+    Merge wanted register blocks into the fewest reads.
+
+    Blocks are merged when the registers between them number at most
+    max_gap and the merged read stays within max_count registers. The
+    registers in the gaps are read and discarded by split_registers().
+    """
+    plans = []
+    address = end = None
+    members: list[RegisterBlock] = []
+    for block in sorted(RegisterBlock(*b) for b in blocks):
+        if block.count > max_count:
+            raise ValueError("Block at 0x%x reads %d registers, more than %d" % (block.address, block.count, max_count))
+        if members and block.address - end <= max_gap and max(end, block.end) - address <= max_count:
+            end = max(end, block.end)
+            members.append(block)
+            continue
+        if members:
+            plans.append(ReadPlan(address, end - address, tuple(members)))
+        address, end, members = block.address, block.end, [block]
+    if members:
+        plans.append(ReadPlan(address, end - address, tuple(members)))
+    return plans
+
+
+def split_registers(plan: ReadPlan, registers: tuple[int, ...] | list[int]) -> dict[RegisterBlock, tuple[int, ...]]:
+    """Split the registers returned for a merged read back into the wanted blocks"""
+    if len(registers) != plan.count:
+        raise ValueError("Expected %d registers, got %d" % (plan.count, len(registers)))
+    return {block: tuple(registers[block.address - plan.address:block.end - plan.address]) for block in plan.blocks}
@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import ssl
+import threading
+import time
+from collections import deque
+from typing import NamedTuple, Optional
+
+
+class Reading(NamedTuple):
+    gateway: str
+    sink: str
+    node: int
+    name: str
+    value: float
+    unit: str
+    # Gateway reception time [ms since epoch]
+    timestamp: int
+
+
+def encode_batch(readings: list[Reading], columnar: bool = False) -> bytes:
+    """JSON array of reading objects, or one object of columns when columnar"""
+    if columnar:
+        return json.dumps({field: [getattr(r, field) for r in readings] for field in Reading._fields},
+                          separators=(',', ':')).encode()
+    return json.dumps([r._asdict() for r in readings], separators=(',', ':')).encode()
+
+
+# paho.mqtt.client result codes, not imported unless publishing to MQTT
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+
+
+class MqttSink():
+    """
+    Publishes batches to one topic over a single MQTT connection kept for the
+    sink's lifetime. A batch paho does not take, e.g. because max_queued
+    messages already wait for the broker, fails the write and is counted in
+    failed, so that the Republisher buffer limit applies while the broker is
+    down.
+    """
+
+    def __init__(self, client, topic: str, qos: int = 1):
+        self.client = client
+        self.topic = topic
+        self.qos = qos
+        self.failed = 0
+        self._last = None
+
+    @classmethod
+    def connect(cls, host: str, port: int, username: str, password: str, topic: str,
+                insecure: bool = False, qos: int = 1, max_queued: int = 100) -> "MqttSink":
+        import paho.mqtt.client as mqtt
+
+        client = mqtt.Client()
+        if not insecure:
+            client.tls_set(cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLSv1_2)
+        client.username_pw_set(username, password)
+        client.max_queued_messages_set(max_queued)
+        # The network loop reconnects and sends queued messages in the background
+        client.connect_async(host, port)
+        client.loop_start()
+        return cls(client, topic, qos)
+
+    def write(self, batch: list[Reading], columnar: bool):
+        info = self.client.publish(self.topic, encode_batch(batch, columnar), qos=self.qos)
+        # With QoS 1 or 2, paho keeps a message published while disconnected and sends it once connected
+        if info.rc == MQTT_ERR_SUCCESS or (info.rc == MQTT_ERR_NO_CONN and self.qos > 0):
+            self._last = info
+            return
+        self.failed += 1
+        raise ConnectionError("publish to %s failed with rc %d" % (self.topic, info.rc))
+
+    def close(self, timeout: float = 5.0):
+        """Wait up to timeout for the queued batches to be published, then disconnect"""
+        deadline = time.monotonic() + timeout
+        while self._last is not None and not self._last.is_published() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.client.disconnect()
+        self.client.loop_stop()
+        if self.failed:
+            logging.warning("%d publishes to %s failed", self.failed, self.topic)
+
+
+class JsonLinesSink():
+    """Appends one JSON line per batch, rotating to path.1 ... path.<backups> past max_bytes"""
+
+    def __init__(self, path: str, max_bytes: int = 64 << 20, backups: int = 5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._file = open(path, "ab")
+
+    def write(self, batch: list[Reading], columnar: bool):
+        self._file.write(encode_batch(batch, columnar) + b"\n")
+        self._file.flush()
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.path, i)):
+                os.replace("%s.%d" % (self.path, i), "%s.%d" % (self.path, i + 1))
+        if self.backups:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, "ab")
+
+    def close(self):
+        self._file.close()
+
+
+class Republisher():
+    """
+    Batches decoded readings towards an output sink.
+
+    publish() only appends to an in-memory buffer. A flusher thread writes
+    a batch once max_batch readings are buffered or the oldest one has
+    waited max_delay seconds. The buffer holds at most max_buffer readings;
+    when the sink cannot keep up the oldest readings are dropped and counted.
+    A batch the sink fails to write goes back to the buffer and is retried
+    after retry_delay seconds, until stop() when it is counted as failed.
+    """
+
+    def __init__(self, sink, max_batch: int = 500, max_delay: float = 5.0, max_buffer: int = 100000,
+                 columnar: bool = False, retry_delay: float = 1.0):
+        self.sink = sink
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_buffer = max_buffer
+        self.columnar = columnar
+        self.retry_delay = retry_delay
+        self.published = 0
+        self.batches = 0
+        self.dropped = 0
+        self.failed = 0
+        self._buffer: deque[Reading] = deque()
+        self._oldest = 0.0
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    def publish(self, readings: list[Reading]):
+        with self._cond:
+            if not self._buffer:
+                self._oldest = time.monotonic()
+                # Start the flusher's max_delay countdown
+                self._cond.notify()
+            self._buffer.extend(readings)
+            overflow = len(self._buffer) - self.max_buffer
+            if overflow > 0:
+                for _ in range(overflow):
+                    self._buffer.popleft()
+                self.dropped += overflow
+            if len(self._buffer) >= self.max_batch:
+                self._cond.notify()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="republisher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Flush what is buffered and close the sink"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.sink.close()
+        logging.info("Republished %d readings in %d batches, %d dropped, %d failed",
+                     self.published, self.batches, self.dropped, self.failed)
+
+    def _next_batch(self) -> list[Reading]:
+        with self._cond:
+            while self._running and len(self._buffer) < self.max_batch:
+                if self._buffer:
+                    remaining = self._oldest + self.max_delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+            batch = [self._buffer.popleft() for _ in range(min(self.max_batch, len(self._buffer)))]
+            self._oldest = time.monotonic()
+            return batch
+
+    def _retry(self, batch: list[Reading]) -> bool:
+        """Put a failed batch back in front of the buffer and wait a bit, False once stopping"""
+        with self._cond:
+            if not self._running:
+                return False
+            self._buffer.extendleft(reversed(batch))
+            # The retried readings are the oldest ones, they go first when the buffer overflows
+            overflow = len(self._buffer) - self.max_buffer
+            if overflow > 0:
+                for _ in range(overflow):
+                    self._buffer.popleft()
+                self.dropped += overflow
+            # Readings keep coming in meanwhile, do not let their notifications shorten the wait
+            deadline = time.monotonic() + self.retry_delay
+            while self._running and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return True
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            try:
+                self.sink.write(batch, self.columnar)
+            except Exception as e:
+                if not self._retry(batch):
+                    logging.error("Cannot republish %d readings: %s", len(batch), e)
+                    self.failed += len(batch)
+                continue
+            self.published += len(batch)
+            self.batches += 1
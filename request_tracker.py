@@ -0,0 +1,280 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple, Optional
+import mbproto.mb_protocol_pb2 as mb_protocol
+from uplink_decoder import Uplink
+
+# Round-trip buckets in seconds, sized for multi-hop mesh latencies
+RTT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 60.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class RequestKey(NamedTuple):
+    gateway: str
+    sink: str
+    node: int
+    cmd: int
+    # Modbus function code for one-shot requests, 0 for commands answered by an ACK or a frame of their own
+    index: int
+
+
+def request_key(gateway: str, sink: str, node: int, payload: bytes) -> RequestKey:
+    """Build the key of a request from the payload passed to send_message"""
+    msg = mb_protocol.MbMessage()
+    msg.ParseFromString(payload[:-2])
+    index = 0
+    if msg.cmd == mb_protocol.Cmd.CMD_MODBUS_ONE_SHOT:
+        modbus_frame = msg.payload.payload_cmd_frame.modbus_one_shot_frame.modbus_frame
+        index = modbus_frame[1] if len(modbus_frame) > 1 else 0
+    return RequestKey(gateway, sink, int(node), msg.cmd, index)
+
+
+def uplink_key(gateway: str, sink: str, node: int, uplink: Uplink) -> Optional[RequestKey]:
+    """Build the key of the request an uplink answers, None for unsolicited periodic reports"""
+    if uplink.modbus is not None:
+        if uplink.cmd == mb_protocol.Cmd.CMD_MODBUS_PERIODICAL:
+            return None
+        return RequestKey(gateway, sink, int(node), uplink.cmd, uplink.modbus.function_code & 0x7F)
+    return RequestKey(gateway, sink, int(node), uplink.cmd, 0)
+
+
+class Histogram():
+    def __init__(self, buckets: tuple[float, ...] = RTT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by linear interpolation inside its bucket"""
+        if self.count == 0:
+            return float('nan')
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class _Stats():
+    def __init__(self):
+        self.rtt = Histogram()
+        self.sent = 0
+        self.answered = 0
+        self.lost = 0
+
+
+class RequestTracker():
+    """
+    In-flight request table linking uplink answers to the send_message that
+    caused them.
+
+    Requests with the same key are answered in order, so several requests of
+    one kind can be in flight per node. Requests left unanswered for longer
+    than timeout are counted as lost.
+    """
+
+    def __init__(self, timeout: float = 30.0):
+        self.timeout = timeout
+        self.unmatched = 0
+        self._last_expire = 0.0
+        self._in_flight: dict[RequestKey, deque[float]] = defaultdict(deque)
+        self._nodes: dict[tuple[str, str, int], _Stats] = defaultdict(_Stats)
+        self._gateways: dict[str, _Stats] = defaultdict(_Stats)
+        self._lock = threading.Lock()
+
+    def sent(self, key: RequestKey, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._in_flight[key].append(now)
+            self._nodes[(key.gateway, key.sink, key.node)].sent += 1
+            self._gateways[key.gateway].sent += 1
+
+    def cancel(self, key: RequestKey):
+        """Forget the newest request for key, e.g. when the gateway refused it"""
+        with self._lock:
+            pending = self._in_flight.get(key)
+            if pending:
+                pending.pop()
+                self._nodes[(key.gateway, key.sink, key.node)].sent -= 1
+                self._gateways[key.gateway].sent -= 1
+
+    def received(self, key: Optional[RequestKey], now: Optional[float] = None) -> Optional[float]:
+        """Match an answer to the oldest pending request and return its round-trip time"""
+        if key is None:
+            return None
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            # Sweeping the whole table on every answer would be O(n) per uplink
+            if now - self._last_expire > 1.0:
+                self._expire(now)
+            pending = self._in_flight.get(key)
+            if not pending:
+                self.unmatched += 1
+                return None
+            rtt = now - pending.popleft()
+            if not pending:
+                del self._in_flight[key]
+            for stats in (self._nodes[(key.gateway, key.sink, key.node)], self._gateways[key.gateway]):
+                stats.answered += 1
+                stats.rtt.observe(rtt)
+            return rtt
+
+    def expire(self, now: Optional[float] = None) -> int:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return self._expire(now)
+
+    def _expire(self, now: float) -> int:
+        self._last_expire = now
+        lost = 0
+        for key in list(self._in_flight):
+            pending = self._in_flight[key]
+            while pending and now - pending[0] > self.timeout:
+                pending.popleft()
+                self._nodes[(key.gateway, key.sink, key.node)].lost += 1
+                self._gateways[key.gateway].lost += 1
+                lost += 1
+            if not pending:
+                del self._in_flight[key]
+        return lost
+
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return sum(len(pending) for pending in self._in_flight.values())
+
+    def totals(self) -> _Stats:
+        """Counters and round-trip time histogram summed over all gateways"""
+        total = _Stats()
+        with self._lock:
+            for stats in self._gateways.values():
+                total.sent += stats.sent
+                total.answered += stats.answered
+                total.lost += stats.lost
+                total.rtt.count += stats.rtt.count
+                total.rtt.sum += stats.rtt.sum
+                total.rtt.counts = [a + b for a, b in zip(total.rtt.counts, stats.rtt.counts)]
+        return total
+
+    def prometheus(self) -> str:
+        """Render the counters and histograms in Prometheus text exposition format"""
+        self.expire()
+        lines = []
+        with self._lock:
+            nodes = [({"gateway": gw, "sink": sink, "node": str(node)}, stats)
+                     for (gw, sink, node), stats in sorted(self._nodes.items())]
+            gateways = [({"gateway": gw}, stats) for gw, stats in sorted(self._gateways.items())]
+            for scope, series in (("node", nodes), ("gateway", gateways)):
+                prefix = "wmb_%s_requests" % scope
+                for field, help_text in (("sent", "Requests sent"),
+                                         ("answered", "Requests matched to an answer"),
+                                         ("lost", "Requests not answered within the timeout")):
+                    lines.append("# HELP %s_%s_total %s" % (prefix, field, help_text))
+                    lines.append("# TYPE %s_%s_total counter" % (prefix, field))
+                    for labels, stats in series:
+                        lines.append("%s_%s_total{%s} %d" % (prefix, field, _labels(labels), getattr(stats, field)))
+                name = "wmb_%s_rtt_seconds" % scope
+                lines.append("# HELP %s Request round-trip time through the mesh" % name)
+                lines.append("# TYPE %s histogram" % name)
+                for labels, stats in series:
+                    cumulative = 0
+                    for bound, n in zip(stats.rtt.buckets + (float('inf'),), stats.rtt.counts):
+                        cumulative += n
+                        le = "+Inf" if bound == float('inf') else repr(bound)
+                        lines.append("%s_bucket{%s} %d" % (name, _labels(dict(labels, le=le)), cumulative))
+                    lines.append("%s_sum{%s} %f" % (name, _labels(labels), stats.rtt.sum))
+                    lines.append("%s_count{%s} %d" % (name, _labels(labels), stats.rtt.count))
+                lines.append("# HELP %s_quantile Round-trip time quantiles estimated from the histogram" % name)
+                lines.append("# TYPE %s_quantile gauge" % name)
+                for labels, stats in series:
+                    for q in QUANTILES:
+                        value = stats.rtt.quantile(q)
+                        lines.append("%s_quantile{%s} %s" % (name, _labels(dict(labels, quantile=str(q))),
+                                                             "NaN" if value != value else "%f" % value))
+            lines.append("# HELP wmb_unmatched_answers_total Answers without a pending request")
+            lines.append("# TYPE wmb_unmatched_answers_total counter")
+            lines.append("wmb_unmatched_answers_total %d" % self.unmatched)
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        # Write to a temporary file first so node_exporter never reads a partial file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+def _labels(labels: dict[str, str]) -> str:
+    return ",".join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items())
+
+
+class MetricsExporter():
+    """Publishes tracker metrics to a textfile every interval and/or over HTTP on /metrics"""
+
+    def __init__(self, tracker: RequestTracker, path: Optional[str] = None, http_port: Optional[int] = None,
+                 interval: float = 15.0):
+        self.tracker = tracker
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._server = None
+        if http_port is not None:
+            self._server = ThreadingHTTPServer(("", http_port), self._handler())
+
+    def _handler(self):
+        tracker = self.tracker
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = tracker.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+    def start(self):
+        if self._server is not None:
+            threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        if self.path is not None:
+            self._thread = threading.Thread(target=self._run, name="metrics-file", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.tracker.write_prometheus(self.path)
+            except OSError as e:
+                logging.error("Cannot write metrics to %s: %s", self.path, e)
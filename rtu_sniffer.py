@@ -0,0 +1,310 @@
+import logging
+import re
+import sys
+import threading
+from typing import NamedTuple, Optional
+from request_tracker import Histogram
+from uplink_decoder import (FC_READ_COILS, FC_READ_DISCRETE_INPUTS, FC_READ_HOLDING_REGISTERS, FC_READ_INPUT_REGISTERS,
+                            FC_WRITE_SINGLE_COIL, FC_WRITE_SINGLE_REGISTER, FC_WRITE_MULTIPLE_COILS,
+                            FC_WRITE_MULTIPLE_REGISTERS)
+
+READ_FCS = (FC_READ_COILS, FC_READ_DISCRETE_INPUTS, FC_READ_HOLDING_REGISTERS, FC_READ_INPUT_REGISTERS)
+WRITE_SINGLE_FCS = (FC_WRITE_SINGLE_COIL, FC_WRITE_SINGLE_REGISTER)
+WRITE_MULTIPLE_FCS = (FC_WRITE_MULTIPLE_COILS, FC_WRITE_MULTIPLE_REGISTERS)
+BIT_FCS = (FC_READ_COILS, FC_READ_DISCRETE_INPUTS, FC_WRITE_MULTIPLE_COILS)
+# Longest RTU frame: write multiple with 255 data bytes
+MAX_FRAME = 9 + 255
+# Highest unicast slave address
+MAX_SLAVE = 247
+# Most bits and registers a request may read or write
+MAX_BITS = 2000
+MAX_REGISTERS = 125
+# Most data bytes a read response may carry
+MAX_BYTE_COUNT = 2 * MAX_REGISTERS
+EXCEPTION_CODES = frozenset((1, 2, 3, 4, 5, 6, 8, 10, 11))
+FCS = READ_FCS + WRITE_SINGLE_FCS + WRITE_MULTIPLE_FCS
+# Offsets where a frame may start: a slave address followed by a known function code or its exception
+_FRAME_START = re.compile(b"[\\x00-\\x%02x](?=[%s])" % (
+    MAX_SLAVE, b"".join(b"\\x%02x" % fc for fc in FCS + tuple(fc | 0x80 for fc in FCS))), re.DOTALL)
+# Time between the uplinks carrying a request and its response [s]
+UPLINK_GAP_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+
+def _crc16_modbus_table() -> tuple[int, ...]:
+    # CRC-16/MODBUS: reflected poly 0xa001, init 0xffff, sent low byte first
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+_CRC16_MODBUS_TABLE = _crc16_modbus_table()
+
+
+def _crc16_modbus_word_table() -> list[int]:
+    # The register xored with a little-endian data word, shifted through its 16 bits
+    table = _CRC16_MODBUS_TABLE
+    half = [(word >> 8) ^ table[word & 0xFF] for word in range(0x10000)]
+    return [(crc >> 8) ^ table[crc & 0xFF] for crc in half]
+
+
+# Two bytes per lookup, 64K entries; the words are read in native order
+_CRC16_MODBUS_WORD_TABLE = _crc16_modbus_word_table() if sys.byteorder == "little" else None
+
+
+def crc16_modbus(data: bytes | bytearray | memoryview, start: int = 0, end: Optional[int] = None) -> int:
+    """CRC of data[start:end], long ones read in place two bytes at a time"""
+    if end is None:
+        end = len(data)
+    crc = 0xFFFF
+    words = _CRC16_MODBUS_WORD_TABLE
+    # Short frames are quicker byte by byte over a copy than through a memoryview
+    if words is not None and end - start >= 16:
+        odd = (end - start) & 1
+        with memoryview(data) as view:
+            for word in view[start:end - odd].cast('H'):
+                crc = words[crc ^ word]
+        if not odd:
+            return crc
+        start = end - 1
+    table = _CRC16_MODBUS_TABLE
+    for byte in data[start:end]:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class RtuFrame(NamedTuple):
+    slave: int
+    function_code: int
+    is_request: bool
+    frame: bytes
+
+
+def _valid_byte_count(function_code: int, byte_count: int) -> bool:
+    if not 0 < byte_count <= MAX_BYTE_COUNT:
+        return False
+    return function_code in BIT_FCS or byte_count % 2 == 0
+
+
+def _plausible(buf: bytearray, i: int, length: int, is_request: bool) -> bool:
+    """Check the fields of a candidate frame, so that most misaligned offsets are rejected without a CRC"""
+    function_code = buf[i + 1]
+    if function_code & 0x80:
+        return buf[i + 2] in EXCEPTION_CODES
+    limit = MAX_BITS if function_code in BIT_FCS else MAX_REGISTERS
+    if function_code in READ_FCS:
+        if is_request:
+            return 1 <= (buf[i + 4] << 8 | buf[i + 5]) <= limit
+        return _valid_byte_count(function_code, buf[i + 2])
+    if function_code == FC_WRITE_SINGLE_COIL:
+        return buf[i + 5] == 0 and buf[i + 4] in (0x00, 0xFF)
+    if function_code in WRITE_MULTIPLE_FCS:
+        quantity = buf[i + 4] << 8 | buf[i + 5]
+        if not 1 <= quantity <= limit:
+            return False
+        return not is_request or buf[i + 6] == ((quantity + 7) // 8 if limit == MAX_BITS else 2 * quantity)
+    return True
+
+
+class RtuStreamParser():
+    """
+    Splits the bytes sniffed on one RS-485 bus into RTU frames.
+
+    Sniffed data carries no inter-frame silence, so the frame length is
+    inferred from the function code and confirmed by the CRC. Reads are 8
+    byte requests or byte-count-sized responses; which one is tried first
+    depends on whether a request to that slave is waiting for its answer.
+    The slave address, quantities and byte counts are checked before the
+    CRC, which is only computed for candidates that pass. Bytes that start
+    no valid frame are skipped up to the next offset holding a slave
+    address and a known function code, searched for with a regex.
+    """
+
+    def __init__(self):
+        self.garbage = 0
+        self._buffer = bytearray()
+        # (slave, function code) of the request waiting for its response
+        self.pending: Optional[tuple[int, int]] = None
+
+    def reset(self):
+        self.garbage += len(self._buffer)
+        self._buffer.clear()
+        self.pending = None
+
+    def _candidates(self, buf: bytearray, i: int, n: int) -> list[tuple[Optional[int], bool]]:
+        """(frame length or None if not known yet, is request) pairs to try at offset i"""
+        if buf[i] > MAX_SLAVE:
+            return []
+        function_code = buf[i + 1]
+        answering = self.pending == (buf[i], function_code & 0x7F)
+        if function_code & 0x80:
+            return [(5, False)] if (function_code & 0x7F) in FCS else []
+        if function_code in READ_FCS:
+            if n - i <= 2:
+                response = (None, False)
+            elif _valid_byte_count(function_code, buf[i + 2]):
+                response = (5 + buf[i + 2], False)
+            else:
+                # Do not wait for the rest of a response that cannot be one
+                return [(8, True)]
+            return [response, (8, True)] if answering else [(8, True), response]
+        if function_code in WRITE_SINGLE_FCS:
+            # The response echoes the request
+            return [(8, not answering)]
+        if function_code in WRITE_MULTIPLE_FCS:
+            request = (9 + buf[i + 6] if n - i > 6 else None, True)
+            return [(8, False), request] if answering else [request, (8, False)]
+        return []
+
+    def feed(self, data: bytes) -> list[RtuFrame]:
+        buf = self._buffer
+        buf += data
+        n = len(buf)
+        i = 0
+        frames = []
+        while n - i >= 5:
+            need_more = False
+            matched = None
+            for length, is_request in self._candidates(buf, i, n):
+                if length is None or i + length > n:
+                    need_more = True
+                    continue
+                if (_plausible(buf, i, length, is_request)
+                        and crc16_modbus(buf, i, i + length - 2) == buf[i + length - 2] | (buf[i + length - 1] << 8)):
+                    matched = (length, is_request)
+                    break
+            if matched is not None:
+                length, is_request = matched
+                slave = buf[i]
+                function_code = buf[i + 1]
+                frames.append(RtuFrame(slave, function_code, is_request, bytes(buf[i:i + length])))
+                self.pending = (slave, function_code) if is_request else None
+                i += length
+            elif need_more and n - i < MAX_FRAME:
+                break
+            else:
+                match = _FRAME_START.search(buf, i + 1)
+                # The last byte may be the slave address of a frame still to come
+                skip_to = match.start() if match is not None else max(i + 1, n - 1)
+                self.garbage += skip_to - i
+                i = skip_to
+        del buf[:i]
+        return frames
+
+
+class SlaveStats():
+    def __init__(self):
+        self.requests = 0
+        self.responses = 0
+        self.exceptions = 0
+        self.unanswered = 0
+        # Paired in one uplink, their bus timing is unknown
+        self.same_uplink = 0
+        self.uplink_gap = Histogram(UPLINK_GAP_BUCKETS)
+
+
+class ModbusSniffer():
+    """
+    Pairs sniffed requests and responses of many buses and keeps statistics
+    per (slave, function code).
+
+    Each bus, e.g. (gateway, sink, node, port), has its own RtuStreamParser.
+    A response is paired with the request the parser saw just before it; a
+    request followed by another request counts as unanswered. At most
+    max_streams buses and max_keys (slave, function code) pairs are
+    tracked, frames beyond are only counted in `untracked`.
+
+    Sniffed data carries no bus timing: the only delay measured is the gap
+    between the reception times of the uplinks that carried a request and
+    its response, which is not the slave's response time. Pairs carried by
+    the same uplink are counted in same_uplink instead.
+    """
+
+    def __init__(self, max_streams: int = 10000, max_keys: int = 4096, stale: float = 1.0):
+        self.max_streams = max_streams
+        self.max_keys = max_keys
+        self.stale = stale
+        self.frames = 0
+        self.untracked = 0
+        self.chunks = 0
+        self.stats: dict[tuple[int, int], SlaveStats] = {}
+        self._streams: dict[tuple, tuple[RtuStreamParser, list]] = {}
+        self._lock = threading.Lock()
+
+    def feed(self, stream: tuple, data: bytes, timestamp: float) -> list[RtuFrame]:
+        """Parse the bytes sniffed on a bus at timestamp [s] and update the statistics"""
+        with self._lock:
+            entry = self._streams.get(stream)
+            if entry is None:
+                if len(self._streams) >= self.max_streams:
+                    self.untracked += 1
+                    return []
+                # Parser, [time of the last chunk, ((slave, function code), time, chunk) of the pending request]
+                entry = self._streams[stream] = (RtuStreamParser(), [timestamp, None])
+            parser, times = entry
+            if timestamp - times[0] > self.stale:
+                # A partial frame left from a previous burst will never complete
+                parser.reset()
+            times[0] = timestamp
+            self.chunks += 1
+            frames = parser.feed(data)
+            for frame in frames:
+                self._count(frame, times, timestamp, self.chunks)
+            self.frames += len(frames)
+            return frames
+
+    def _count(self, frame: RtuFrame, times: list, timestamp: float, chunk: int):
+        key = (frame.slave, frame.function_code & 0x7F)
+        pending = times[1]
+        if frame.is_request:
+            if pending is not None and pending[0] in self.stats:
+                self.stats[pending[0]].unanswered += 1
+            times[1] = (key, timestamp, chunk)
+        elif pending is not None and pending[0] == key:
+            times[1] = None
+        stats = self.stats.get(key)
+        if stats is None:
+            if len(self.stats) >= self.max_keys:
+                self.untracked += 1
+                return
+            stats = self.stats[key] = SlaveStats()
+        if frame.is_request:
+            stats.requests += 1
+            return
+        stats.responses += 1
+        if frame.function_code & 0x80:
+            stats.exceptions += 1
+        if pending is not None and pending[0] == key:
+            if pending[2] == chunk:
+                stats.same_uplink += 1
+            else:
+                stats.uplink_gap.observe(timestamp - pending[1])
+
+    @property
+    def garbage(self) -> int:
+        with self._lock:
+            return self._garbage()
+
+    def _garbage(self) -> int:
+        return sum(parser.garbage for parser, _ in self._streams.values())
+
+    def log_stats(self, reset: bool = False):
+        """Log the statistics, with reset start a new interval so that each log covers only its own"""
+        with self._lock:
+            stats = sorted(self.stats.items())
+            counters = (self.frames, len(self._streams), self._garbage(), self.untracked)
+            if reset:
+                self.stats = {}
+                self.frames = 0
+                self.untracked = 0
+                for parser, _ in self._streams.values():
+                    parser.garbage = 0
+        logging.info("Sniffed %d frames on %d buses, %d bytes skipped, %d frames untracked", *counters)
+        for (slave, function_code), s in stats:
+            logging.info("slave %d function 0x%02x: %d requests, %d responses, %d exceptions, %d unanswered, "
+                         "%d paired in one uplink, uplink gap p50 %.3fs p99 %.3fs", slave, function_code,
+                         s.requests, s.responses, s.exceptions, s.unanswered, s.same_uplink,
+                         s.uplink_gap.quantile(0.5), s.uplink_gap.quantile(0.99))
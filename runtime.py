@@ -0,0 +1,92 @@
+import logging
+import signal
+import threading
+from typing import Callable, Optional
+
+
+class Runtime():
+    """
+    Keeps an entry point alive without spinning a CPU core.
+
+    The main thread blocks on an event that is set on SIGINT/SIGTERM, by
+    stop(), or once the number of responses given to expect() has arrived.
+    On the way out the registered cleanups run in reverse order and the
+    WirepasNetworkInterface is closed.
+    """
+
+    def __init__(self, wni=None):
+        self.wni = wni
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._expected: Optional[int] = None
+        self._cleanups: list[Callable[[], None]] = []
+        self._stop_hooks: list[Callable[[], None]] = []
+
+    def install_signal_handlers(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        logging.info("Received %s, exiting", signal.Signals(signum).name)
+        self.stop()
+
+    def on_shutdown(self, cleanup: Callable[[], None]):
+        self._cleanups.append(cleanup)
+
+    def on_stop(self, hook: Callable[[], None]):
+        """Call hook as soon as a stop is requested, e.g. to interrupt work blocking the main thread"""
+        self._stop_hooks.append(hook)
+
+    def expect(self, count: int):
+        """Stop once count more calls to response_received() have been made"""
+        with self._lock:
+            self._expected = count
+        if count <= 0:
+            self.stop()
+
+    def response_received(self):
+        with self._lock:
+            if self._expected is None:
+                return
+            self._expected -= 1
+            done = self._expected <= 0
+        if done:
+            self.stop()
+
+    def stop(self):
+        self._stop_event.set()
+        for hook in self._stop_hooks:
+            hook()
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop_event.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Sleep up to timeout seconds, return True if the runtime is stopping"""
+        return self._stop_event.wait(timeout)
+
+    def run(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until stopped or timeout seconds have passed, then shut down.
+
+        Returns True if the runtime was stopped, False on timeout.
+        """
+        self.install_signal_handlers()
+        stopped = self.wait(timeout)
+        if not stopped:
+            logging.warning("Timed out after %gs", timeout)
+        self.shutdown()
+        return stopped
+
+    def shutdown(self):
+        self._stop_event.set()
+        while self._cleanups:
+            cleanup = self._cleanups.pop()
+            try:
+                cleanup()
+            except Exception as e:
+                logging.error("Cleanup failed: %s", e)
+        if self.wni is not None:
+            self.wni.close()
+            self.wni = None
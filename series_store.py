@@ -0,0 +1,242 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import NamedTuple, Optional
+
+_MAGIC = b"WMBS"
+_VERSION = 1
+# magic, version, capacity, names, max nodes; padded so that the arrays stay 8-byte aligned
+_HEADER = struct.Struct("<4sIIII")
+_HEADER_SIZE = 64
+
+
+class WindowStats(NamedTuple):
+    count: int
+    min: float
+    max: float
+    mean: float
+
+
+class SeriesStore():
+    """
+    Last capacity samples of every (node, register) series in fixed-size rings.
+
+    All series share one flat buffer: a uint32 head and count per series, then
+    the timestamps and the values of every series as doubles, capacity slots
+    each at series * capacity. Series are numbered like DeadbandFilter slots,
+    node slot * len(names) + register index, so storing a sample allocates no
+    Python objects.
+
+    The buffer is sized for max_nodes nodes up front. With path it is a
+    memory-mapped file and the node keys are appended to path + ".nodes",
+    so a restarted process reopening the same file keeps the history.
+    Samples of nodes beyond max_nodes are only counted in `untracked`.
+
+    Queries look samples up by time, so each series only takes samples in
+    time order: a sample older than the newest one of its series is
+    dropped and counted in `out_of_order`.
+    """
+
+    def __init__(self,
+                 names: list[str] | tuple[str, ...],
+                 capacity: int = 360,
+                 max_nodes: int = 1000,
+                 path: Optional[str] = None):
+        self.names = tuple(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.capacity = capacity
+        self.max_nodes = max_nodes
+        self.path = path
+        self.untracked = 0
+        self.out_of_order = 0
+        self._slots: dict[tuple[str, str, int], int] = {}
+        self._lock = threading.Lock()
+        series = max_nodes * len(self.names)
+        size = _HEADER_SIZE + series * 8 + 2 * series * capacity * 8
+        self._file = None
+        self._nodes_file = None
+        if path is None:
+            self._buffer = bytearray(size)
+        else:
+            self._buffer = self._open(path, size)
+        _HEADER.pack_into(self._buffer, 0, _MAGIC, _VERSION, capacity, len(self.names), max_nodes)
+        self._view = view = memoryview(self._buffer)
+        offset = _HEADER_SIZE
+        self._heads = view[offset:offset + series * 4].cast('I')
+        offset += series * 4
+        self._counts = view[offset:offset + series * 4].cast('I')
+        offset += series * 4
+        self._times = view[offset:offset + series * capacity * 8].cast('d')
+        offset += series * capacity * 8
+        self._values = view[offset:offset + series * capacity * 8].cast('d')
+
+    def _open(self, path: str, size: int) -> mmap.mmap:
+        nodes_path = path + ".nodes"
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self._file = open(path, "r+b" if exists else "w+b")
+        if exists:
+            header = _HEADER.unpack(self._file.read(_HEADER.size))
+            if header != (_MAGIC, _VERSION, self.capacity, len(self.names), self.max_nodes):
+                self._file.close()
+                raise ValueError("%s was written with another layout, remove it or use the same settings" % path)
+            try:
+                with open(nodes_path) as f:
+                    lines = f.read().splitlines()
+            except OSError as e:
+                self._file.close()
+                raise ValueError("Cannot read the node list of %s: %s" % (path, e))
+            if not lines or lines[0] != ",".join(self.names):
+                self._file.close()
+                raise ValueError("%s was written for other registers" % path)
+            for line in lines[1:]:
+                gateway, sink, node = line.rsplit(",", 2)
+                self._slots[(gateway, sink, int(node))] = len(self._slots)
+        else:
+            self._file.truncate(size)
+            with open(nodes_path, "w") as f:
+                f.write(",".join(self.names) + "\n")
+        self._nodes_file = open(nodes_path, "a")
+        return mmap.mmap(self._file.fileno(), size)
+
+    def _slot(self, node_key: tuple[str, str, int]) -> Optional[int]:
+        slot = self._slots.get(node_key)
+        if slot is None:
+            if len(self._slots) >= self.max_nodes:
+                return None
+            slot = self._slots[node_key] = len(self._slots)
+            if self._nodes_file is not None:
+                self._nodes_file.write("%s,%s,%d\n" % node_key)
+                self._nodes_file.flush()
+        return slot
+
+    def _series(self, node_key: tuple[str, str, int], name: str) -> Optional[int]:
+        slot = self._slots.get(node_key)
+        if slot is None:
+            return None
+        return slot * len(self.names) + self.index[name]
+
+    def append(self, node_key: tuple[str, str, int], values: dict[str, float], timestamp: float):
+        """Store the values read from a node at timestamp [s since the epoch]"""
+        capacity = self.capacity
+        with self._lock:
+            slot = self._slot(node_key)
+            if slot is None:
+                self.untracked += len(values)
+                return
+            base = slot * len(self.names)
+            for name, value in values.items():
+                i = self.index.get(name)
+                if i is None:
+                    continue
+                series = base + i
+                head = self._heads[series]
+                if self._counts[series] and timestamp < self._times[series * capacity + (head - 1) % capacity]:
+                    # Older than the newest sample, _window() relies on time order
+                    self.out_of_order += 1
+                    continue
+                self._times[series * capacity + head] = timestamp
+                self._values[series * capacity + head] = value
+                self._heads[series] = head + 1 if head + 1 < capacity else 0
+                if self._counts[series] < capacity:
+                    self._counts[series] += 1
+
+    def _window(self, series: int, seconds: Optional[float], now: Optional[float]) -> list[tuple[int, int]]:
+        """[start, end) index ranges of the samples in the window, oldest first"""
+        capacity = self.capacity
+        base = series * capacity
+        head = self._heads[series]
+        if self._counts[series] < capacity:
+            ranges = [(base, base + head)]
+        else:
+            ranges = [(base + head, base + capacity), (base, base + head)]
+        if seconds is None:
+            return [r for r in ranges if r[0] < r[1]]
+        since = (time.time() if now is None else now) - seconds
+        window = []
+        for start, end in ranges:
+            # Each range holds samples in time order, skip the ones older than the window
+            start = bisect.bisect_left(self._times, since, start, end)
+            if start < end:
+                window.append((start, end))
+        return window
+
+    def latest(self, node_key: tuple[str, str, int], name: str) -> Optional[tuple[float, float]]:
+        """(timestamp, value) of the newest sample"""
+        with self._lock:
+            series = self._series(node_key, name)
+            if series is None or not self._counts[series]:
+                return None
+            i = series * self.capacity + (self._heads[series] - 1) % self.capacity
+            return self._times[i], self._values[i]
+
+    def samples(self, node_key: tuple[str, str, int], name: str, seconds: Optional[float] = None,
+                now: Optional[float] = None) -> tuple[list[float], list[float]]:
+        """Timestamps and values of the samples of the last seconds (all by default), oldest first"""
+        with self._lock:
+            series = self._series(node_key, name)
+            if series is None:
+                return [], []
+            ranges = self._window(series, seconds, now)
+            return ([t for start, end in ranges for t in self._times[start:end]],
+                    [v for start, end in ranges for v in self._values[start:end]])
+
+    def stats(self, node_key: tuple[str, str, int], name: str, seconds: Optional[float] = None,
+              now: Optional[float] = None) -> Optional[WindowStats]:
+        """Count, min, max and mean of the samples of the last seconds (all by default)"""
+        with self._lock:
+            series = self._series(node_key, name)
+            if series is None:
+                return None
+            ranges = self._window(series, seconds, now)
+            if not ranges:
+                return None
+            count = sum(end - start for start, end in ranges)
+            return WindowStats(count,
+                               min(min(self._values[start:end]) for start, end in ranges),
+                               max(max(self._values[start:end]) for start, end in ranges),
+                               sum(sum(self._values[start:end]) for start, end in ranges) / count)
+
+    def rate(self, node_key: tuple[str, str, int], name: str, seconds: Optional[float] = None,
+             now: Optional[float] = None) -> Optional[float]:
+        """Change per second between the oldest and the newest sample of the last seconds (all by default)"""
+        with self._lock:
+            series = self._series(node_key, name)
+            if series is None:
+                return None
+            ranges = self._window(series, seconds, now)
+            if not ranges:
+                return None
+            first = ranges[0][0]
+            last = ranges[-1][1] - 1
+            elapsed = self._times[last] - self._times[first]
+            if elapsed <= 0:
+                return None
+            return (self._values[last] - self._values[first]) / elapsed
+
+    @property
+    def nodes(self) -> int:
+        return len(self._slots)
+
+    @property
+    def memory(self) -> int:
+        """Bytes of the ring buffer"""
+        return len(self._buffer)
+
+    def flush(self):
+        if self._file is not None:
+            self._buffer.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        with self._lock:
+            self._buffer.flush()
+            for view in (self._heads, self._counts, self._times, self._values, self._view):
+                view.release()
+            self._buffer.close()
+            self._file.close()
+            self._nodes_file.close()
+            self._file = None
@@ -0,0 +1,170 @@
+import time
+from types import SimpleNamespace
+import pytest
+import wirepas_mesh_messaging as wmm
+import mbproto.mb_protocol_pb2 as mb_protocol
+from mbproto.mb_protocol_iface import MBProto
+from pymodbus.client import ModbusFrameGenerator
+from pymodbus.framer import FramerType
+from connection_manager import ConnectionManager, SharedConnection
+from benchmarks.fake_wni import FakeWirepasNetworkInterface
+from benchmarks.uplinks import build_ack_uplink, build_modbus_uplink, build_read_registers_response
+
+ONE_SHOT = build_modbus_uplink(build_read_registers_response(1, [1, 2]))
+PERIODIC = build_modbus_uplink(build_read_registers_response(1, [1, 2]), 1, mb_protocol.Cmd.CMD_MODBUS_PERIODICAL)
+
+
+def uplink(gw_id: str, sink_id: str, node: int, payload: bytes = ONE_SHOT):
+    return SimpleNamespace(gw_id=gw_id, sink_id=sink_id, source_address=node, data_payload=payload)
+
+
+@pytest.fixture
+def fakes():
+    created = []
+    yield created
+    for wni in created:
+        wni.close()
+
+
+@pytest.fixture
+def connection(fakes):
+    def factory(connection_cb):
+        # Answers are lost so that requests stay pending until the test answers them
+        wni = FakeWirepasNetworkInterface(loss=1.0)
+        wni.connection_cb = connection_cb
+        fakes.append(wni)
+        return wni
+    connection = SharedConnection(factory)
+    yield connection
+    connection._stop_event.set()
+    connection._watchdog.join()
+
+
+def test_dispatch_by_gateway_sink_and_node(connection):
+    received = {}
+    for key in [("gw0", "sink0", 5), ("gw0", "sink0", None), ("gw0", None, None), (None, None, 5),
+                (None, None, None), ("gw1", None, None), ("gw0", "sink1", 5)]:
+        connection.register_uplink_traffic_cb(lambda data, key=key: received.setdefault(key, []).append(data),
+                                              gateway=key[0], sink=key[1], node=key[2])
+    connection._dispatch(uplink("gw0", "sink0", 5))
+    assert sorted(received, key=str) == sorted([("gw0", "sink0", 5), ("gw0", "sink0", None), ("gw0", None, None),
+                                                (None, None, 5), (None, None, None)], key=str)
+
+
+def test_unregister(connection):
+    received = []
+    cb_id = connection.register_uplink_traffic_cb(received.append, gateway="gw0", node=5)
+    connection.unregister_uplink_traffic_cb(cb_id)
+    connection._dispatch(uplink("gw0", "sink0", 5))
+    assert received == []
+    with pytest.raises(KeyError):
+        connection.unregister_uplink_traffic_cb(cb_id)
+
+
+def test_failing_callback_does_not_stop_dispatch(connection):
+    received = []
+    connection.register_uplink_traffic_cb(lambda data: 1 / 0)
+    connection.register_uplink_traffic_cb(received.append)
+    connection._dispatch(uplink("gw0", "sink0", 5))
+    assert len(received) == 1
+
+
+def request(slave: int) -> bytes:
+    generator = ModbusFrameGenerator(framer=FramerType.RTU, slave=slave)
+    mbproto = MBProto()
+    mbproto.target_port = 1
+    return mbproto.create_modbus_oneshot(generator.read_input_registers(address=0, count=2))
+
+
+FIRST = request(1)
+SECOND = request(2)
+
+
+def send(connection, node: int, payload: bytes = FIRST):
+    assert connection.send_message("gw0", "sink0", node, 77, 66, payload) == wmm.GatewayResultCode.GW_RES_OK
+
+
+def pending(connection, node: int) -> list[bytes]:
+    return [request.payload for request in connection._pending.get(("gw0", "sink0", node), ())]
+
+
+def test_answers_pop_the_oldest_request(connection):
+    send(connection, 5, FIRST)
+    send(connection, 5, SECOND)
+    send(connection, 6)
+    connection._dispatch(uplink("gw0", "sink0", 5))
+    assert pending(connection, 5) == [SECOND]
+    connection._dispatch(uplink("gw0", "sink0", 5, build_ack_uplink()))
+    assert pending(connection, 5) == []
+    assert pending(connection, 6) == [FIRST]
+
+
+@pytest.mark.parametrize("payload", [PERIODIC, b"\xff\xff\xff"])
+def test_periodic_reports_and_garbage_do_not_answer(connection, payload):
+    send(connection, 5)
+    connection._dispatch(uplink("gw0", "sink0", 5, payload))
+    assert pending(connection, 5) == [FIRST]
+
+
+def wait_for(predicate, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_replay_on_reconnect(connection, fakes):
+    wni = fakes[0]
+    connection._on_connection(True, None)
+    send(connection, 5, FIRST)
+    send(connection, 6, SECOND)
+    connection._dispatch(uplink("gw0", "sink0", 6))
+    connection._on_connection(False, "dropped")
+    connection._on_connection(True, None)
+    wait_for(lambda: connection.replayed == 1)
+    assert wni.sent == 3
+    # The replayed request waits for its answer again
+    assert pending(connection, 5) == [FIRST]
+
+
+def test_no_replay_without_a_drop_or_when_disabled(connection, fakes):
+    connection._on_connection(True, None)
+    send(connection, 5)
+    connection._on_connection(True, None)
+    connection.replay = False
+    connection._on_connection(False, "dropped")
+    connection._on_connection(True, None)
+    time.sleep(0.05)
+    assert connection.replayed == 0
+    assert fakes[0].sent == 1
+
+
+@pytest.fixture
+def manager(fakes):
+    def factory(host, port, username, password, insecure, connection_cb):
+        wni = FakeWirepasNetworkInterface()
+        fakes.append(wni)
+        return wni
+    manager = ConnectionManager(factory)
+    yield manager
+    manager.close()
+
+
+def test_connections_are_shared_per_credentials(manager, fakes):
+    first = manager.connect("broker", 8883, "user", "secret")
+    second = manager.connect("broker", "8883", "user", "secret")
+    other = manager.connect("broker", 8883, "user", "other")
+    assert len(fakes) == 2
+    assert first._connection is second._connection is not other._connection
+    assert all("secret" not in map(str, key) for key in manager._connections)
+    first.close()
+    first.close()
+    assert second._connection.users == 1
+    second.close()
+    assert len(manager._connections) == 1
+
+
+def test_conflicting_replay_raises(manager):
+    manager.connect("broker", 8883, "user", "secret")
+    with pytest.raises(ValueError):
+        manager.connect("broker", 8883, "user", "secret", replay=False)
@@ -0,0 +1,83 @@
+import threading
+from types import SimpleNamespace
+import pytest
+import fleet_poller
+from fleet_poller import Backoff, IntervalAdapter, SinkWindow, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(fleet_poller, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_token_bucket_burst_then_rate(clock):
+    bucket = TokenBucket(2.0, burst=3)
+    assert [bucket.try_acquire() for _ in range(3)] == [None, None, None]
+    assert bucket.try_acquire() == pytest.approx(0.5)
+    clock[0] += 0.25
+    assert bucket.try_acquire() == pytest.approx(0.25)
+    clock[0] += 0.25
+    assert bucket.try_acquire() is None
+    # Idle time refills up to the burst only
+    clock[0] += 60
+    assert [bucket.try_acquire() for _ in range(4)][-1] == pytest.approx(0.5)
+
+
+def test_unlimited_token_bucket():
+    bucket = TokenBucket(0, burst=1)
+    assert all(bucket.try_acquire() is None for _ in range(100))
+    assert bucket.acquire(threading.Event())
+
+
+def test_token_bucket_acquire_stops(clock):
+    bucket = TokenBucket(1.0)
+    stop = threading.Event()
+    assert bucket.acquire(stop)
+    stop.set()
+    assert not bucket.acquire(stop)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_backoff_doubles_within_jitter(seed):
+    fleet_poller.random.seed(seed)
+    backoff = Backoff(base=1.0, maximum=8.0)
+    for limit in (1, 2, 4, 8, 8, 8):
+        assert limit / 2 <= backoff.failure() <= limit
+    assert backoff.failures == 6
+    backoff.reset()
+    assert backoff.failures == 0
+    assert 0.5 <= backoff.failure() <= 1.0
+
+
+def test_sink_window(clock):
+    window = SinkWindow(2, answer_timeout=10.0)
+    assert window.try_acquire(1) is None
+    # One request per node at a time
+    assert window.try_acquire(1) == pytest.approx(10.01)
+    assert window.try_acquire(2) is None
+    clock[0] += 4
+    assert window.try_acquire(3) == pytest.approx(6.01)
+    window.release(1)
+    assert window.try_acquire(3) is None
+    clock[0] += 10
+    # The unanswered request expired
+    assert window.try_acquire(4) is None
+    assert window.timeouts == 1
+    assert window.in_flight == 2
+
+
+def test_interval_adapter():
+    adapter = IntervalAdapter(5.0, 40.0, change_percent=1.0, initial=20.0)
+    node = ("gw0", "sink0", 5)
+    assert adapter.interval(node) == 20.0
+    adapter.observe(node, 230.0)
+    adapter.observe(node, 240.0)
+    assert adapter.interval(node) == 10.0
+    for _ in range(10):
+        adapter.observe(node, 240.0)
+    assert adapter.interval(node) == 40.0
+    for value in (100.0, 200.0, 100.0, 200.0):
+        adapter.observe(node, value)
+    assert adapter.interval(node) == 5.0
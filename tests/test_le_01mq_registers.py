@@ -0,0 +1,58 @@
+import struct
+import pytest
+import le_01mq_registers
+from le_01mq_registers import LE_01MQ, Register, RegisterMap
+from benchmarks.fake_wni import encode_registers
+
+VALUES = {register.name: 10.5 * (i + 1) for i, register in enumerate(LE_01MQ.registers)}
+MIXED = RegisterMap([
+    Register('voltage', 0, unit='V'),
+    Register('swapped', 2, word_order='CDAB'),
+    Register('counter', 4, 'uint32', word_order='CDAB'),
+    Register('offset', 6, 'int16', scale=0.1),
+    Register('status', 8, 'uint16'),
+    Register('energy', 9, 'int32', scale=0.01),
+])
+MIXED_VALUES = {'voltage': 231.25, 'swapped': -1.5, 'counter': 70000, 'offset': -12.3, 'status': 65535,
+                'energy': -1234.56}
+
+
+def block(register_map: RegisterMap, values: dict[str, float], address: int, count: int) -> list[int]:
+    image = encode_registers(register_map, values)
+    return [image.get(address + i, 0) for i in range(count)]
+
+
+def test_decode_block_with_gaps():
+    registers = block(LE_01MQ, VALUES, 0, 0x26)
+    decoded = LE_01MQ.decode(0, registers)
+    assert list(decoded) == ['voltage', 'current', 'active_power', 'apparent_power', 'reactive_power',
+                             'power_factor', 'phase_angle']
+    assert decoded == {name: VALUES[name] for name in decoded}
+    assert LE_01MQ.decode_bytes(0, struct.pack(">%dH" % len(registers), *registers)) == decoded
+
+
+def test_decode_skips_registers_cut_by_the_block():
+    decoded = LE_01MQ.decode(0x46, block(LE_01MQ, VALUES, 0x46, 5))
+    assert set(decoded) == {'frequency', 'import_active_energy'}
+
+
+def test_types_word_order_and_scale():
+    decoded = MIXED.decode(0, block(MIXED, MIXED_VALUES, 0, 11))
+    assert decoded == pytest.approx(MIXED_VALUES)
+    assert MIXED.unit('voltage') == 'V'
+
+
+@pytest.mark.parametrize("numpy", [True, False])
+def test_decode_many_matches_decode(monkeypatch, numpy):
+    if numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(le_01mq_registers, "np", None)
+    rows = [dict(MIXED_VALUES, voltage=200.0 + i, counter=i * 1000) for i in range(5)]
+    blocks = [block(MIXED, values, 0, 11) for values in rows]
+    columns = MIXED.decode_many(0, blocks)
+    assert set(columns) == set(MIXED_VALUES)
+    for i, registers in enumerate(blocks):
+        expected = MIXED.decode(0, registers)
+        assert {name: float(column[i]) for name, column in columns.items()} == pytest.approx(expected)
+    assert MIXED.decode_many(0, []) == {}
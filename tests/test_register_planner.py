@@ -0,0 +1,51 @@
+import pytest
+from register_planner import ReadPlan, RegisterBlock, plan_reads, split_registers
+
+
+def test_contiguous_blocks_are_merged():
+    assert plan_reads([(0, 2), (2, 4), (6, 2)]) == [
+        ReadPlan(0, 8, (RegisterBlock(0, 2), RegisterBlock(2, 4), RegisterBlock(6, 2)))]
+
+
+def test_unsorted_and_overlapping_blocks():
+    plans = plan_reads([(10, 4), (0, 2), (11, 2)])
+    assert plans == [ReadPlan(0, 2, (RegisterBlock(0, 2),)),
+                     ReadPlan(10, 4, (RegisterBlock(10, 4), RegisterBlock(11, 2)))]
+
+
+@pytest.mark.parametrize("max_gap, reads", [(0, 2), (3, 2), (4, 1), (100, 1)])
+def test_max_gap(max_gap, reads):
+    # 4 registers between the blocks
+    assert len(plan_reads([(0, 2), (6, 2)], max_gap=max_gap)) == reads
+
+
+def test_max_count_splits_reads():
+    plans = plan_reads([(0, 60), (60, 60), (120, 10)])
+    assert [(p.address, p.count) for p in plans] == [(0, 120), (120, 10)]
+    plans = plan_reads([(0, 4), (4, 4)], max_count=6)
+    assert [(p.address, p.count) for p in plans] == [(0, 4), (4, 4)]
+
+
+def test_oversized_block_raises():
+    with pytest.raises(ValueError):
+        plan_reads([(0, 126)])
+    with pytest.raises(ValueError):
+        plan_reads([(0, 2), (10, 8)], max_count=4)
+
+
+def test_split_registers_round_trip():
+    blocks = [(0, 2), (4, 2), (5, 3)]
+    [plan] = plan_reads(blocks, max_gap=2)
+    registers = list(range(100, 100 + plan.count))
+    assert split_registers(plan, registers) == {
+        RegisterBlock(0, 2): (100, 101),
+        RegisterBlock(4, 2): (104, 105),
+        RegisterBlock(5, 3): (105, 106, 107),
+    }
+
+
+@pytest.mark.parametrize("count", [0, 7, 9])
+def test_split_registers_wrong_count_raises(count):
+    [plan] = plan_reads([(0, 8)])
+    with pytest.raises(ValueError):
+        split_registers(plan, [0] * count)
@@ -0,0 +1,86 @@
+import random
+import pytest
+from pymodbus.client import ModbusFrameGenerator
+from pymodbus.framer import FramerRTU, FramerType
+from rtu_sniffer import ModbusSniffer, RtuStreamParser, crc16_modbus
+from benchmarks.uplinks import build_read_registers_response, build_rtu_response
+
+
+def reference_crc(data: bytes) -> int:
+    # pymodbus returns the CRC high byte first
+    crc = FramerRTU.compute_CRC(data)
+    return (crc & 0xFF) << 8 | crc >> 8
+
+
+@pytest.mark.parametrize("length", [0, 1, 2, 6, 15, 16, 17, 64, 255, 256])
+@pytest.mark.parametrize("offset", [0, 1, 3])
+def test_crc_matches_pymodbus(length, offset):
+    data = random.Random(length * 7 + offset).randbytes(offset + length + 5)
+    assert crc16_modbus(data, offset, offset + length) == reference_crc(data[offset:offset + length])
+
+
+def test_crc_of_bytearray_and_memoryview():
+    data = bytearray(range(200))
+    expected = reference_crc(bytes(data))
+    assert crc16_modbus(data) == expected
+    assert crc16_modbus(memoryview(data)) == expected
+
+
+def request(slave: int, count: int = 4) -> bytes:
+    return ModbusFrameGenerator(framer=FramerType.RTU, slave=slave).read_input_registers(address=0, count=count)
+
+
+def conversation() -> list[bytes]:
+    frames = []
+    for slave in (1, 2, 17):
+        frames.append(request(slave))
+        frames.append(build_read_registers_response(slave, [slave, 2, 3, 4]))
+    frames.append(build_rtu_response(5, 0x84, b"\x02"))
+    return frames
+
+
+def test_parses_aligned_stream():
+    frames = conversation()
+    parsed = RtuStreamParser().feed(b"".join(frames))
+    assert [f.frame for f in parsed] == frames
+    assert [f.is_request for f in parsed] == [True, False] * 3 + [False]
+    assert parsed[-1].function_code == 0x84
+
+
+@pytest.mark.parametrize("prefix", [b"\x00", b"\xff\xfe", b"\x01\x04\x02", b"\x03\x04\x00\x00\x00\x04\x99"])
+def test_skips_garbage_before_the_first_frame(prefix):
+    frames = conversation()
+    parser = RtuStreamParser()
+    parsed = parser.feed(prefix + b"".join(frames))
+    assert [f.frame for f in parsed] == frames
+    assert parser.garbage == len(prefix)
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 3, 5, 7, 13])
+def test_frames_split_across_chunks(chunk):
+    frames = conversation()
+    stream = b"\xaa\x01" + b"".join(frames)
+    parser = RtuStreamParser()
+    parsed = []
+    for i in range(0, len(stream), chunk):
+        parsed += parser.feed(stream[i:i + chunk])
+    assert [f.frame for f in parsed] == frames
+
+
+def test_starting_in_the_middle_of_a_frame():
+    frames = conversation()
+    stream = b"".join(frames)
+    parser = RtuStreamParser()
+    parsed = parser.feed(stream[3:])
+    # The torn first request is lost, everything after it is found
+    assert [f.frame for f in parsed] == frames[1:]
+
+
+def test_sniffer_pairs_requests_and_responses():
+    sniffer = ModbusSniffer()
+    sniffer.feed(("gw", "sink", 1, 1), request(1), 10.0)
+    sniffer.feed(("gw", "sink", 1, 1), build_read_registers_response(1, [1, 2, 3, 4]), 10.2)
+    sniffer.feed(("gw", "sink", 1, 1), request(1) + request(1), 10.4)
+    stats = sniffer.stats[(1, 4)]
+    assert (stats.requests, stats.responses, stats.unanswered) == (3, 1, 1)
+    assert stats.uplink_gap.count == 1
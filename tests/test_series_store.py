@@ -0,0 +1,86 @@
+import pytest
+from series_store import SeriesStore, WindowStats
+
+NODE = ("gw0", "sink0", 5)
+OTHER = ("gw0", "sink1", 6)
+
+
+def filled(capacity: int = 4, samples: int = 6, **kwargs) -> SeriesStore:
+    store = SeriesStore(["voltage", "current"], capacity, 2, **kwargs)
+    for t in range(samples):
+        store.append(NODE, {"voltage": 230.0 + t, "current": float(t)}, 1000.0 + t)
+    return store
+
+
+def test_ring_keeps_the_last_samples_in_order():
+    store = filled()
+    assert store.samples(NODE, "voltage") == ([1002.0, 1003.0, 1004.0, 1005.0], [232.0, 233.0, 234.0, 235.0])
+    assert store.latest(NODE, "current") == (1005.0, 5.0)
+    assert store.samples(OTHER, "voltage") == ([], [])
+    assert store.latest(OTHER, "voltage") is None
+
+
+def test_partly_filled_ring():
+    store = filled(samples=2)
+    assert store.samples(NODE, "current") == ([1000.0, 1001.0], [0.0, 1.0])
+
+
+def test_stats_and_rate_windows():
+    store = filled()
+    assert store.stats(NODE, "voltage") == WindowStats(4, 232.0, 235.0, 233.5)
+    # Window across the wrap of the ring
+    assert store.stats(NODE, "voltage", 2.5, now=1005.0) == WindowStats(3, 233.0, 235.0, 234.0)
+    assert store.stats(NODE, "voltage", 1.0, now=1010.0) is None
+    assert store.rate(NODE, "current") == pytest.approx(1.0)
+    assert store.rate(NODE, "current", 0.5, now=1005.0) is None
+
+
+def test_out_of_order_samples_are_dropped():
+    store = filled()
+    store.append(NODE, {"voltage": 0.0}, 1004.5)
+    # Same timestamp as the newest sample is kept
+    store.append(NODE, {"current": 9.0}, 1005.0)
+    assert store.out_of_order == 1
+    assert store.latest(NODE, "voltage") == (1005.0, 235.0)
+    assert store.latest(NODE, "current") == (1005.0, 9.0)
+
+
+def test_nodes_beyond_max_nodes_are_untracked():
+    store = filled()
+    store.append(OTHER, {"voltage": 1.0}, 1000.0)
+    store.append(("gw1", "sink0", 7), {"voltage": 1.0, "current": 2.0}, 1000.0)
+    assert store.nodes == 2
+    assert store.untracked == 2
+
+
+def test_file_survives_reopen(tmp_path):
+    path = str(tmp_path / "history")
+    store = filled(path=path)
+    store.append(OTHER, {"voltage": 1.0}, 2000.0)
+    store.close()
+    store = SeriesStore(["voltage", "current"], 4, 2, path)
+    try:
+        assert store.nodes == 2
+        assert store.samples(NODE, "voltage")[1] == [232.0, 233.0, 234.0, 235.0]
+        assert store.latest(OTHER, "voltage") == (2000.0, 1.0)
+        store.append(NODE, {"voltage": 236.0}, 1006.0)
+        assert store.samples(NODE, "voltage")[1] == [233.0, 234.0, 235.0, 236.0]
+    finally:
+        store.close()
+
+
+def test_reopen_with_other_layout_raises(tmp_path):
+    path = str(tmp_path / "history")
+    filled(path=path).close()
+    with pytest.raises(ValueError):
+        SeriesStore(["voltage", "current"], 8, 2, path)
+    with pytest.raises(ValueError):
+        SeriesStore(["current", "voltage"], 4, 2, path)
+
+
+def test_missing_node_list_raises(tmp_path):
+    path = tmp_path / "history"
+    filled(path=str(path)).close()
+    (tmp_path / "history.nodes").unlink()
+    with pytest.raises(ValueError, match="node list"):
+        SeriesStore(["voltage", "current"], 4, 2, str(path))
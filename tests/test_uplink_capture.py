@@ -0,0 +1,83 @@
+import pytest
+from uplink_capture import CAPTURE_MAGIC, CaptureWriter, CapturedUplink, iter_records, open_capture, split_capture
+from uplink_pipeline import RawUplink
+
+
+def uplinks(count: int) -> list[RawUplink]:
+    return [RawUplink("gw%d" % (i % 3), "sink%d" % (i % 2), 100 + i, 1700000000000 + i, bytes([i]) * (i % 7 + 1), 0.0)
+            for i in range(count)]
+
+
+def write(path, records) -> CaptureWriter:
+    writer = CaptureWriter(str(path))
+    for data in records:
+        writer.record(data)
+    writer.close()
+    return writer
+
+
+def read(path) -> list[CapturedUplink]:
+    mm = open_capture(str(path))
+    try:
+        return list(iter_records(mm))
+    finally:
+        mm.close()
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / "uplinks.cap"
+    records = uplinks(20)
+    assert write(path, records).records == 20
+    assert read(path) == [CapturedUplink(r.rx_time_ms_epoch, r.gw_id, r.sink_id, r.source_address, 66, 77,
+                                         r.data_payload) for r in records]
+
+
+def test_reopen_appends(tmp_path):
+    path = tmp_path / "uplinks.cap"
+    records = uplinks(10)
+    write(path, records[:4])
+    assert write(path, records[4:]).truncated == 0
+    assert [r.source_address for r in read(path)] == [r.source_address for r in records]
+
+
+@pytest.mark.parametrize("cut", [1, 5, 20])
+def test_torn_tail_is_cut_off_on_reopen(tmp_path, cut):
+    path = tmp_path / "uplinks.cap"
+    records = uplinks(5)
+    write(path, records[:4])
+    complete = path.stat().st_size
+    write(path, records[4:])
+    last = path.stat().st_size - complete
+    with open(path, "r+b") as f:
+        f.truncate(complete + last - cut)
+    # The reader skips the torn record, the writer cuts it off before appending
+    assert len(read(path)) == 4
+    assert write(path, records[:1]).truncated == last - cut
+    assert [r.source_address for r in read(path)] == [r.source_address for r in records[:4] + records[:1]]
+
+
+def test_not_a_capture_raises(tmp_path):
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"something else")
+    with pytest.raises(ValueError):
+        CaptureWriter(str(path))
+    with pytest.raises(ValueError):
+        open_capture(str(path))
+
+
+@pytest.mark.parametrize("chunks", [1, 3, 7, 50])
+def test_split_capture_covers_every_record_once(tmp_path, chunks):
+    path = tmp_path / "uplinks.cap"
+    records = uplinks(30)
+    write(path, records)
+    mm = open_capture(str(path))
+    try:
+        ranges = split_capture(mm, chunks)
+        assert ranges[0][0] == len(CAPTURE_MAGIC)
+        assert ranges[-1][1] == len(mm)
+        assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+        assert len(ranges) <= max(chunks, 1) + 1
+        split = [r for start, end in ranges for r in iter_records(mm, start, end)]
+    finally:
+        mm.close()
+    assert [r.source_address for r in split] == [r.source_address for r in records]
@@ -0,0 +1,90 @@
+import pytest
+import mbproto.mb_protocol_pb2 as mb_protocol
+import mbproto.mb_protocol_answers_pb2 as mb_answers
+from mbproto.mb_protocol_iface import MBProto
+from uplink_decoder import (UplinkDecoder, FC_READ_INPUT_REGISTERS, FC_WRITE_SINGLE_COIL, decode_modbus_response,
+                            registers_to_float)
+from benchmarks.uplinks import (build_ack_uplink, build_diagnostics_uplink, build_modbus_uplink,
+                                build_read_registers_response, build_rtu_response, float_to_registers)
+
+
+def test_decode_one_shot_read():
+    frame = build_read_registers_response(3, float_to_registers(231.5))
+    uplink = UplinkDecoder().decode(build_modbus_uplink(frame, modbus_port=2))
+    assert uplink.cmd == mb_protocol.Cmd.CMD_MODBUS_ONE_SHOT
+    assert uplink.configuration_index == 0
+    assert uplink.modbus_port == 2
+    assert uplink.modbus.slave == 3
+    assert uplink.modbus.function_code == FC_READ_INPUT_REGISTERS
+    assert registers_to_float(uplink.modbus.registers) == 231.5
+
+
+def test_decode_periodic_keeps_configuration_index():
+    frame = build_read_registers_response(1, [1, 2, 3, 4])
+    uplink = UplinkDecoder().decode(build_modbus_uplink(frame, 5, mb_protocol.Cmd.CMD_MODBUS_PERIODICAL))
+    assert uplink.configuration_index == 5
+    assert uplink.modbus.registers == (1, 2, 3, 4)
+
+
+def test_decode_ack():
+    uplink = UplinkDecoder().decode(build_ack_uplink(ack=mb_answers.Acknowladge.ACKNOWLADGE_NACK))
+    assert uplink.ack == mb_answers.Acknowladge.ACKNOWLADGE_NACK
+    assert uplink.modbus is None
+
+
+def test_decode_diagnostics_survives_next_decode():
+    diagnostics = mb_answers.DiagnosticsAnsFrame(device_mode=1)
+    decoder = UplinkDecoder()
+    uplink = decoder.decode(build_diagnostics_uplink(diagnostics))
+    decoder.decode(build_ack_uplink())
+    assert uplink.diagnostics == diagnostics
+
+
+def test_decoder_matches_mbproto():
+    payload = build_modbus_uplink(build_read_registers_response(1, [0x4366, 0x8000]))
+    _, _, msg = MBProto().decode_response(payload)
+    uplink = UplinkDecoder().decode(payload)
+    assert uplink.cmd == msg.cmd
+    assert uplink.modbus.registers == (0x4366, 0x8000)
+
+
+@pytest.mark.parametrize("payload", [
+    b"",
+    b"\x01",
+    # Valid CRC over bytes that are not a protobuf message
+    MBProto()._add_crc(b"\xff\xff\xff"),
+])
+def test_malformed_payload_raises_value_error(payload):
+    with pytest.raises(ValueError):
+        UplinkDecoder().decode(payload)
+
+
+def test_bad_crc_raises_value_error():
+    payload = bytearray(build_ack_uplink())
+    payload[-1] ^= 0xFF
+    with pytest.raises(ValueError, match="CRC"):
+        UplinkDecoder().decode(bytes(payload))
+
+
+def test_modbus_exception_response():
+    response = decode_modbus_response(build_rtu_response(1, 0x84, b"\x02"))
+    assert response.function_code == 0x84
+    assert response.exception_code == 2
+
+
+def test_modbus_write_coil_response():
+    response = decode_modbus_response(build_rtu_response(1, FC_WRITE_SINGLE_COIL, b"\x00\x07\xff\x00"))
+    assert response.address == 7
+    assert response.bits == (True,)
+
+
+@pytest.mark.parametrize("frame", [
+    b"\x01\x04\x00",
+    # Byte count larger than the frame
+    build_rtu_response(1, FC_READ_INPUT_REGISTERS, b"\x06\x00\x01"),
+    # Unknown function code
+    build_rtu_response(1, 0x2b, b"\x0e\x01\x00"),
+])
+def test_malformed_modbus_frame_raises_value_error(frame):
+    with pytest.raises(ValueError):
+        decode_modbus_response(frame)
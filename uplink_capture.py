@@ -0,0 +1,137 @@
+import mmap
+import os
+import struct
+import threading
+from typing import Iterator, NamedTuple
+
+# File header, followed by length-prefixed records
+CAPTURE_MAGIC = b"WMBCAP\x00\x01"
+# Record: length of the rest of the record, rx time [ms since epoch], node, source endpoint,
+# destination endpoint, gateway id length, sink id length; then gateway id, sink id and payload
+RECORD_HEADER = struct.Struct("<IqIBBBB")
+
+
+class CapturedUplink(NamedTuple):
+    rx_time_ms_epoch: int
+    gw_id: str
+    sink_id: str
+    source_address: int
+    source_endpoint: int
+    destination_endpoint: int
+    data_payload: bytes
+
+
+class CaptureWriter():
+    """
+    Appends raw uplinks to a capture file.
+
+    record() has the signature of an uplink callback so it can be registered
+    directly or chained in front of another callback.
+
+    An existing capture is appended to, after cutting off a last record torn
+    by a recorder killed mid-write; truncated holds the bytes cut off.
+    """
+
+    def __init__(self, path: str, buffering: int = 1 << 16):
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        end = _complete_length(path) if size else 0
+        self.truncated = size - end
+        if self.truncated:
+            os.truncate(path, end)
+        self._file = open(path, "ab", buffering=buffering)
+        if end == 0:
+            self._file.write(CAPTURE_MAGIC)
+        self._lock = threading.Lock()
+        self.records = 0
+
+    def record(self, data):
+        gw_id = data.gw_id.encode()
+        sink_id = data.sink_id.encode()
+        payload = data.data_payload
+        length = RECORD_HEADER.size - 4 + len(gw_id) + len(sink_id) + len(payload)
+        header = RECORD_HEADER.pack(length, int(data.rx_time_ms_epoch or 0), int(data.source_address),
+                                    getattr(data, 'source_endpoint', 66) or 0, getattr(data, 'destination_endpoint', 77) or 0,
+                                    len(gw_id), len(sink_id))
+        with self._lock:
+            # Uplinks can still arrive between close() and the interface shutdown
+            if self._file.closed:
+                return
+            self._file.write(header + gw_id + sink_id + payload)
+            self.records += 1
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _complete_length(path: str) -> int:
+    """Length of the capture up to its last complete record, 0 if even the header is incomplete"""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(CAPTURE_MAGIC):
+            if CAPTURE_MAGIC.startswith(f.read()):
+                return 0
+            raise ValueError("%s is not an uplink capture" % path)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+                raise ValueError("%s is not an uplink capture" % path)
+            offset = len(CAPTURE_MAGIC)
+            while offset + RECORD_HEADER.size <= size:
+                length, _, _, _, _, gw_len, sink_len = RECORD_HEADER.unpack_from(mm, offset)
+                if length < RECORD_HEADER.size - 4 + gw_len + sink_len or offset + 4 + length > size:
+                    break
+                offset += 4 + length
+            return offset
+
+
+def open_capture(path: str) -> mmap.mmap:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(CAPTURE_MAGIC):
+            raise ValueError("%s is empty" % path)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        mm.close()
+        raise ValueError("%s is not an uplink capture" % path)
+    return mm
+
+
+def split_capture(mm: mmap.mmap, chunks: int) -> list[tuple[int, int]]:
+    """Split a capture into about chunks byte ranges that start and end on record boundaries"""
+    size = len(mm)
+    target = max(1, (size - len(CAPTURE_MAGIC)) // max(1, chunks))
+    ranges = []
+    start = offset = len(CAPTURE_MAGIC)
+    while offset + 4 <= size:
+        (length,) = struct.unpack_from("<I", mm, offset)
+        if offset + 4 + length > size:
+            # Truncated last record, e.g. the recorder was killed mid-write
+            break
+        offset += 4 + length
+        if offset - start >= target:
+            ranges.append((start, offset))
+            start = offset
+    if offset > start:
+        ranges.append((start, offset))
+    return ranges
+
+
+def iter_records(mm: mmap.mmap, start: int = len(CAPTURE_MAGIC), end: int = -1) -> Iterator[CapturedUplink]:
+    end = len(mm) if end < 0 else end
+    offset = start
+    header_size = RECORD_HEADER.size
+    while offset + header_size <= end:
+        length, rx_time, node, src_ep, dst_ep, gw_len, sink_len = RECORD_HEADER.unpack_from(mm, offset)
+        record_end = offset + 4 + length
+        if record_end > end:
+            break
+        position = offset + header_size
+        gw_id = mm[position:position + gw_len].decode()
+        position += gw_len
+        sink_id = mm[position:position + sink_len].decode()
+        position += sink_len
+        yield CapturedUplink(rx_time, gw_id, sink_id, node, src_ep, dst_ep, mm[position:record_end])
+        offset = record_end
@@ -0,0 +1,168 @@
+import struct
+from typing import NamedTuple, Optional
+import mbproto.mb_protocol_pb2 as mb_protocol
+import mbproto.mb_protocol_answers_pb2 as mb_answers
+from google.protobuf.message import DecodeError
+from pymodbus.framer.rtu import FramerRTU
+
+# Modbus function codes understood by the fast path
+FC_READ_COILS = 0x01
+FC_READ_DISCRETE_INPUTS = 0x02
+FC_READ_HOLDING_REGISTERS = 0x03
+FC_READ_INPUT_REGISTERS = 0x04
+FC_WRITE_SINGLE_COIL = 0x05
+FC_WRITE_SINGLE_REGISTER = 0x06
+FC_WRITE_MULTIPLE_COILS = 0x0F
+FC_WRITE_MULTIPLE_REGISTERS = 0x10
+
+MODBUS_CMDS = (mb_protocol.Cmd.CMD_MODBUS_ONE_SHOT, mb_protocol.Cmd.CMD_MODBUS_PERIODICAL)
+
+
+def _crc16_dds110_table() -> tuple[int, ...]:
+    # CRC-16/DDS-110: poly 0x8005, init 0x800d, no reflection, no final xor
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x8005) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return tuple(table)
+
+
+_CRC16_DDS110_TABLE = _crc16_dds110_table()
+
+
+def crc16_dds110(data: bytes) -> int:
+    crc = 0x800D
+    table = _CRC16_DDS110_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+
+def registers_to_float(registers: tuple[int, ...] | list[int], offset: int = 0) -> float:
+    # Same result as mbd_to_float() on the little-endian register bytes: high word first
+    return struct.unpack(">f", struct.pack(">HH", registers[offset], registers[offset + 1]))[0]
+
+
+class ModbusResponse(NamedTuple):
+    slave: int
+    function_code: int
+    registers: tuple[int, ...] = ()
+    bits: tuple[bool, ...] = ()
+    address: int = 0
+    count: int = 0
+    exception_code: int = 0
+
+
+class Uplink(NamedTuple):
+    cmd: int
+    ack: int
+    configuration_index: int
+    modbus_port: int
+    modbus: Optional[ModbusResponse]
+    # Copy of the answer to CMD_DIAGNOSTICS, None for every other uplink
+    diagnostics: Optional[mb_answers.DiagnosticsAnsFrame] = None
+
+
+def decode_modbus_response(frame: bytes) -> ModbusResponse:
+    """Decode a Modbus RTU response frame without going through pymodbus PDU objects"""
+    if len(frame) < 5:
+        raise ValueError("Modbus frame too short")
+    if FramerRTU.compute_CRC(frame[:-2]) != int.from_bytes(frame[-2:], "big"):
+        raise ValueError("Modbus frame CRC verification failed")
+    slave = frame[0]
+    function_code = frame[1]
+    if function_code & 0x80:
+        return ModbusResponse(slave, function_code, exception_code=frame[2])
+    if function_code in (FC_READ_HOLDING_REGISTERS, FC_READ_INPUT_REGISTERS):
+        byte_count = frame[2]
+        if byte_count % 2 or len(frame) != 5 + byte_count:
+            raise ValueError("Modbus byte count %d does not match the frame" % byte_count)
+        registers = struct.unpack_from(">%dH" % (byte_count // 2), frame, 3)
+        return ModbusResponse(slave, function_code, registers=registers, count=len(registers))
+    if function_code in (FC_READ_COILS, FC_READ_DISCRETE_INPUTS):
+        byte_count = frame[2]
+        if len(frame) != 5 + byte_count:
+            raise ValueError("Modbus byte count %d does not match the frame" % byte_count)
+        bits = tuple(bool((byte >> bit) & 1) for byte in frame[3:3 + byte_count] for bit in range(8))
+        return ModbusResponse(slave, function_code, bits=bits, count=len(bits))
+    if function_code not in (FC_WRITE_SINGLE_COIL, FC_WRITE_SINGLE_REGISTER, FC_WRITE_MULTIPLE_COILS,
+                             FC_WRITE_MULTIPLE_REGISTERS):
+        raise ValueError("Unsupported Modbus function code 0x%02x" % function_code)
+    # Write responses echo an address and a value or count
+    if len(frame) != 8:
+        raise ValueError("Modbus frame length %d does not match function code 0x%02x" % (len(frame), function_code))
+    address, value = struct.unpack_from(">HH", frame, 2)
+    if function_code == FC_WRITE_SINGLE_COIL:
+        return ModbusResponse(slave, function_code, bits=(value == 0xFF00,), address=address, count=1)
+    if function_code == FC_WRITE_SINGLE_REGISTER:
+        return ModbusResponse(slave, function_code, registers=(value,), address=address, count=1)
+    return ModbusResponse(slave, function_code, address=address, count=value)
+
+
+class UplinkDecoder():
+    """
+    Decodes WMB uplink payloads straight off the protobuf message.
+
+    A single MbMessage is reused between calls, so an instance must not be
+    shared between threads.
+    """
+
+    def __init__(self):
+        self._msg = mb_protocol.MbMessage()
+        # Optional profiling.StageProfiler timing decode_response and decode_modbus_frame
+        self.profiler = None
+
+    def _parse(self, frame: bytes) -> mb_protocol.MbMessage:
+        if len(frame) < 2:
+            raise ValueError("Frame too short")
+        message_data = frame[:-2]
+        if crc16_dds110(message_data) != int.from_bytes(frame[-2:], "big"):
+            raise ValueError("CRC verification failed")
+        msg = self._msg
+        try:
+            msg.ParseFromString(message_data)
+        except DecodeError as e:
+            # Callers handle a single error type
+            raise ValueError("Invalid MBProto message: %s" % e)
+        return msg
+
+    def modbus_frame(self, frame: bytes) -> tuple[int, bytes]:
+        """
+        Return the Modbus port and the raw bytes of the Modbus frame an uplink
+        carries, without decoding them, e.g. for bytes sniffed on the bus.
+        The frame is empty for uplinks without one.
+        """
+        answer = self._parse(frame).payload.payload_answer_frame
+        if answer.WhichOneof("answer_frame") != "modbus_response_frame":
+            return 0, b""
+        return answer.modbus_response_frame.modbus_port, answer.modbus_response_frame.modbus_frame
+
+    def decode(self, frame: bytes) -> Uplink:
+        profiler = self.profiler
+        if profiler is not None:
+            start = profiler.clock()
+        msg = self._parse(frame)
+        answer = msg.payload.payload_answer_frame
+        kind = answer.WhichOneof("answer_frame")
+        if profiler is not None:
+            start = profiler.record('decode_response', start)
+        if kind == "ack_frame":
+            return Uplink(msg.cmd, answer.ack_frame.acknowladge, 0, 0, None)
+        if kind == "modbus_response_frame" and msg.cmd in MODBUS_CMDS:
+            response = answer.modbus_response_frame
+            modbus = decode_modbus_response(response.modbus_frame)
+            if profiler is not None:
+                profiler.record('decode_modbus_frame', start)
+            return Uplink(msg.cmd,
+                          mb_answers.Acknowladge.ACKNOWLADGE_UNKNOWN,
+                          response.configuration_index,
+                          response.modbus_port,
+                          modbus)
+        if kind == "diagnostics_ans_frame":
+            # Rare, copied out of the reused message
+            diagnostics = mb_answers.DiagnosticsAnsFrame()
+            diagnostics.CopyFrom(answer.diagnostics_ans_frame)
+            return Uplink(msg.cmd, mb_answers.Acknowladge.ACKNOWLADGE_UNKNOWN, 0, 0, None, diagnostics)
+        return Uplink(msg.cmd, mb_answers.Acknowladge.ACKNOWLADGE_UNKNOWN, 0, 0, None)
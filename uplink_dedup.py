@@ -0,0 +1,57 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Optional
+
+
+class UplinkDeduplicator():
+    """
+    Drops copies of an uplink seen again within window seconds.
+
+    Uplinks are keyed on gateway, sink, source node and a hash of the raw
+    payload. The configuration index is part of the protobuf payload, so two
+    identical answers to different periodic configurations never collide,
+    and no decoding is needed to tell copies apart.
+
+    The index is an insertion-ordered dict trimmed from its oldest end, both
+    when entries leave the time window and when it holds more than maxsize
+    entries. A copy does not refresh its entry: a value that legitimately
+    repeats every period is let through again once the window has passed,
+    so window must stay below the polling period.
+    """
+
+    def __init__(self, window: float = 2.0, maxsize: int = 100000):
+        self.window = window
+        self.maxsize = maxsize
+        self.suppressed: dict[tuple[str, str, int], int] = defaultdict(int)
+        self._seen: OrderedDict[tuple[str, str, int, int], float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_duplicate(self, data, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        node = int(data.source_address)
+        key = (data.gw_id, data.sink_id, node, hash(data.data_payload))
+        with self._lock:
+            seen = self._seen
+            while seen:
+                oldest_key, oldest = next(iter(seen.items()))
+                if now - oldest <= self.window and len(seen) < self.maxsize:
+                    break
+                del seen[oldest_key]
+            if key in seen:
+                self.suppressed[(data.gw_id, data.sink_id, node)] += 1
+                return True
+            seen[key] = now
+            return False
+
+    @property
+    def total_suppressed(self) -> int:
+        with self._lock:
+            return sum(self.suppressed.values())
+
+    def log_summary(self):
+        with self._lock:
+            suppressed = sorted(self.suppressed.items())
+        for (gateway, sink, node), count in suppressed:
+            logging.info("%s:%s node %s: %d duplicate uplinks suppressed", gateway, sink, node, count)
@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, NamedTuple, Optional
+from uplink_decoder import Uplink, UplinkDecoder
+
+OVERFLOW_POLICIES = ('block', 'drop-oldest')
+
+
+class RawUplink(NamedTuple):
+    # Same attribute names as wirepas_mesh_messaging.ReceivedDataEvent
+    gw_id: str
+    sink_id: str
+    source_address: int
+    rx_time_ms_epoch: int
+    data_payload: bytes
+    # time.monotonic() when the MQTT thread handed the uplink over
+    received: float
+
+
+_decoder = threading.local()
+
+
+def decode_batch(payloads: list[bytes], profiler=None) -> list[Uplink | str]:
+    """Decode payloads with a per-thread (or per-process) decoder, errors are returned as strings"""
+    decoder = getattr(_decoder, 'decoder', None)
+    if decoder is None:
+        decoder = _decoder.decoder = UplinkDecoder()
+    decoder.profiler = profiler
+    results = []
+    for payload in payloads:
+        try:
+            results.append(decoder.decode(payload))
+        except ValueError as e:
+            results.append(str(e))
+    return results
+
+
+class UplinkPipeline():
+    """
+    Moves uplink decoding off the MQTT network thread.
+
+    enqueue() is registered as the uplink callback: it only copies the
+    payload and metadata into a bounded queue. Worker threads take batches
+    from the queue, decode them inline or in a process pool, and call
+    handler(raw, uplink) for each decoded uplink. With a process pool there
+    are at least as many worker threads as processes, each waiting for the
+    batch it submitted, so that every process has a batch to decode.
+
+    The queue is split in one shard per worker and the uplinks of a node
+    (gateway, sink, source address) always go to the same shard, so the
+    handler sees every node's uplinks in arrival order and never two of
+    them at once: per-node state such as deadband or history stays
+    consistent with several workers.
+
+    When a shard is full, 'drop-oldest' discards its oldest uplink while
+    the 'block' policy makes the MQTT thread wait for room. That thread
+    also delivers the gateways' answers to send_message and the connection
+    callbacks, which then wait too and may time out.
+
+    With a profiling.StageProfiler as profiler, the time each uplink waited
+    in the queue is recorded as the 'queue' stage and, when decoding in
+    threads, the decoding stages as well.
+    """
+
+    def __init__(self,
+                 handler: Callable[[RawUplink, Uplink], None],
+                 maxsize: int = 10000,
+                 workers: int = 1,
+                 processes: int = 0,
+                 batch_size: int = 64,
+                 overflow: str = 'drop-oldest',
+                 stats_interval: Optional[float] = None,
+                 profiler=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unsupported overflow policy %s" % overflow)
+        self.handler = handler
+        self.maxsize = maxsize
+        # A worker thread waits for each batch it hands to the pool, keep every process busy
+        self.workers = max(workers, processes)
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.stats_interval = stats_interval
+        self.profiler = profiler
+        self.enqueued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.decode_errors = 0
+        self.max_depth = 0
+        # maxsize is shared evenly between the shards
+        self._shard_size = max(1, -(-maxsize // self.workers))
+        self._queues: list[deque[RawUplink]] = [deque() for _ in range(self.workers)]
+        self._cond = threading.Condition()
+        self._running = False
+        self._threads: list[threading.Thread] = []
+        self._executor: Optional[Executor] = ProcessPoolExecutor(processes) if processes > 0 else None
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues)
+
+    def enqueue(self, data):
+        raw = RawUplink(data.gw_id, data.sink_id, data.source_address, data.rx_time_ms_epoch,
+                        data.data_payload, time.monotonic())
+        queue = self._queues[hash((raw.gw_id, raw.sink_id, raw.source_address)) % self.workers]
+        with self._cond:
+            if len(queue) >= self._shard_size:
+                if self.overflow == 'drop-oldest':
+                    queue.popleft()
+                    self.dropped += 1
+                else:
+                    while self._running and len(queue) >= self._shard_size:
+                        self._cond.wait()
+            queue.append(raw)
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self._cond.notify_all()
+
+    def start(self):
+        self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(self._queues[i],), name="uplink-worker-%d" % i,
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.stats_interval:
+            threading.Thread(target=self._log_stats, name="uplink-stats", daemon=True).start()
+
+    def stop(self):
+        """Stop the workers once the queued uplinks have been handled"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def stats(self) -> dict[str, int]:
+        with self._cond:
+            return {"depth": self.depth, "max_depth": self.max_depth, "enqueued": self.enqueued,
+                    "processed": self.processed, "dropped": self.dropped, "decode_errors": self.decode_errors}
+
+    def _log_stats(self):
+        while self._running:
+            time.sleep(self.stats_interval)
+            logging.info("Uplink queue: %s", ", ".join("%s=%d" % item for item in self.stats().items()))
+
+    def _next_batch(self, queue: deque[RawUplink]) -> list[RawUplink]:
+        with self._cond:
+            while self._running and not queue:
+                self._cond.wait()
+            batch = [queue.popleft() for _ in range(min(self.batch_size, len(queue)))]
+            # Wake up the MQTT thread blocked on a full queue
+            self._cond.notify_all()
+            return batch
+
+    def _run(self, queue: deque[RawUplink]):
+        while True:
+            batch = self._next_batch(queue)
+            if not batch:
+                return
+            if self.profiler is not None:
+                now = time.monotonic()
+                for raw in batch:
+                    self.profiler.record_time('queue', now - raw.received)
+            payloads = [raw.data_payload for raw in batch]
+            if self._executor is not None:
+                results = self._executor.submit(decode_batch, payloads).result()
+            else:
+                results = decode_batch(payloads, self.profiler)
+            errors = 0
+            for raw, uplink in zip(batch, results):
+                if isinstance(uplink, str):
+                    errors += 1
+                    logging.error("Failed to decode uplink from %s: %s", raw.source_address, uplink)
+                    continue
+                try:
+                    self.handler(raw, uplink)
+                except Exception:
+                    logging.exception("Uplink handler failed")
+            with self._cond:
+                self.processed += len(batch)
+                self.decode_errors += errors
@@ -0,0 +1,113 @@
+import argparse
+import csv
+import logging
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from uplink_decoder import UplinkDecoder
+from uplink_capture import iter_records, open_capture, split_capture
+
+COLUMNS = ('rx_time_ms_epoch', 'gateway', 'sink', 'node', 'cmd', 'ack', 'configuration_index',
+           'slave', 'function_code', 'exception_code', 'registers', 'bits', 'error')
+
+
+def decode_range(path: str, start: int, end: int) -> dict[str, list]:
+    """Decode the records of one byte range of a capture into columns"""
+    decoder = UplinkDecoder()
+    columns = {name: [] for name in COLUMNS}
+    mm = open_capture(path)
+    try:
+        for record in iter_records(mm, start, end):
+            row = [record.rx_time_ms_epoch, record.gw_id, record.sink_id, record.source_address]
+            try:
+                uplink = decoder.decode(record.data_payload)
+            except ValueError as e:
+                row += [None, None, None, None, None, None, "", "", str(e)]
+            else:
+                modbus = uplink.modbus
+                if modbus is None:
+                    row += [uplink.cmd, uplink.ack, uplink.configuration_index, None, None, None, "", "", ""]
+                else:
+                    row += [uplink.cmd, uplink.ack, uplink.configuration_index, modbus.slave, modbus.function_code,
+                            modbus.exception_code, " ".join(map(str, modbus.registers)),
+                            "".join("1" if bit else "0" for bit in modbus.bits), ""]
+            for name, value in zip(COLUMNS, row):
+                columns[name].append(value)
+    finally:
+        mm.close()
+    return columns
+
+
+def decode_captures(paths: list[str], processes: int) -> dict[str, list]:
+    tasks = []
+    for path in paths:
+        mm = open_capture(path)
+        try:
+            tasks.extend((path, start, end) for start, end in split_capture(mm, processes * 4))
+        finally:
+            mm.close()
+    columns = {name: [] for name in COLUMNS}
+    if not tasks:
+        return columns
+    with ProcessPoolExecutor(processes) as executor:
+        # map() keeps the chunk order, so the output keeps the capture order
+        for chunk in executor.map(decode_range, *zip(*tasks)):
+            for name in COLUMNS:
+                columns[name].extend(chunk[name])
+    return columns
+
+
+def write_csv(columns: dict[str, list], output):
+    writer = csv.writer(output)
+    writer.writerow(COLUMNS)
+    writer.writerows(zip(*(columns[name] for name in COLUMNS)))
+
+
+def write_parquet(columns: dict[str, list], path: str):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("Parquet output requires pyarrow: pip install pyarrow")
+    pyarrow.parquet.write_table(pyarrow.table(columns), path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    parser.add_argument('captures',
+                        nargs='+',
+                        help='Capture files written with --capture')
+    parser.add_argument('--output',
+                        required=False,
+                        default='-',
+                        help='Output file, - for stdout')
+    parser.add_argument('--format',
+                        required=False,
+                        choices=['csv', 'parquet'],
+                        default='csv',
+                        help='Output format')
+    parser.add_argument('--processes',
+                        required=False,
+                        type=int,
+                        default=4,
+                        help='Decoding processes')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
+
+    start = time.perf_counter()
+    columns = decode_captures(args.captures, args.processes)
+    elapsed = time.perf_counter() - start
+    count = len(columns['node'])
+    logging.info("Decoded %d uplinks in %.2fs (%.0f uplinks/s)", count, elapsed, count / elapsed if elapsed else 0)
+
+    if args.format == 'parquet':
+        if args.output == '-':
+            parser.error("Parquet output needs --output <file>")
+        write_parquet(columns, args.output)
+    elif args.output == '-':
+        write_csv(columns, sys.stdout)
+    else:
+        with open(args.output, 'w', newline='') as f:
+            write_csv(columns, f)
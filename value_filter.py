@@ -0,0 +1,85 @@
+import math
+import threading
+import time
+from array import array
+from typing import Optional
+
+
+class DeadbandFilter():
+    """
+    Report-by-exception filter for decoded meter values.
+
+    A value is emitted when it differs from the last emitted value of the
+    same node and register by more than absolute, or by more than percent
+    of that last value, or when nothing was emitted for max_silence seconds.
+    A threshold of 0 is disabled; with both disabled any change is emitted.
+    thresholds overrides (absolute, percent) per register name.
+
+    The last emitted value and time of every (node, register) pair live in
+    two flat arrays of doubles, at node slot * len(names) + register index.
+    """
+
+    def __init__(self,
+                 names: list[str] | tuple[str, ...],
+                 absolute: float = 0.0,
+                 percent: float = 0.0,
+                 max_silence: float = 0.0,
+                 thresholds: Optional[dict[str, tuple[float, float]]] = None):
+        self.names = tuple(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        thresholds = thresholds or {}
+        self.absolute = array('d', (thresholds.get(name, (absolute, percent))[0] for name in self.names))
+        self.percent = array('d', (thresholds.get(name, (absolute, percent))[1] / 100 for name in self.names))
+        self.max_silence = max_silence
+        self.received = 0
+        self.emitted = 0
+        self._slots: dict[tuple[str, str, int], int] = {}
+        self._values = array('d')
+        self._times = array('d')
+        self._lock = threading.Lock()
+
+    def _slot(self, node_key: tuple[str, str, int]) -> int:
+        slot = self._slots.get(node_key)
+        if slot is None:
+            slot = self._slots[node_key] = len(self._slots)
+            self._values.extend([math.nan] * len(self.names))
+            self._times.extend([0.0] * len(self.names))
+        return slot
+
+    def update(self, node_key: tuple[str, str, int], values: dict[str, float],
+               now: Optional[float] = None) -> dict[str, float]:
+        """Record the values read from a node and return the ones to report"""
+        now = time.monotonic() if now is None else now
+        emit = {}
+        with self._lock:
+            base = self._slot(node_key) * len(self.names)
+            for name, value in values.items():
+                i = self.index.get(name)
+                if i is None:
+                    # Not filtered
+                    emit[name] = value
+                    continue
+                last = self._values[base + i]
+                delta = abs(value - last)
+                absolute = self.absolute[i]
+                percent = self.percent[i]
+                if (last != last
+                        or (absolute and delta > absolute)
+                        or (percent and delta > percent * abs(last))
+                        or (not absolute and not percent and delta)
+                        or (self.max_silence and now - self._times[base + i] >= self.max_silence)):
+                    self._values[base + i] = value
+                    self._times[base + i] = now
+                    emit[name] = value
+            self.received += len(values)
+            self.emitted += len(emit)
+        return emit
+
+    @property
+    def nodes(self) -> int:
+        return len(self._slots)
+
+    @property
+    def memory(self) -> int:
+        """Bytes held by the state arrays"""
+        return (len(self._values) + len(self._times)) * self._values.itemsize
@@ -0,0 +1,72 @@
+import argparse
+import importlib
+import sys
+import time
+from typing import Optional
+from cli_options import add_connection_arguments
+
+_START = time.perf_counter()
+
+# (command words, module, help)
+COMMANDS = (
+    (('config',), 'configuration_mqtt', "Send a configuration command to a node or configure a fleet"),
+    (('le01mq', 'poll'), 'le_01mq_mqtt', "Poll the voltage of an le-01mq meter"),
+    (('le01mq', 'continuous'), 'le_01mq_set_continous_mqtt', "Configure le-01mq meters to report periodically"),
+    (('le01mq', 'fleet'), 'le_01mq_fleet_mqtt', "Poll the voltage of every le-01mq meter of an inventory"),
+    (('le01mq', 'async'), 'le_01mq_async_mqtt', "Read the voltage of every le-01mq meter of an inventory once"),
+    (('zephyr',), 'zephyr_rtu_server_mqtt', "Send a command to the zephyr RTU server"),
+    (('sniffer',), 'modbus_sniffer_mqtt', "Log statistics of the Modbus traffic sniffed by the nodes"),
+)
+
+
+def build_parser(module=None) -> tuple[argparse.ArgumentParser, dict[str, argparse.ArgumentParser]]:
+    """
+    Parser of every command, with the arguments of the command implemented by
+    module only, so that only that module has to be imported. Returns the
+    parser and the parser of each command by module name.
+    """
+    parser = argparse.ArgumentParser(prog='wmb', fromfile_prefix_chars='@')
+    parser.add_argument('--import-time',
+                        required=False,
+                        action='store_true',
+                        help='Print how long importing the command took')
+    commands = parser.add_subparsers(dest='command', metavar='command', required=True)
+    groups = {}
+    leaves = {}
+    for words, name, help in COMMANDS:
+        parent = commands
+        if len(words) > 1:
+            if words[0] not in groups:
+                group = commands.add_parser(words[0], help="%s commands" % words[0])
+                groups[words[0]] = group.add_subparsers(dest=words[0] + '_command', metavar='command', required=True)
+            parent = groups[words[0]]
+        selected = module is not None and module.__name__ == name
+        # Other commands get no arguments and no help, their unknown options are left for the second pass
+        leaf = parent.add_parser(words[-1], help=help, add_help=selected, fromfile_prefix_chars='@')
+        leaf.set_defaults(module=name)
+        if selected:
+            add_connection_arguments(leaf)
+            module.add_arguments(leaf)
+        leaves[name] = leaf
+    return parser, leaves
+
+
+def main(argv: Optional[list[str]] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    # First pass: only find out which command to import
+    parser, _ = build_parser()
+    args, _ = parser.parse_known_args(argv)
+    start = time.perf_counter()
+    modules = len(sys.modules)
+    module = importlib.import_module(args.module)
+    if args.import_time:
+        print("Imported %s in %.3fs (%d modules), started in %.3fs" % (
+            args.module, time.perf_counter() - start, len(sys.modules) - modules, start - _START),
+            file=sys.stderr)
+    parser, leaves = build_parser(module)
+    args = parser.parse_args(argv)
+    module.main(leaves[args.module], args)
+
+
+if __name__ == "__main__":
+    main()
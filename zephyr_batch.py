@@ -0,0 +1,119 @@
+import argparse
+import asyncio
+import json
+import logging
+import shlex
+import time
+from collections import defaultdict
+from typing import NamedTuple, Optional, TextIO
+from async_client import AsyncWmbClient, GatewayError
+from zephyr_commands import add_command_arguments, add_node_arguments, command_payload, describe_response
+
+
+class BatchCommand(NamedTuple):
+    line: int
+    gateway: str
+    sink: str
+    node: int
+    cmd: str
+    payload: bytes
+
+
+class BatchResult(NamedTuple):
+    command: BatchCommand
+    # 'ok', 'exception', 'timeout' or 'error'
+    status: str
+    # Seconds from the start of the batch to sending, and from sending to the answer
+    sent: float
+    rtt: Optional[float]
+    fields: dict
+
+
+def load_batch(lines: TextIO, defaults: argparse.Namespace) -> list[BatchCommand]:
+    """
+    Parse one command per line, written with the same --gw/--sink/--node/
+    --modbus-addr/--target-port and --cmd/--led-num/--led-val/--regs options
+    as the command line. Node options default to the ones of defaults. Empty
+    lines and lines starting with '#' are ignored.
+    """
+    parser = argparse.ArgumentParser(prog='batch', add_help=False, exit_on_error=False)
+    add_node_arguments(parser, gw_required=False)
+    add_command_arguments(parser, cmd_required=False)
+    parser.set_defaults(gw=defaults.gw, sink=defaults.sink, node=defaults.node, modbus_addr=defaults.modbus_addr,
+                        target_port=defaults.target_port)
+    commands = []
+    for number, line in enumerate(lines, start=1):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        try:
+            args, unknown = parser.parse_known_args(shlex.split(line))
+            if unknown:
+                raise ValueError("unrecognized arguments: %s" % " ".join(unknown))
+            if args.gw is None:
+                raise ValueError("Argument --gw is required")
+            commands.append(BatchCommand(number, args.gw, args.sink, int(args.node), args.cmd, command_payload(args)))
+        except (argparse.ArgumentError, ValueError) as e:
+            raise ValueError("Line %d: %s" % (number, e))
+    return commands
+
+
+async def _run_command(client: AsyncWmbClient, command: BatchCommand, node_window: asyncio.Semaphore,
+                       start: float, timeout: float) -> BatchResult:
+    async with node_window:
+        # Set once the request got its slot in the client's window, so that queueing is not counted in rtt
+        sent = time.monotonic()
+
+        def on_sent(now: float):
+            nonlocal sent
+            sent = now
+
+        try:
+            uplink = await client.request(command.gateway, command.sink, command.node, command.payload, timeout,
+                                          on_sent)
+        except TimeoutError:
+            return BatchResult(command, "timeout", sent - start, None, {})
+        except GatewayError as e:
+            return BatchResult(command, "error", sent - start, None, {"error": str(e)})
+        rtt = time.monotonic() - sent
+        if uplink.modbus is None:
+            return BatchResult(command, "error", sent - start, rtt, {"error": "unexpected answer"})
+        return BatchResult(command, "exception" if uplink.modbus.exception_code else "ok", sent - start, rtt,
+                           describe_response(uplink.modbus))
+
+
+async def run_batch(wni, commands: list[BatchCommand], window: int = 16, node_window: int = 1,
+                    timeout: float = 30.0, output: Optional[TextIO] = None) -> list[BatchResult]:
+    """
+    Run the commands over one connection with up to window of them waiting
+    for their answer, and up to node_window per node so that by default the
+    commands of one node run one after the other in file order. With output
+    each result is written as a JSON line as soon as it is known.
+    """
+    node_windows = defaultdict(lambda: asyncio.Semaphore(node_window))
+    start = time.monotonic()
+
+    async def run(command: BatchCommand) -> BatchResult:
+        result = await _run_command(client, command, node_windows[(command.gateway, command.sink, command.node)],
+                                    start, timeout)
+        if output is not None:
+            output.write(format_result(result) + "\n")
+            output.flush()
+        return result
+
+    async with AsyncWmbClient(wni, window, timeout) as client:
+        # Tasks start in file order, so commands of one node take their node window in that order
+        return await asyncio.gather(*(run(command) for command in commands))
+
+
+def format_result(result: BatchResult) -> str:
+    command = result.command
+    return json.dumps({"line": command.line, "gateway": command.gateway, "sink": command.sink, "node": command.node,
+                       "cmd": command.cmd, "status": result.status, "sent": round(result.sent, 3),
+                       "rtt": round(result.rtt, 3) if result.rtt is not None else None, **result.fields})
+
+
+def log_summary(results: list[BatchResult], elapsed: float):
+    counts = {status: sum(r.status == status for r in results) for status in ("ok", "exception", "timeout", "error")}
+    rtts = sorted(r.rtt for r in results if r.rtt is not None)
+    logging.info("%d commands in %.1fs: %d ok, %d exceptions, %d timeouts, %d errors%s", len(results), elapsed,
+                 *counts.values(), ", rtt p50 %.2fs max %.2fs" % (rtts[len(rtts) // 2], rtts[-1]) if rtts else "")
@@ -0,0 +1,104 @@
+import argparse
+import string
+from mbproto.mb_protocol_iface import MBProto
+from pymodbus.client import ModbusFrameGenerator
+from pymodbus.framer import FramerType
+from uplink_decoder import (ModbusResponse, FC_READ_COILS, FC_READ_HOLDING_REGISTERS, FC_WRITE_MULTIPLE_REGISTERS,
+                            FC_WRITE_SINGLE_COIL)
+
+COMMANDS = ['write_coil', 'read_coil', 'write_regs', 'read_regs']
+
+
+def regs_type(value):
+    if len(value) > 8:
+        raise argparse.ArgumentTypeError("Regs must be up to characters long")
+    if not all(c in string.ascii_letters + string.digits for c in value):
+        raise argparse.ArgumentTypeError("Regs must contain only ASCII letters and digits")
+    return value
+
+
+def add_node_arguments(parser: argparse.ArgumentParser, gw_required: bool = True):
+    parser.add_argument('--gw',
+                        required=gw_required,
+                        help="GW ID")
+    parser.add_argument('--sink',
+                        required=False,
+                        default='sink0',
+                        help="Sink ID")
+    parser.add_argument('--node',
+                        required=False,
+                        default=21,
+                        help="Node address")
+    parser.add_argument('--modbus-addr',
+                        required=False,
+                        type=int,
+                        default=1,
+                        help='Modbus slave address')
+    parser.add_argument('--target-port',
+                        required=False,
+                        type=int,
+                        choices=[1, 2],
+                        default=1,
+                        help='Target port: 1 - Port 1, 2 - Port 2')
+
+
+def add_command_arguments(parser: argparse.ArgumentParser, cmd_required: bool = True):
+    parser.add_argument('--cmd',
+                        required=cmd_required,
+                        type=str,
+                        choices=COMMANDS,
+                        help='Command Types')
+    parser.add_argument('--led-num',
+                        required=False,
+                        type=int,
+                        choices=[0, 1, 2],
+                        help='LED number')
+    parser.add_argument('--led-val',
+                        required=False,
+                        type=int,
+                        choices=[0, 1],
+                        help='LED value')
+    parser.add_argument('--regs',
+                        required=False,
+                        type=regs_type,
+                        help='Regs value')
+
+
+def command_payload(args: argparse.Namespace) -> bytes:
+    """MBProto one-shot payload of the command given by the node and command arguments"""
+    generator = ModbusFrameGenerator(framer=FramerType.RTU, slave=args.modbus_addr)
+
+    if args.cmd == "write_coil":
+        if args.led_num is None or args.led_val is None:
+            raise ValueError("Both --led-num and --led-val arguments are required")
+        led_value = args.led_val == 1
+        modbus_frame = generator.write_coil(args.led_num, led_value)
+    elif args.cmd == "read_coil":
+        if args.led_num is None:
+            raise ValueError("Argument --led-num is required")
+        modbus_frame = generator.read_coils(args.led_num)
+    elif args.cmd == "write_regs":
+        if args.regs is None:
+            raise ValueError("Argument --regs is required")
+        modbus_frame = generator.write_registers(0, args.regs.encode('utf-8'))
+    elif args.cmd == "read_regs":
+        modbus_frame = generator.read_holding_registers(0, count=8)
+    else:
+        raise ValueError("Argument --cmd is required")
+
+    mbproto = MBProto()
+    mbproto.target_port = args.target_port
+    return mbproto.create_modbus_oneshot(modbus_frame)
+
+
+def describe_response(response: ModbusResponse) -> dict:
+    """Fields of a Zephyr RTU server answer worth reporting"""
+    if response.exception_code:
+        return {"exception_code": response.exception_code}
+    if response.function_code in (FC_READ_COILS, FC_WRITE_SINGLE_COIL):
+        return {"led": response.bits[0]}
+    if response.function_code == FC_READ_HOLDING_REGISTERS:
+        return {"regs": "".join(chr(i) for i in response.registers)}
+    if response.function_code == FC_WRITE_MULTIPLE_REGISTERS:
+        return {"count": response.count}
+    return {}
@@ -1,157 +1,127 @@
 import argparse
-import json
-import string
 import logging
-from wirepas_mqtt_library import WirepasNetworkInterface
+import sys
+import time
 import wirepas_mesh_messaging as wmm
-import mbproto.mb_protocol_pb2 as mb_protocol
-from mbproto.mb_protocol_iface import MBProto
-from google.protobuf.json_format import MessageToJson
-from pymodbus.client import ModbusFrameGenerator
-from pymodbus.framer import FramerType
+from uplink_decoder import (UplinkDecoder, FC_READ_COILS, FC_READ_HOLDING_REGISTERS,
+                            FC_WRITE_MULTIPLE_REGISTERS, FC_WRITE_SINGLE_COIL)
+from request_tracker import request_key, uplink_key
+from runtime import Runtime
+from cli_options import add_connection_arguments, connect
+from zephyr_commands import add_command_arguments, add_node_arguments, command_payload
 
-def on_uplink_data_transmitted(data):
-    _mbproto = MBProto()
-    _ret, _err, _msg = _mbproto.decode_response(data.data_payload)
-    _json_str = MessageToJson(_msg, always_print_fields_with_no_presence=True, preserving_proto_field_name=True)
-    _dict = json.loads(_json_str)
-    if (_msg.cmd == mb_protocol.Cmd.CMD_MODBUS_ONE_SHOT or _msg.cmd == mb_protocol.Cmd.CMD_MODBUS_PERIODICAL):
-        if (_msg.payload.payload_answer_frame.ack_frame.acknowladge == 0):
-            _modbus_data = _msg.payload.payload_answer_frame.modbus_response_frame.modbus_frame
-            _modbus_frame = _mbproto.decode_modbus_frame(_modbus_data)
-            _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame'] = _modbus_frame
-    if 'modbus_response_frame' in _dict['payload']['payload_answer_frame']:
-        if 'ReadHoldingRegistersResponse' in _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']:
-            _result = _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']['ReadHoldingRegistersResponse']['registers']
-            _chars = [chr(i) for i in _result]
-            logging.info("Holding registers: %s", _chars)
-        elif 'ReadCoilsResponse' in _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']:
-            _result = _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']['ReadCoilsResponse']['bits']
-            logging.info("LED is " + ("on" if _result[0] else "off"))
-        elif 'WriteMultipleRegistersResponse' in _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']:
-            _result = _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']['WriteMultipleRegistersResponse']['count']
-            logging.info("Wrote %d registers", _result)
-        elif 'WriteSingleCoilResponse' in _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']:
-            _result = _dict['payload']['payload_answer_frame']['modbus_response_frame']['modbus_frame']['WriteSingleCoilResponse']['bits']
-            logging.info("LED set to " + ("on" if _result else "off"))
+decoder = UplinkDecoder()
+runtime = Runtime()
+# Key of the command sent, only its answer ends the run
+expected_key = None
 
-def regs_type(value):
-    if len(value) > 8:
-        raise argparse.ArgumentTypeError("Regs must be up to characters long")
-    if not all(c in string.ascii_letters + string.digits for c in value):
-        raise argparse.ArgumentTypeError("Regs must contain only ASCII letters and digits")
-    return value
+def on_uplink_data_transmitted(data):
+    try:
+        _uplink = decoder.decode(data.data_payload)
+    except ValueError as e:
+        logging.error("Failed to decode uplink: %s", e)
+        return
+    if _uplink.modbus is None or uplink_key(data.gw_id, data.sink_id, data.source_address, _uplink) != expected_key:
+        # Periodic reports, other nodes and answers to other requests
+        return
+    _function_code = _uplink.modbus.function_code
+    if _function_code == FC_READ_HOLDING_REGISTERS:
+        _chars = [chr(i) for i in _uplink.modbus.registers]
+        logging.info("Holding registers: %s", _chars)
+    elif _function_code == FC_READ_COILS:
+        logging.info("LED is " + ("on" if _uplink.modbus.bits[0] else "off"))
+    elif _function_code == FC_WRITE_MULTIPLE_REGISTERS:
+        logging.info("Wrote %d registers", _uplink.modbus.count)
+    elif _function_code == FC_WRITE_SINGLE_COIL:
+        logging.info("LED set to " + ("on" if _uplink.modbus.bits[0] else "off"))
+    runtime.response_received()
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
-    parser.add_argument('--host',
-                        required=True,
-                        help="MQTT broker address")
-    parser.add_argument('--port',
-                        required=False,
-                        default=8883,
-                        type=int,
-                        help="MQTT broker port")
-    parser.add_argument('--username', 
-                        required=False,
-                        default='mqttmasteruser',
-                        help="MQTT broker username")
-    parser.add_argument('--password',
-                        required=True,
-                        help="MQTT broker password")
-    parser.add_argument('--insecure',
+def add_arguments(parser: argparse.ArgumentParser):
+    add_node_arguments(parser, gw_required=False)
+    add_command_arguments(parser, cmd_required=False)
+    parser.add_argument('--timeout',
                         required=False,
-                        dest='insecure',
-                        action='store_true',
-                        help="MQTT use unsecured connection")
-    parser.add_argument('--gw',
-                        required=True,
-                        help="GW ID")
-    parser.add_argument('--sink',
+                        type=float,
+                        help='Seconds to wait for the answer, by default wait until interrupted (30 in batch mode)')
+    parser.add_argument('--batch',
                         required=False,
-                        default='sink0',
-                        help="Sink ID")
-    parser.add_argument('--node',
-                        required=False,
-                        default=21,
-                        help="Node address")
-    parser.add_argument('--modbus-addr',
+                        help='Run the commands of this file, - for stdin, one per line with the same node and '
+                             'command options, e.g. "--node 22 --cmd read_coil --led-num 1"; results are printed '
+                             'as JSON lines')
+    parser.add_argument('--window',
                         required=False,
                         type=int,
-                        default=1,
-                        help='Modbus slave address')
-    parser.add_argument('--target-port',
+                        default=16,
+                        help='Batch mode: commands waiting for their answer at a time')
+    parser.add_argument('--node-window',
                         required=False,
                         type=int,
-                        choices=[1, 2],
                         default=1,
-                        help='Target port: 1 - Port 1, 2 - Port 2')
-    parser.add_argument('--cmd',
-                        required=True,
-                        type=str,
-                        choices=['write_coil', 'read_coil', 'write_regs', 'read_regs'],
-                        help='Command Types')
-    parser.add_argument('--led-num',
-                        required=False,
-                        type=int,
-                        choices=[0, 1, 2],
-                        help='LED number')
-    parser.add_argument('--led-val',
-                        required=False,
-                        type=int,
-                        choices=[0, 1],
-                        help='LED value')
-    parser.add_argument('--regs',
-                        required=False,
-                        type=regs_type,
-                        help='Regs value')
+                        help='Batch mode: commands of one node waiting for their answer at a time, '
+                             '1 runs them in file order')
 
-    args = parser.parse_args()
+def main_batch(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    # Only batch mode needs asyncio and the async client
+    import asyncio
+    from zephyr_batch import load_batch, log_summary, run_batch
 
+    try:
+        if args.batch == '-':
+            commands = load_batch(sys.stdin, args)
+        else:
+            with open(args.batch) as f:
+                commands = load_batch(f, args)
+    except ValueError as e:
+        parser.error("%s: %s" % (args.batch, e))
+
+    runtime.wni = connect(args)
+    start = time.monotonic()
+    results = None
+    try:
+        results = asyncio.run(run_batch(runtime.wni, commands, args.window, args.node_window,
+                                        args.timeout if args.timeout is not None else 30.0, sys.stdout))
+    except KeyboardInterrupt:
+        logging.info("Interrupted, exiting")
+    finally:
+        runtime.shutdown()
+    if results is None:
+        sys.exit(1)
+    log_summary(results, time.monotonic() - start)
+    sys.exit(0 if all(result.status == "ok" for result in results) else 1)
+
+def main(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    global expected_key
     logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
 
-    wni = WirepasNetworkInterface(args.host,
-                                  args.port,
-                                  args.username,
-                                  args.password,
-                                  insecure=args.insecure)
+    if args.batch is not None:
+        main_batch(parser, args)
+    if args.gw is None or args.cmd is None:
+        parser.error("Both --gw and --cmd are required without --batch")
+    try:
+        payload_coded = command_payload(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    wni = connect(args)
+    runtime.wni = wni
     
     # Register a callback for uplink traffic
     wni.register_uplink_traffic_cb(on_uplink_data_transmitted, gateway=args.gw, sink=args.sink, src_ep = 66, dst_ep = 77)
 
-    generator = ModbusFrameGenerator(framer=FramerType.RTU, slave=args.modbus_addr)
-
-    if args.cmd == "write_coil":
-        if args.led_num is None or args.led_val is None:
-            parser.error("Both --led-num and --led-val arguments are required")
-        led_value = args.led_val == 1
-        modbus_frame = generator.write_coil(args.led_num, led_value)
-    elif args.cmd == "read_coil":
-        if args.led_num is None:
-            parser.error("Argument --led-num is required")
-        modbus_frame = generator.read_coils(args.led_num)
-    elif args.cmd == "write_regs":
-        if args.regs is None:
-            parser.error("Argument --regs is required")
-        modbus_frame = generator.write_registers(0, args.regs.encode('utf-8'))
-    elif args.cmd == "read_regs":
-        modbus_frame = generator.read_holding_registers(0, count=8)
-
-    mbproto = MBProto()
-
-    mbproto.target_port = args.target_port
-    payload_coded = mbproto.create_modbus_oneshot(modbus_frame)
-
+    expected_key = request_key(args.gw, args.sink, args.node, payload_coded)
+    runtime.expect(1)
     try:
         res = wni.send_message(args.gw, args.sink, args.node, 77, 66, payload_coded)
         if res != wmm.GatewayResultCode.GW_RES_OK:
-            print("Cannot send data to %s:%s res=%s" % (args.gw, args.sink, res))
+            logging.error("Cannot send data to %s:%s res=%s", args.gw, args.sink, res)
     except TimeoutError:
-        print("Cannot send data to %s:%s", args.gw, args.sink)
+        logging.error("Cannot send data to %s:%s", args.gw, args.sink)
 
-    logging.info("Entering infinite polling, press Ctrl+C to exit")
-    try:
-        while True:
-            pass
-    except KeyboardInterrupt:
-        print("Loop interrupted by user.")
\ No newline at end of file
+    logging.info("Waiting for the answer, press Ctrl+C to exit")
+    runtime.run(args.timeout)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_connection_arguments(parser)
+    add_arguments(parser)
+    main(parser, parser.parse_args())